@@ -0,0 +1,391 @@
+"""Asyncio serving path: the routes in main.py on Quart, with non-blocking cache access and upstream calls.
+
+Run with `uvicorn asgi:app`. One process keeps up to NUTRITIONIX_MAX_CONCURRENCY Nutritionix lookups in
+flight instead of blocking a worker for each round trip.
+"""
+import os
+import time
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Hashable, Union, cast
+
+import httpx
+from quart import Quart, Response, g, render_template, request
+
+import db
+import model
+from cache import rendered_result_cache
+from main import (
+    API_CACHE_CONTROL,
+    MAX_BATCH_SIZE,
+    build_meal_result,
+    build_safe_foods_result,
+    get_result_etag,
+    parse_safe_foods_args,
+)
+from model import (
+    IngredientNutrientResult,
+    list_safe_foods,
+    resolve_ingredient_batch,
+    split_search_queries,
+)
+from metrics import (
+    CONTENT_TYPE,
+    begin_request,
+    cache_lookups,
+    finish_request,
+    registry,
+    span,
+)
+from nutritionix import (
+    NATURAL_NUTRIENTS_PATH,
+    NutritionixClient,
+    UpstreamError,
+    nutritionix_client,
+)
+from presentation import build_ingredient_result
+from quota import INTERACTIVE
+
+app = Quart(__name__)
+
+# the root logger is at NOTSET (see model.py); httpx/httpcore would log every connection event
+logging.getLogger("httpx").setLevel(logging.WARNING)
+logging.getLogger("httpcore").setLevel(logging.WARNING)
+
+
+class AsyncNutritionixClient(NutritionixClient):
+    """NutritionixClient over httpx.AsyncClient, with the same timeouts, retries and circuit breaker.
+
+    Args:
+    - max_concurrency(int) - most requests in flight at once; further callers wait for a free slot
+    """
+
+    def __init__(self, *args, max_concurrency: int = 200, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.max_concurrency = max_concurrency
+        self.http_client: Union[httpx.AsyncClient, None] = None
+        self.semaphore: Union[asyncio.Semaphore, None] = None
+
+    def get_http_client(self) -> httpx.AsyncClient:
+        if self.http_client is None:
+            connect_timeout, read_timeout = self.timeout
+            self.http_client = httpx.AsyncClient(
+                timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+                limits=httpx.Limits(
+                    max_connections=self.max_concurrency,
+                    max_keepalive_connections=self.max_concurrency,
+                ),
+            )
+        return self.http_client
+
+    def get_semaphore(self) -> asyncio.Semaphore:
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self.semaphore
+
+    async def fetch_natural_nutrients_async(
+        self,
+        search_query: str,
+        acquire: Union[Callable[[], Awaitable[None]], None] = None,
+    ) -> str:
+        """Async counterpart of fetch_natural_nutrients(), awaiting acquire before every attempt."""
+        self.begin_call()
+        http_client = self.get_http_client()
+        semaphore = self.get_semaphore()
+        payload = self.build_payload(search_query)
+        last_error = ""
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                await asyncio.sleep(self.get_backoff_delay(attempt - 1))
+            if acquire is not None:
+                with self.releasing_trial_on_shed():
+                    await acquire()
+            async with semaphore:
+                attempt_started = time.perf_counter()
+                try:
+                    response = await http_client.post(
+                        self.base_url + NATURAL_NUTRIENTS_PATH,
+                        headers=self.build_headers(),
+                        content=payload,
+                    )
+                except httpx.HTTPError as error:
+                    last_error = self.record_connection_error(
+                        error, attempt, attempt_started
+                    )
+                    continue
+            error_to_retry = self.check_response(
+                response.status_code, attempt, attempt_started, acquire is not None
+            )
+            if error_to_retry is None:
+                return response.text
+            last_error = error_to_retry
+        self.give_up(last_error)
+
+    async def aclose(self):
+        if self.http_client is not None:
+            await self.http_client.aclose()
+            self.http_client = None
+        # an asyncio.Semaphore is bound to the event loop it was first used on
+        self.semaphore = None
+
+
+class AsyncSingleFlight:
+    """singleflight.SingleFlight for coroutines on one event loop."""
+
+    def __init__(self):
+        self._calls: dict[Hashable, asyncio.Future] = {}
+
+    async def do(self, key: Hashable, function: Callable[[], Awaitable[Any]]) -> Any:
+        call = self._calls.get(key)
+        if call is not None:
+            return await asyncio.shield(call)
+        call = self._calls[key] = asyncio.get_running_loop().create_future()
+        try:
+            result = await function()
+        except BaseException as error:
+            call.set_exception(error)
+            # mark the exception retrieved for the case where nobody else was waiting
+            call.exception()
+            raise
+        else:
+            call.set_result(result)
+            return result
+        finally:
+            del self._calls[key]
+
+
+# shares the sync client's breaker so both serving paths agree on whether Nutritionix is healthy
+async_nutritionix_client = AsyncNutritionixClient(
+    base_url=nutritionix_client.base_url,
+    app_id=nutritionix_client.app_id,
+    app_key=nutritionix_client.app_key,
+    connect_timeout=nutritionix_client.timeout[0],
+    read_timeout=nutritionix_client.timeout[1],
+    max_retries=nutritionix_client.max_retries,
+    circuit_breaker=nutritionix_client.circuit_breaker,
+    max_concurrency=int(os.environ.get("NUTRITIONIX_MAX_CONCURRENCY", "200")),
+)
+async_upstream_fetches = AsyncSingleFlight()
+
+
+async def fetch_with_quota(search_query: str) -> str:
+    """Calls Nutritionix over the async client, waiting on the event loop for an interactive quota token before
+    every attempt."""
+    return await async_nutritionix_client.fetch_natural_nutrients_async(
+        search_query,
+        acquire=lambda: model.upstream_scheduler.acquire_async(INTERACTIVE),
+    )
+
+
+async def resolve_ingredient_async(search_query: str) -> IngredientNutrientResult:
+    """Async counterpart of model.resolve_ingredient(), sharing its lookup tiers: the memory cache on the event loop,
+    the tiers stored in searches.db (model.lookup_stored_result()) in a worker thread, then Nutritionix over the
+    async client. Raises KeyError (model.UnmatchedFoodError) for unmatched foods and UpstreamError when Nutritionix
+    is unavailable and no stale entry exists."""
+    NutrientResults = model.lookup_memory_result(search_query)
+    if NutrientResults is None:
+        NutrientResults = await asyncio.to_thread(
+            model.lookup_stored_result, search_query
+        )
+    elif model.take_freshness_check(search_query):
+        await asyncio.to_thread(model.refresh_if_stale, search_query)
+    if NutrientResults is not None:
+        return NutrientResults
+    cache_key = db.normalize_query(search_query)
+    try:
+        with span("upstream_fetch"):
+            raw_response_from_api = await async_upstream_fetches.do(
+                cache_key, lambda: fetch_with_quota(search_query)
+            )
+    except UpstreamError:
+        NutrientResults = model.lookup_stale_result(search_query)
+        if NutrientResults is None:
+            raise
+        return NutrientResults
+    # a no match answer is written to the negative cache in SQLite
+    NutrientResults = await asyncio.to_thread(
+        model.evaluate_api_response, search_query, raw_response_from_api
+    )
+    model.nutrient_verdict_cache.set(
+        cache_key, NutrientResults.verdict.materialized_verdict
+    )
+    return NutrientResults
+
+
+async def store_results(batch_results: list):
+    """Queues the cache writes for resolved foods from a worker thread; encoding a payload is too slow for the
+    event loop."""
+
+    def insert_results_into_cache():
+        for _, NutrientResults in batch_results:
+            if NutrientResults is not None:
+                NutrientResults.insert_results_into_cache()
+
+    await asyncio.to_thread(insert_results_into_cache)
+
+
+@app.before_request
+async def start_request_timing():
+    g.request_started = begin_request()
+
+
+@app.after_request
+async def record_request_timing(response):
+    """Counts the response and adds a Server-Timing header with the time spent in each stage."""
+    route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+    response.headers["Server-Timing"] = finish_request(
+        route, request.method, response.status_code, g.request_started
+    )
+    return response
+
+
+async def render_search_page(**context) -> str:
+    with span("render"):
+        return await render_template("search.html", **context)
+
+
+async def get_cached_rendering(
+    kind: str, etag: str, render: Callable[[], Awaitable[Any]]
+):
+    """Async counterpart of main.get_cached_rendering(); shares its cache."""
+    rendering = rendered_result_cache.get((kind, etag))
+    cache_lookups.inc(
+        tier=f"rendered_{kind}", result="miss" if rendering is None else "hit"
+    )
+    if rendering is None:
+        rendering = await render()
+        rendered_result_cache.set((kind, etag), rendering)
+    return rendering
+
+
+async def serialize_result(result: dict) -> bytes:
+    # typed as the sans-IO werkzeug Response; Quart's provider builds a quart.Response, whose get_data() is async
+    response = cast(Response, app.json.response(result))
+    return await response.get_data(as_text=False)
+
+
+@app.route("/metrics", methods=["GET"])
+async def get_metrics():
+    return registry.render(), 200, {"Content-Type": CONTENT_TYPE}
+
+
+@app.after_serving
+async def close_upstream_client():
+    await async_nutritionix_client.aclose()
+
+
+@app.route("/")
+async def index():
+    return await render_search_page(search_query="")
+
+
+@app.route("/", methods=["POST"])
+async def update():
+    search_query = (await request.form)["search_query"]
+    try:
+        NutrientResults = await resolve_ingredient_async(search_query)
+        await store_results([(search_query, NutrientResults)])
+    except KeyError:
+        return await render_search_page(search_query="", error=True)
+    except UpstreamError:
+        return await render_search_page(search_query="", upstream_error=True)
+    return await get_cached_rendering(
+        "html",
+        get_result_etag(search_query, NutrientResults),
+        lambda: render_search_page(
+            **build_ingredient_result(search_query, NutrientResults)
+        ),
+    )
+
+
+@app.route("/meal", methods=["POST"])
+async def update_meal():
+    search_queries = split_search_queries((await request.form)["search_queries"])
+    if not search_queries or len(search_queries) > MAX_BATCH_SIZE:
+        return await render_search_page(search_query="", error=True)
+    try:
+        # a batch is already a single upstream call, so it runs on a worker thread
+        batch_results = await asyncio.to_thread(
+            resolve_ingredient_batch, search_queries
+        )
+    except UpstreamError:
+        return await render_search_page(search_query="", upstream_error=True)
+    await store_results(batch_results)
+    return await render_search_page(
+        search_query="", meal=build_meal_result(batch_results)
+    )
+
+
+@app.route("/api/v1/get_single_ingredient", methods=["GET"])
+async def get_single_ingredient_result():
+    if "search_query" not in request.args:
+        return "Error: No query provided. Please specify a food."
+    search_query = request.args["search_query"]
+    try:
+        NutrientResults = await resolve_ingredient_async(search_query)
+        await store_results([(search_query, NutrientResults)])
+    except KeyError:
+        return await render_search_page(search_query="", error=True)
+    except UpstreamError:
+        return (
+            dict(
+                search_query=search_query,
+                error="Nutrition data is temporarily unavailable. Please try again.",
+            ),
+            503,
+            {"Cache-Control": "no-store"},
+        )
+    etag = get_result_etag(search_query, NutrientResults)
+    headers = {"Cache-Control": API_CACHE_CONTROL}
+    if request.if_none_match.contains(etag):
+        response = app.response_class(b"", status=304, headers=headers)
+    else:
+        body = await get_cached_rendering(
+            "json",
+            etag,
+            lambda: serialize_result(
+                build_ingredient_result(search_query, NutrientResults)
+            ),
+        )
+        response = app.response_class(
+            body, mimetype="application/json", headers=headers
+        )
+    response.set_etag(etag)
+    return response
+
+
+@app.route("/api/v1/get_ingredients", methods=["GET", "POST"])
+async def get_ingredients_result():
+    values = request.args if request.method == "GET" else await request.values
+    if not split_search_queries(values.get("search_queries", "")):
+        return "Error: No query provided. Please specify a list of foods."
+    search_queries = split_search_queries(values["search_queries"])
+    if len(search_queries) > MAX_BATCH_SIZE:
+        return (
+            dict(error=f"Please specify at most {MAX_BATCH_SIZE} foods per request."),
+            400,
+        )
+    try:
+        batch_results = await asyncio.to_thread(
+            resolve_ingredient_batch, search_queries
+        )
+    except UpstreamError:
+        return (
+            dict(
+                search_queries=search_queries,
+                error="Nutrition data is temporarily unavailable. Please try again.",
+            ),
+            503,
+        )
+    await store_results(batch_results)
+    return build_meal_result(batch_results)
+
+
+@app.route("/api/v1/safe_foods", methods=["GET"])
+async def get_safe_foods_result():
+    try:
+        page = parse_safe_foods_args(request.args)
+    except ValueError as error:
+        return dict(error=str(error)), 400
+    foods = await asyncio.to_thread(list_safe_foods, **page)
+    return build_safe_foods_result(page, foods)
@@ -0,0 +1,584 @@
+"""Offline benchmarks run against stub_nutritionix.py.
+
+    python benchmark.py serving --requests 400 --concurrency 100 --latency 0.1
+    python benchmark.py workers --workers 1 2 4 --threads 1
+    python benchmark.py hit-ratio --database searches.db
+    python benchmark.py --output baseline.json suite
+    python benchmark.py compare baseline.json current.json
+
+serving: sync Flask path (one request at a time, like a gunicorn sync worker) against the asyncio path
+in asgi.py under uvicorn, both resolving distinct cache misses through a stub with fixed latency.
+
+workers: gunicorn.conf.py (preloaded app, shared searches.db) at each worker count, first resolving distinct
+cache misses through the stub and then the same queries again, answered from what any worker cached.
+
+endpoints: the Flask routes in process through the test client against the raw payloads recorded in
+searches.db, served by stub_nutritionix.py: memory and SQLite cache hits, cache misses, unmatched foods and
+upstream errors for POST / (main.update) and /api/v1/get_single_ingredient, plus conditional GETs
+answered 304 Not Modified. Memory cache scenarios also hit the rendered result cache; SQLite scenarios run
+with both memory caches disabled.
+
+parsing: the nutrient parsing and verdict functions on the recorded payloads, without any I/O.
+
+suite: endpoints, parsing and hit-ratio in one JSON document; compare reports the latency and throughput
+changes between two such documents.
+
+hit-ratio: replays the legacy Searches history in order against an empty cache and counts the searches
+answered by an exact query match against those also answered by a scaled or similar cached search.
+"""
+import os
+import sys
+import json
+import time
+import socket
+import sqlite3
+import asyncio
+import argparse
+import tempfile
+import subprocess
+from contextlib import contextmanager
+from typing import Callable, Iterable, Union
+
+import httpx
+
+import db
+from stub_nutritionix import StubNutritionixServer, load_recorded_responses
+
+SERVER_COMMANDS = {
+    "sync": [
+        sys.executable,
+        "-m",
+        "flask",
+        "--app",
+        "main",
+        "run",
+        "--without-threads",
+    ],
+    "async": [sys.executable, "-m", "uvicorn", "asgi:app", "--log-level", "warning"],
+    "gunicorn": [sys.executable, "-m", "gunicorn", "--config", "gunicorn.conf.py"],
+}
+
+# the stub enforces no quota, so the upstream scheduler (quota.py) must not throttle the load either
+UNTHROTTLED_ENVIRONMENT = dict(NUTRITIONIX_CALLS_PER_MINUTE="1000000")
+
+
+def percentile(samples: list[float], fraction: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def summarize_latencies(
+    latencies: list[float], elapsed_seconds: float, errors: int = 0, digits: int = 3
+) -> dict:
+    """Latency percentiles in milliseconds (rounded to digits) and throughput in requests per second."""
+    return {
+        "requests": len(latencies) + errors,
+        "errors": errors,
+        "elapsed_seconds": round(elapsed_seconds, 4),
+        "throughput_per_second": round(
+            (len(latencies) + errors) / elapsed_seconds if elapsed_seconds else 0.0, 2
+        ),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, digits),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, digits),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, digits),
+    }
+
+
+def get_free_port() -> int:
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+
+def start_server(mode: str, port: int, environment: dict) -> subprocess.Popen:
+    if mode == "gunicorn":
+        command = SERVER_COMMANDS[mode] + ["--bind", f"127.0.0.1:{port}"]
+    else:
+        command = SERVER_COMMANDS[mode] + ["--host", "127.0.0.1", "--port", str(port)]
+    process = subprocess.Popen(
+        command,
+        env=environment,
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            httpx.get(f"http://127.0.0.1:{port}/", timeout=1.0)
+            return process
+        except httpx.HTTPError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError(f"{mode} server did not start on port {port}")
+
+
+async def run_load(
+    base_url: str, paths: list[str], concurrency: int
+) -> tuple[list[float], int, float]:
+    """Requests every path with at most concurrency in flight. Returns latencies, error count and wall time."""
+    latencies: list[float] = []
+    errors = 0
+    semaphore = asyncio.Semaphore(concurrency)
+    limits = httpx.Limits(max_connections=concurrency)
+    async with httpx.AsyncClient(
+        base_url=base_url, timeout=120.0, limits=limits
+    ) as client:
+
+        async def request(path: str):
+            nonlocal errors
+            async with semaphore:
+                started = time.perf_counter()
+                try:
+                    response = await client.get(path)
+                except httpx.HTTPError:
+                    errors += 1
+                    return
+                if response.status_code != 200:
+                    errors += 1
+                    return
+                latencies.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(request(path) for path in paths))
+        return latencies, errors, time.perf_counter() - started
+
+
+def benchmark_serving(
+    requests: int, concurrency: int, latency_seconds: float, modes: list[str]
+) -> dict:
+    stub = StubNutritionixServer(
+        latency_seconds=latency_seconds, synthesize_unknown=True
+    ).start()
+    results: dict = {
+        "stub_latency_seconds": latency_seconds,
+        "concurrency": concurrency,
+    }
+    try:
+        for mode in modes:
+            with tempfile.TemporaryDirectory() as directory:
+                environment = dict(
+                    os.environ,
+                    SEARCHES_DB=os.path.join(directory, "searches.db"),
+                    NUTRITIONIX_URL=stub.url,
+                    **UNTHROTTLED_ENVIRONMENT,
+                )
+                port = get_free_port()
+                process = start_server(mode, port, environment)
+                calls_before = stub.call_count
+                try:
+                    paths = [
+                        f"/api/v1/get_single_ingredient?search_query={mode}+food+{number}"
+                        for number in range(requests)
+                    ]
+                    latencies, errors, elapsed = asyncio.run(
+                        run_load(f"http://127.0.0.1:{port}", paths, concurrency)
+                    )
+                finally:
+                    process.terminate()
+                    process.wait(timeout=10)
+                results[mode] = summarize_latencies(latencies, elapsed, errors)
+                results[mode]["upstream_calls"] = stub.call_count - calls_before
+    finally:
+        stub.stop()
+    return results
+
+
+def benchmark_workers(
+    requests: int,
+    concurrency: int,
+    latency_seconds: float,
+    worker_counts: list[int],
+    threads: int,
+) -> dict:
+    """Runs gunicorn.conf.py with each worker count: distinct cache misses through the stub, then the same
+    queries again, which every worker must answer from what the others cached in searches.db."""
+    stub = StubNutritionixServer(
+        latency_seconds=latency_seconds, synthesize_unknown=True
+    ).start()
+    results: dict = {
+        "stub_latency_seconds": latency_seconds,
+        "concurrency": concurrency,
+        "threads": threads,
+    }
+    try:
+        for worker_count in worker_counts:
+            with tempfile.TemporaryDirectory() as directory:
+                environment = dict(
+                    os.environ,
+                    SEARCHES_DB=os.path.join(directory, "searches.db"),
+                    NUTRITIONIX_URL=stub.url,
+                    **UNTHROTTLED_ENVIRONMENT,
+                    WEB_CONCURRENCY=str(worker_count),
+                    GUNICORN_THREADS=str(threads),
+                    LOG_FILENAME=os.path.join(directory, "mainlog.log"),
+                )
+                port = get_free_port()
+                process = start_server("gunicorn", port, environment)
+                paths = [
+                    f"/api/v1/get_single_ingredient?search_query=food+{number}"
+                    for number in range(requests)
+                ]
+                result = {}
+                try:
+                    for scenario in ("miss", "shared_hit"):
+                        calls_before = stub.call_count
+                        latencies, errors, elapsed = asyncio.run(
+                            run_load(f"http://127.0.0.1:{port}", paths, concurrency)
+                        )
+                        result[scenario] = summarize_latencies(
+                            latencies, elapsed, errors
+                        )
+                        result[scenario]["upstream_calls"] = (
+                            stub.call_count - calls_before
+                        )
+                finally:
+                    process.terminate()
+                    process.wait(timeout=30)
+                results[f"workers_{worker_count}"] = result
+    finally:
+        stub.stop()
+    return results
+
+
+def time_calls(
+    function: Callable, arguments: Iterable, digits: int = 3
+) -> tuple[dict, list]:
+    """Calls function once per argument, one at a time. Returns the latency summary and the results."""
+    latencies = []
+    results = []
+    started = time.perf_counter()
+    for argument in arguments:
+        call_started = time.perf_counter()
+        results.append(function(argument))
+        latencies.append(time.perf_counter() - call_started)
+    return (
+        summarize_latencies(latencies, time.perf_counter() - started, digits=digits),
+        results,
+    )
+
+
+@contextmanager
+def offline_app(responses: dict, directory: str, memory_cache_size: int = 512):
+    """The Flask app wired to a fresh cache database in directory and a stub serving responses. Yields the test
+    client and the stub. memory_cache_size bounds both the verdict and the rendered result caches."""
+    import main
+    import model
+    from cache import MemoryCache
+    from nutritionix import NutritionixClient
+
+    stub = StubNutritionixServer(responses=responses).start()
+    store = db.CacheStore(os.path.join(directory, "searches.db"))
+    replaced = [
+        (db, "cache_store", store),
+        (model, "nutritionix_client", NutritionixClient(base_url=stub.url)),
+        (model, "nutrient_verdict_cache", MemoryCache(max_size=memory_cache_size)),
+        (main, "rendered_result_cache", MemoryCache(max_size=memory_cache_size)),
+    ]
+    originals = [getattr(module, name) for module, name, _ in replaced]
+    for module, name, value in replaced:
+        setattr(module, name, value)
+    try:
+        yield main.app.test_client(), stub
+    finally:
+        for (module, name, _), original in zip(replaced, originals):
+            setattr(module, name, original)
+        store.close()
+        stub.stop()
+
+
+def benchmark_endpoints(database_path: str, repeat: int) -> dict:
+    """Times each route and scenario over every recorded query, repeat passes for the cache hit scenarios."""
+    responses = load_recorded_responses(database_path)
+    queries = sorted(responses)
+    unknown_queries = [f"unrecorded food {number}" for number in range(len(queries))]
+
+    etags: dict[str, str] = {}
+
+    def post_update(search_query: str):
+        return client.post("/", data={"search_query": search_query})
+
+    def get_single_ingredient(search_query: str):
+        response = client.get(
+            "/api/v1/get_single_ingredient", query_string={"search_query": search_query}
+        )
+        if response.headers.get("ETag"):
+            etags[search_query] = response.headers["ETag"]
+        return response
+
+    def get_single_ingredient_if_changed(search_query: str):
+        return client.get(
+            "/api/v1/get_single_ingredient",
+            query_string={"search_query": search_query},
+            headers={"If-None-Match": etags.get(search_query, "")},
+        )
+
+    def get_safe_foods(query_string: str):
+        return client.get(f"/api/v1/safe_foods?{query_string}")
+
+    def run(scenario: str, send: Callable, search_queries: list[str]):
+        summary, responses_sent = time_calls(send, search_queries)
+        statuses = [response.status_code for response in responses_sent]
+        summary["statuses"] = {
+            str(status): statuses.count(status) for status in sorted(set(statuses))
+        }
+        response_bytes = sum(len(response.get_data()) for response in responses_sent)
+        summary["response_bytes"] = response_bytes
+        summary["bytes_per_request"] = round(response_bytes / len(responses_sent), 1)
+        summary["upstream_calls"] = stub.call_count - calls_before
+        results[scenario] = summary
+
+    results: dict = {"recorded_queries": len(queries), "repeat": repeat}
+    hit_queries = queries * repeat
+    safe_food_pages = [
+        f"order_by={order_by}&max_fructose=3&offset={offset}"
+        for order_by in db.SAFE_FOOD_ORDERS
+        for offset in (0, 20)
+    ] * (len(queries) * repeat // 4 or 1)
+    with tempfile.TemporaryDirectory() as directory:
+        with offline_app(responses, directory) as (client, stub):
+            calls_before = stub.call_count
+            run("update_miss", post_update, queries)
+            db.cache_store.flush()
+            calls_before = stub.call_count
+            run("update_hit_memory", post_update, hit_queries)
+            calls_before = stub.call_count
+            run("api_hit_memory", get_single_ingredient, hit_queries)
+            calls_before = stub.call_count
+            run("api_hit_not_modified", get_single_ingredient_if_changed, hit_queries)
+            calls_before = stub.call_count
+            run("api_unmatched", get_single_ingredient, unknown_queries)
+            calls_before = stub.call_count
+            run("api_safe_foods", get_safe_foods, safe_food_pages)
+    with tempfile.TemporaryDirectory() as directory:
+        with offline_app(responses, directory, memory_cache_size=0) as (client, stub):
+            calls_before = stub.call_count
+            run("api_miss", get_single_ingredient, queries)
+            for search_query in queries:
+                post_update(search_query)
+            db.cache_store.flush()
+            calls_before = stub.call_count
+            run("api_hit_sqlite", get_single_ingredient, hit_queries)
+            calls_before = stub.call_count
+            run("update_hit_sqlite", post_update, hit_queries)
+            stub.error_rate = 1.0
+            calls_before = stub.call_count
+            run("api_upstream_error", get_single_ingredient, unknown_queries)
+    return results
+
+
+def benchmark_parsing(database_path: str, repeat: int) -> dict:
+    """Times the pure nutrient functions on every recorded food, repeat passes each."""
+    from nutrients import (
+        NutrientBatch,
+        evaluate,
+        evaluate_materialized_verdict,
+        parse_food,
+    )
+    from queries import parse_query
+
+    responses = []
+    for search_query, response in load_recorded_responses(database_path).items():
+        try:
+            evaluate(response)
+        except (KeyError, IndexError, TypeError, ValueError):
+            continue
+        responses.append((search_query, response))
+    queries = [search_query for search_query, _ in responses] * repeat
+    parsed_responses = [response for _, response in responses] * repeat
+    raw_responses = [json.dumps(response) for response in parsed_responses]
+    foods = [response["foods"][0] for response in parsed_responses]
+    verdicts = [
+        evaluate(response).materialized_verdict for response in parsed_responses
+    ]
+
+    results: dict = {"calls": len(parsed_responses)}
+    results["json_loads_and_evaluate"], _ = time_calls(
+        lambda raw: evaluate(json.loads(raw.lower())), raw_responses, digits=4
+    )
+    results["parse_food"], _ = time_calls(parse_food, foods, digits=4)
+    results["evaluate"], _ = time_calls(evaluate, parsed_responses, digits=4)
+    results["evaluate_materialized_verdict"], _ = time_calls(
+        evaluate_materialized_verdict, verdicts, digits=4
+    )
+    results["parse_query"], _ = time_calls(parse_query, queries, digits=4)
+    batch_foods = [food for food in foods if food["tags"].get("quantity") is not None]
+    results["nutrient_batch_evaluate"], _ = time_calls(
+        lambda batch: NutrientBatch.from_foods(batch).evaluate(),
+        [batch_foods] * repeat,
+        digits=4,
+    )
+    results["nutrient_batch_evaluate"]["foods_per_call"] = len(batch_foods)
+    return results
+
+
+def compare_results(baseline: dict, current: dict, threshold: float) -> list[str]:
+    """Returns a line per latency or throughput figure that got worse by more than threshold (a fraction)."""
+    regressions = []
+
+    def walk(baseline_value, current_value, path: str):
+        if isinstance(baseline_value, dict) and isinstance(current_value, dict):
+            for key in baseline_value.keys() & current_value.keys():
+                walk(
+                    baseline_value[key], current_value[key], f"{path}.{key}".strip(".")
+                )
+            return
+        if not isinstance(baseline_value, (int, float)) or not baseline_value:
+            return
+        if path.endswith("_ms"):
+            change = current_value / baseline_value - 1
+        elif path.endswith("throughput_per_second"):
+            change = baseline_value / current_value - 1 if current_value else 1.0
+        else:
+            return
+        if change > threshold:
+            regressions.append(
+                f"{path}: {baseline_value} -> {current_value} ({change:+.0%})"
+            )
+
+    walk(baseline, current, "")
+    return sorted(regressions)
+
+
+def benchmark_hit_ratio(database_path: str) -> dict:
+    import model
+    from nutrients import evaluate
+
+    legacy_connection = sqlite3.connect(database_path)
+    if not db.table_exists(legacy_connection, "Searches"):
+        raise SystemExit(f"{database_path} has no legacy Searches history to replay")
+    rows = legacy_connection.execute(
+        "SELECT COALESCE(query, name), raw FROM Searches ORDER BY id"
+    ).fetchall()
+    legacy_connection.close()
+
+    exact_hits = similar_hits = searches = 0
+    started = time.perf_counter()
+    with tempfile.TemporaryDirectory() as directory:
+        store = db.CacheStore(
+            os.path.join(directory, "searches.db"), write_behind=False
+        )
+        cache_store, db.cache_store = db.cache_store, store
+        try:
+            for search_query, raw in rows:
+                if not db.normalize_query(search_query):
+                    continue
+                searches += 1
+                if store.lookup_verdict(search_query) is not None:
+                    exact_hits += 1
+                    continue
+                if model.lookup_similar_verdict(search_query) is not None:
+                    similar_hits += 1
+                    continue
+                try:
+                    model.IngredientNutrientResult(
+                        search_query,
+                        evaluate(json.loads(db.clean_raw_payload(raw).lower())),
+                        raw,
+                    ).insert_results_into_cache()
+                except (KeyError, IndexError, TypeError, ValueError):
+                    continue
+        finally:
+            db.cache_store = cache_store
+            store.close()
+    return {
+        "searches": searches,
+        "exact_hits": exact_hits,
+        "similar_hits": similar_hits,
+        "hit_ratio_before": round(exact_hits / searches, 3) if searches else 0.0,
+        "hit_ratio_after": (
+            round((exact_hits + similar_hits) / searches, 3) if searches else 0.0
+        ),
+        "elapsed_seconds": round(time.perf_counter() - started, 3),
+    }
+
+
+def write_results(results: dict, output: Union[str, None]):
+    encoded = json.dumps(results, indent=2)
+    if output:
+        with open(output, "w", encoding="utf-8") as output_file:
+            output_file.write(encoded + "\n")
+    print(encoded)
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--output", help="also write the JSON results to this file")
+    subcommands = parser.add_subparsers(dest="command", required=True)
+    serving = subcommands.add_parser("serving", help="sync Flask vs asyncio path")
+    serving.add_argument("--requests", type=int, default=400)
+    serving.add_argument("--concurrency", type=int, default=100)
+    serving.add_argument("--latency", type=float, default=0.1)
+    serving.add_argument(
+        "--modes", nargs="+", choices=sorted(SERVER_COMMANDS), default=["sync", "async"]
+    )
+    workers = subcommands.add_parser(
+        "workers", help="throughput of gunicorn.conf.py by worker count"
+    )
+    workers.add_argument("--requests", type=int, default=400)
+    workers.add_argument("--concurrency", type=int, default=32)
+    workers.add_argument("--latency", type=float, default=0.1)
+    workers.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    workers.add_argument("--threads", type=int, default=1)
+    hit_ratio = subcommands.add_parser(
+        "hit-ratio", help="cache hit ratio of the search history with near matches"
+    )
+    hit_ratio.add_argument("--database", default=db.DATABASE_PATH)
+    for name, help_text in (
+        ("endpoints", "routes end to end against recorded responses"),
+        ("parsing", "nutrient parsing and verdict functions"),
+        ("suite", "endpoints, parsing and hit-ratio"),
+    ):
+        offline = subcommands.add_parser(name, help=help_text)
+        offline.add_argument("--database", default=db.DATABASE_PATH)
+        offline.add_argument("--repeat", type=int, default=5)
+    compare = subcommands.add_parser(
+        "compare", help="report regressions between two JSON results"
+    )
+    compare.add_argument("baseline")
+    compare.add_argument("current")
+    compare.add_argument(
+        "--threshold",
+        type=float,
+        default=0.1,
+        help="fraction a latency may grow (or throughput shrink) before it is reported",
+    )
+    args = parser.parse_args(argv)
+
+    if args.command == "serving":
+        results = benchmark_serving(
+            args.requests, args.concurrency, args.latency, args.modes
+        )
+    elif args.command == "workers":
+        results = benchmark_workers(
+            args.requests, args.concurrency, args.latency, args.workers, args.threads
+        )
+    elif args.command == "hit-ratio":
+        results = benchmark_hit_ratio(args.database)
+    elif args.command == "endpoints":
+        results = benchmark_endpoints(args.database, args.repeat)
+    elif args.command == "parsing":
+        results = benchmark_parsing(args.database, args.repeat)
+    elif args.command == "suite":
+        results = {
+            "endpoints": benchmark_endpoints(args.database, args.repeat),
+            "parsing": benchmark_parsing(args.database, args.repeat),
+            "hit_ratio": benchmark_hit_ratio(args.database),
+        }
+    elif args.command == "compare":
+        with open(args.baseline, encoding="utf-8") as baseline_file:
+            baseline = json.load(baseline_file)
+        with open(args.current, encoding="utf-8") as current_file:
+            current = json.load(current_file)
+        regressions = compare_results(baseline, current, args.threshold)
+        print("\n".join(regressions) or "No regressions")
+        return 1 if regressions else 0
+    write_results(results, args.output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
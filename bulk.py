@@ -0,0 +1,290 @@
+"""Evaluates large food lists (menus, grocery exports) from the command line and streams the verdicts as JSONL.
+
+    python bulk.py menu.txt --output verdicts.jsonl
+    python bulk.py export.csv --column product --concurrency 8 --output verdicts.jsonl
+    cat foods.jsonl | python bulk.py - --format jsonl > verdicts.jsonl
+
+Foods are read one at a time from a text file (one food per line), a CSV file or a JSONL file, and resolved with
+model.resolve_ingredient() by a bounded pool of threads, so Nutritionix calls go through the quota scheduler's
+background lane. Each verdict is written as soon as it is ready, in the fields of the JSON API plus its input
+"line" and a "status" (ok or unmatched), so output lines can be out of input order. Memory does not grow with
+the input: only a bounded window of lines past the oldest unfinished one is in flight.
+
+With --output a checkpoint file records how far the output is complete; an interrupted run, or one stopped by
+Nutritionix being unavailable, resumes from it and rewrites nothing already written.
+"""
+import os
+import csv
+import sys
+import json
+import time
+import argparse
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import BinaryIO, Callable, Iterable, Iterator, Union
+
+from model import resolve_ingredient
+from nutritionix import UpstreamError
+from presentation import build_ingredient_result
+from quota import BACKGROUND, QuotaExceededError, upstream_scheduler
+
+INPUT_FORMATS = ("text", "csv", "jsonl")
+# lines past the oldest unfinished one that may be in flight or finished, per worker thread
+WINDOW_PER_WORKER = 16
+# pause before retrying a food shed because the background lane's queue was full
+QUEUE_FULL_RETRY_SECONDS = 0.1
+
+
+def detect_input_format(input_path: str) -> str:
+    extension = os.path.splitext(input_path)[1].lower()
+    if extension == ".csv":
+        return "csv"
+    if extension in (".jsonl", ".ndjson"):
+        return "jsonl"
+    return "text"
+
+
+def read_foods(lines: Iterable[str], input_format: str, column: str) -> Iterator[str]:
+    """Yields the food of every non blank record, reading lines lazily.
+
+    Args:
+    - input_format(String) - one of INPUT_FORMATS
+    - column(String) - CSV column or JSON key holding the food; JSONL lines may also be plain JSON strings
+    """
+    if input_format == "csv":
+        reader = csv.DictReader(lines)
+        if reader.fieldnames is not None and column not in reader.fieldnames:
+            raise ValueError(
+                f"No {column!r} column, found: {', '.join(reader.fieldnames)}"
+            )
+        records: Iterable = (row[column] or "" for row in reader)
+    elif input_format == "jsonl":
+        records = (
+            record if isinstance(record, str) else record.get(column) or ""
+            for record in (json.loads(line) for line in lines if line.strip())
+        )
+    else:
+        records = lines
+    for record in records:
+        food = record.strip()
+        if food:
+            yield food
+
+
+def evaluate_food(search_query: str) -> tuple[dict, bool]:
+    """Returns the output record for a food and whether Nutritionix was called for it. Fetched answers are stored
+    in the cache; cache hits are not counted as searches. A call shed because the background lane's queue is full
+    is backpressure and retried; other nutritionix.UpstreamErrors are raised."""
+    while True:
+        try:
+            result = resolve_ingredient(search_query, lane=BACKGROUND)
+        except KeyError:
+            return dict(search_query=search_query, status="unmatched"), False
+        except QuotaExceededError as error:
+            if error.reason != "queue_full":
+                raise
+            time.sleep(QUEUE_FULL_RETRY_SECONDS)
+            continue
+        break
+    fetched = bool(result.raw_response_from_api)
+    if fetched:
+        result.insert_results_into_cache()
+    return (
+        dict(status="ok", **build_ingredient_result(search_query, result)),
+        fetched,
+    )
+
+
+def load_checkpoint(checkpoint_path: str) -> dict:
+    """Returns the progress of an interrupted run: every line before next_line and the lines in done_after are
+    written, in the first output_bytes of the output."""
+    try:
+        with open(checkpoint_path, encoding="utf-8") as checkpoint_file:
+            checkpoint = json.load(checkpoint_file)
+        return dict(
+            next_line=int(checkpoint["next_line"]),
+            done_after=[int(line) for line in checkpoint["done_after"]],
+            output_bytes=int(checkpoint["output_bytes"]),
+        )
+    except (OSError, ValueError, KeyError, TypeError):
+        return dict(next_line=1, done_after=[], output_bytes=0)
+
+
+def save_checkpoint(checkpoint_path: str, checkpoint: dict):
+    temporary_path = checkpoint_path + ".tmp"
+    with open(temporary_path, "w", encoding="utf-8") as checkpoint_file:
+        json.dump(checkpoint, checkpoint_file)
+    os.replace(temporary_path, checkpoint_path)
+
+
+def evaluate_stream(
+    foods: Iterable[str],
+    output: BinaryIO,
+    evaluate: Callable[[str], tuple[dict, bool]] = evaluate_food,
+    concurrency: int = 4,
+    checkpoint: Union[dict, None] = None,
+    save: Union[Callable[[dict], None], None] = None,
+    checkpoint_every: int = 100,
+    report: Callable[[str], None] = print,
+) -> dict:
+    """Evaluates foods on concurrency threads and writes one JSON line per food to output as each finishes.
+
+    Args:
+    - checkpoint(dict) - progress of an earlier run (see load_checkpoint()); its lines are skipped
+    - save(callable) - stores the progress, after flushing output, every checkpoint_every lines and at the end
+
+    Stops submitting foods at the first nutritionix.UpstreamError and lets the running ones finish. Returns counts
+    of ok, unmatched, fetched, skipped and failed foods.
+    """
+    checkpoint = checkpoint or dict(next_line=1, done_after=[], output_bytes=0)
+    next_line = checkpoint["next_line"]
+    done_after = set(checkpoint["done_after"])
+    counts = dict(ok=0, unmatched=0, fetched=0, skipped=0, failed=0)
+    window = concurrency * WINDOW_PER_WORKER
+
+    def save_progress():
+        if save is not None:
+            output.flush()
+            save(
+                dict(
+                    next_line=next_line,
+                    done_after=sorted(done_after),
+                    output_bytes=output.tell(),
+                )
+            )
+
+    numbered_foods = enumerate(foods, start=1)
+    pending: dict[Future, tuple[int, str]] = {}
+    last_submitted = next_line - 1
+    exhausted = stopping = False
+    since_checkpoint = 0
+    with ThreadPoolExecutor(concurrency, thread_name_prefix="bulk") as executor:
+        while True:
+            while (
+                not (exhausted or stopping)
+                and len(pending) < 2 * concurrency
+                and last_submitted - next_line < window
+            ):
+                numbered_food = next(numbered_foods, None)
+                if numbered_food is None:
+                    exhausted = True
+                    continue
+                line, search_query = numbered_food
+                if line < next_line or line in done_after:
+                    counts["skipped"] += 1
+                else:
+                    pending[executor.submit(evaluate, search_query)] = (
+                        line,
+                        search_query,
+                    )
+                    last_submitted = line
+            if not pending:
+                break
+            finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                line, search_query = pending.pop(future)
+                try:
+                    record, fetched = future.result()
+                except UpstreamError as error:
+                    counts["failed"] += 1
+                    if not stopping:
+                        report(f"Nutritionix unavailable, stopping: {error}")
+                    stopping = True
+                    continue
+                output.write(
+                    (json.dumps(dict(line=line, **record)) + "\n").encode("utf-8")
+                )
+                counts[record["status"]] += 1
+                counts["fetched"] += fetched
+                done_after.add(line)
+                while next_line in done_after:
+                    done_after.remove(next_line)
+                    next_line += 1
+                since_checkpoint += 1
+                if since_checkpoint >= checkpoint_every:
+                    save_progress()
+                    since_checkpoint = 0
+    save_progress()
+    return counts
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("input", help="food list to evaluate, - for stdin")
+    parser.add_argument("--format", choices=INPUT_FORMATS, dest="input_format")
+    parser.add_argument(
+        "--column", default="food", help="CSV column or JSON key holding the food"
+    )
+    parser.add_argument(
+        "--output", default="-", help="JSONL file to write, - for stdout"
+    )
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument(
+        "--checkpoint", help="progress file, defaults to <output>.checkpoint.json"
+    )
+    parser.add_argument("--checkpoint-every", type=int, default=100)
+    parser.add_argument(
+        "--restart", action="store_true", help="ignore an existing checkpoint"
+    )
+    args = parser.parse_args(argv)
+    input_format = args.input_format or detect_input_format(args.input)
+
+    checkpoint_path = None
+    checkpoint = None
+    if args.output == "-":
+        output = sys.stdout.buffer
+    else:
+        checkpoint_path = args.checkpoint or args.output + ".checkpoint.json"
+        if not args.restart and os.path.exists(checkpoint_path):
+            checkpoint = load_checkpoint(checkpoint_path)
+        if checkpoint is not None and os.path.exists(args.output):
+            output = open(args.output, "r+b")
+            # drop lines written after the last checkpoint; they are evaluated again
+            output.truncate(checkpoint["output_bytes"])
+            output.seek(0, os.SEEK_END)
+        else:
+            checkpoint = None
+            output = open(args.output, "wb")
+
+    started = time.perf_counter()
+    input_file = (
+        sys.stdin
+        if args.input == "-"
+        else open(args.input, newline="", encoding="utf-8-sig")
+    )
+    try:
+        # every worker thread may be waiting for a token at once
+        with upstream_scheduler.reserved_queue_slots(BACKGROUND, args.concurrency):
+            counts = evaluate_stream(
+                read_foods(input_file, input_format, args.column),
+                output,
+                concurrency=args.concurrency,
+                checkpoint=checkpoint,
+                save=(
+                    None
+                    if checkpoint_path is None
+                    else lambda progress: save_checkpoint(checkpoint_path, progress)
+                ),
+                checkpoint_every=args.checkpoint_every,
+                report=lambda message: print(message, file=sys.stderr),
+            )
+    finally:
+        if input_file is not sys.stdin:
+            input_file.close()
+        if output is not sys.stdout.buffer:
+            output.close()
+    if checkpoint_path is not None and not counts["failed"]:
+        os.remove(checkpoint_path)
+
+    elapsed = time.perf_counter() - started
+    evaluated = counts["ok"] + counts["unmatched"]
+    print(
+        f"Evaluated {evaluated} food(s) in {elapsed:.1f}s ({evaluated / elapsed if elapsed else 0:.1f}/s): "
+        f"{counts['ok']} ok, {counts['unmatched']} unmatched, {counts['fetched']} fetched from Nutritionix, "
+        f"{counts['skipped']} skipped from an earlier run, {counts['failed']} failed",
+        file=sys.stderr,
+    )
+    return 1 if counts["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
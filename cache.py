@@ -0,0 +1,122 @@
+"""In-process memory tier that sits in front of the SQLite cache in searches.db."""
+import os
+import time
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Union
+
+
+class MemoryCache:
+    """Bounded LRU cache with a per-entry time to live, safe to share between request threads.
+
+    Args:
+    - max_size(int) - number of entries kept before the least recently used one is evicted
+    - ttl_seconds(float) - seconds an entry stays valid after it was stored
+    - clock(callable) - monotonic time source, overridable in tests
+    """
+
+    def __init__(
+        self,
+        max_size: int = 512,
+        ttl_seconds: float = 3600.0,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.stale_hits = 0
+        self.evictions = 0
+        self._entries: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Union[Any, None]:
+        """Returns the cached value for key, or None if it is missing or expired. Expired entries are kept
+        until they are evicted or replaced so get_stale() can still serve them."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= self.clock():
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def get_stale(self, key: Hashable) -> Union[Any, None]:
+        """Returns the value for key even if it has expired, for use when the source of truth is unavailable."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self.stale_hits += 1
+            return entry[1]
+
+    def set(self, key: Hashable, value: Any):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (self.clock() + self.ttl_seconds, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key: Hashable):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = self.stale_hits = self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "ttl_seconds": self.ttl_seconds,
+            "hits": self.hits,
+            "misses": self.misses,
+            "stale_hits": self.stale_hits,
+            "evictions": self.evictions,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
+
+
+# materialized verdicts (see nutrients.NutrientVerdict.materialized_verdict) keyed by db.normalize_query(search_query)
+nutrient_verdict_cache = MemoryCache(
+    max_size=int(os.environ.get("MEMORY_CACHE_SIZE", "512")),
+    ttl_seconds=float(os.environ.get("MEMORY_CACHE_TTL_SECONDS", "3600")),
+)
+
+# rendered search pages and serialized API results keyed by (kind, ETag), see main.get_result_etag()
+rendered_result_cache = MemoryCache(
+    max_size=int(os.environ.get("RENDERED_CACHE_SIZE", "256")),
+    ttl_seconds=float(os.environ.get("MEMORY_CACHE_TTL_SECONDS", "3600")),
+)
+
+# queries Nutritionix had no usable food for, keyed by db.normalize_query(search_query); kept briefly, since a food
+# can be added upstream and every entry is also shared with other workers through UnmatchedQueries in searches.db
+NEGATIVE_CACHE_TTL_SECONDS = float(os.environ.get("NEGATIVE_CACHE_TTL_SECONDS", "600"))
+unmatched_query_cache = MemoryCache(
+    max_size=int(os.environ.get("NEGATIVE_CACHE_SIZE", "1024")),
+    ttl_seconds=NEGATIVE_CACHE_TTL_SECONDS,
+)
+
+# how long a payload fetched from Nutritionix is served before a hit also queues a background refresh (see refresh.py);
+# 0 never refreshes
+FRESHNESS_TTL_SECONDS = float(
+    os.environ.get("CACHE_FRESHNESS_TTL_SECONDS", str(30 * 24 * 60 * 60))
+)
+
+# queries whose cached payload was checked against FRESHNESS_TTL_SECONDS, keyed by db.normalize_query(search_query); a
+# memory cache hit only reads searches.db to check again once its entry has expired
+freshness_checks = MemoryCache(
+    max_size=int(os.environ.get("MEMORY_CACHE_SIZE", "512")),
+    ttl_seconds=float(os.environ.get("CACHE_FRESHNESS_CHECK_INTERVAL_SECONDS", "600")),
+)
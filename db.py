@@ -1,16 +1,1330 @@
+"""Schema, migrations and shared storage for the search cache stored in searches.db.
+
+Run `python db.py migrate` to bring an existing database up to the current schema version.
+"""
+import os
+import sys
+import json
+import math
+import time
+import zlib
+import queue
+import atexit
 import sqlite3
+import logging
+import argparse
+import threading
+from typing import Callable, Union
+
+from nutrients import UNUSABLE_RESPONSE_ERRORS, trim_response
+from queries import parse_query
+
+DATABASE_PATH = os.environ.get("SEARCHES_DB", "searches.db")
+SQLITE_MMAP_SIZE = int(os.environ.get("SQLITE_MMAP_SIZE", str(64 * 1024 * 1024)))
+
+# bumped whenever a migration is appended to MIGRATIONS; stored in PRAGMA user_version
+SCHEMA_VERSION = 10
+
+CACHE_COLUMNS = (
+    "name",
+    "serving_unit",
+    "serving_size_grams",
+    "item",
+    "measure",
+    "quantity",
+    "fructose_n",
+    "glucose_n",
+    "sucrose",
+    "raw",
+)
+
+# Threshold independent fields parsed from raw, so a cache hit needs no JSON parsing. verdict_version is NULL until
+# a row is materialized (on write or by `python db.py backfill`) and is bumped when the parsing logic changes.
+VERDICT_VERSION = 1
+VERDICT_COLUMNS = (
+    "total_sugar",
+    "fructose_per_gram",
+    "has_detailed_nutrients",
+    "verdict_version",
+)
+
+
+def build_upsert_statement(
+    cache_columns: tuple, verdict_columns: tuple, query_columns: tuple = ()
+) -> str:
+    """One row per normalized query. Payload columns are only replaced when the incoming row carries a raw
+    API response (or the cached row has none), so recording a cache hit never blanks out the stored payload.
+    Verdict columns are replaced whenever the incoming row was materialized. Query columns are derived from
+    the query itself and only written on insert. Migrations build their own statement from the columns that
+    exist at their schema version."""
+    assignments = [
+        f"{column} = CASE WHEN excluded.raw != '' OR SearchCache.raw = '' "
+        f"THEN excluded.{column} ELSE SearchCache.{column} END"
+        for column in cache_columns
+    ] + [
+        f"{column} = CASE WHEN excluded.verdict_version IS NOT NULL "
+        f"THEN excluded.{column} ELSE SearchCache.{column} END"
+        for column in verdict_columns
+    ]
+    columns = query_columns + cache_columns + verdict_columns
+    return f"""
+    INSERT INTO SearchCache (query, {", ".join(columns)}, hit_count, first_seen, last_seen)
+    VALUES (?, {", ".join("?" for _ in columns)}, ?,
+            COALESCE(?, CURRENT_TIMESTAMP), COALESCE(?, CURRENT_TIMESTAMP))
+    ON CONFLICT (query) DO UPDATE SET
+        {", ".join(assignments)},
+        hit_count = SearchCache.hit_count + excluded.hit_count,
+        first_seen = MIN(SearchCache.first_seen, excluded.first_seen),
+        last_seen = MAX(SearchCache.last_seen, excluded.last_seen)
+    """
+
+
+# the query reduced by queries.parse_query(), shared by searches for different amounts of the same food
+QUERY_COLUMNS = ("food",)
+
+# when raw was last fetched from Nutritionix (Unix time), replaced together with it; NULL for payloads from before v9
+FRESHNESS_COLUMNS = ("refreshed_at",)
+
+UPSERT_SEARCH = build_upsert_statement(
+    CACHE_COLUMNS + FRESHNESS_COLUMNS, VERDICT_COLUMNS, QUERY_COLUMNS
+)
+
+
+def normalize_query(search_query: Union[str, None]) -> str:
+    """Returns the cache key for a search: lowercased, with surrounding and repeated whitespace removed."""
+    return " ".join((search_query or "").lower().split())
+
+
+def clean_raw_payload(raw: Union[str, None]) -> str:
+    """Stores missing and empty ("{}") API responses as '' so they never shadow a usable payload."""
+    if raw is None or raw.strip() in ("", "{}"):
+        return ""
+    return raw
+
+
+def encode_payload(raw: Union[str, None]) -> Union[bytes, str]:
+    """Compact storage for a raw API response: trimmed by nutrients.trim_response() to the fields the model reads,
+    then zlib compressed. Missing, empty and unparsable responses are stored as ''."""
+    raw = clean_raw_payload(raw)
+    if not raw:
+        return ""
+    try:
+        response = json.loads(raw)
+    except ValueError:
+        return ""
+    return zlib.compress(
+        json.dumps(trim_response(response), separators=(",", ":")).encode("utf-8"), 9
+    )
+
+
+def decode_payload(payload: Union[bytes, str, None]) -> str:
+    """The response text stored by encode_payload(). Rows written before payloads were compressed hold the
+    response text itself. Raises ValueError for a payload that does not decompress."""
+    if isinstance(payload, bytes):
+        try:
+            return zlib.decompress(payload).decode("utf-8")
+        except zlib.error as error:
+            raise ValueError(f"Corrupt payload: {error}") from error
+    return payload or ""
+
+
+def connect(database_path: str = DATABASE_PATH) -> sqlite3.Connection:
+    """Opens the cache database, migrating it to the current schema version if needed."""
+    connection = sqlite3.connect(database_path)
+    migrate(connection)
+    return connection
+
+
+def get_schema_version(connection: sqlite3.Connection) -> int:
+    return connection.execute("PRAGMA user_version").fetchone()[0]
+
+
+def table_exists(connection: sqlite3.Connection, table_name: str) -> bool:
+    cursor = connection.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table_name,)
+    )
+    return cursor.fetchone() is not None
+
+
+def migrate(connection: sqlite3.Connection) -> int:
+    """Applies every migration newer than the database's user_version. Returns the number applied.
+    Each step re-reads the version under a write lock, so workers starting together never migrate twice."""
+    applied = 0
+    while get_schema_version(connection) < SCHEMA_VERSION:
+        with connection:
+            connection.execute("BEGIN IMMEDIATE")
+            version = get_schema_version(connection) + 1
+            if version > SCHEMA_VERSION:
+                break
+            MIGRATIONS[version](connection)
+            connection.execute(f"PRAGMA user_version = {version}")
+        logging.debug(f"Migrated cache schema to version {version}")
+        applied += 1
+    return applied
+
+
+def migrate_to_v1(connection: sqlite3.Connection):
+    """Creates the deduplicated SearchCache table and collapses the legacy append-only Searches history
+    into it. Every legacy row is counted in hit_count; the newest row with a raw payload wins."""
+    connection.execute(
+        """CREATE TABLE IF NOT EXISTS SearchCache
+              (id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+              query TEXT NOT NULL,
+              name TEXT,
+              serving_unit TEXT,
+              serving_size_grams FLOAT,
+              item TEXT,
+              measure TEXT,
+              quantity FLOAT,
+              fructose_n FLOAT,
+              glucose_n FLOAT,
+              sucrose FLOAT,
+              raw TEXT NOT NULL DEFAULT '',
+              hit_count INTEGER NOT NULL DEFAULT 1,
+              first_seen DATETIME DEFAULT CURRENT_TIMESTAMP,
+              last_seen DATETIME DEFAULT CURRENT_TIMESTAMP)"""
+    )
+    connection.execute(
+        "CREATE UNIQUE INDEX IF NOT EXISTS SearchCache_query ON SearchCache (query)"
+    )
+    if not table_exists(connection, "Searches"):
+        return
+    legacy_rows = connection.execute(
+        """SELECT query, name, serving_unit, serving_size_grams, item, measure, quantity,
+                  fructose_n, glucose_n, sucrose, raw, Timestamp
+           FROM Searches ORDER BY id"""
+    )
+    legacy_upsert = build_upsert_statement(CACHE_COLUMNS, ())
+    for row in legacy_rows.fetchall():
+        query, *payload, raw, timestamp = row
+        payload.append(clean_raw_payload(raw))
+        # the earliest rows predate the query column; fall back to the parsed food name
+        query_key = normalize_query(query) or normalize_query(payload[0])
+        connection.execute(
+            legacy_upsert, (query_key, *payload, 1, timestamp, timestamp)
+        )
+
+
+def migrate_to_v2(connection: sqlite3.Connection):
+    """Adds the materialized verdict columns. Existing rows stay unmaterialized until `python db.py backfill` runs."""
+    connection.execute("ALTER TABLE SearchCache ADD COLUMN total_sugar FLOAT")
+    connection.execute("ALTER TABLE SearchCache ADD COLUMN fructose_per_gram FLOAT")
+    connection.execute(
+        "ALTER TABLE SearchCache ADD COLUMN has_detailed_nutrients INTEGER"
+    )
+    connection.execute("ALTER TABLE SearchCache ADD COLUMN verdict_version INTEGER")
+
+
+def migrate_to_v3(connection: sqlite3.Connection):
+    """Adds the table gunicorn workers use to see each other's in-flight Nutritionix fetches."""
+    connection.execute(
+        """CREATE TABLE IF NOT EXISTS InflightFetches
+              (query TEXT PRIMARY KEY NOT NULL,
+              owner TEXT NOT NULL,
+              expires_at FLOAT NOT NULL,
+              raw TEXT)"""
+    )
+
+
+def migrate_to_v4(connection: sqlite3.Connection):
+    """Adds the local food database filled by fooddata.py. Nutrients are grams per 100 g of food (NULL when the
+    dataset does not report them) and the portion is the food's first listed household measure."""
+    connection.execute(
+        """CREATE TABLE IF NOT EXISTS LocalFoods
+              (name TEXT PRIMARY KEY NOT NULL,
+              fdc_id INTEGER,
+              description TEXT NOT NULL,
+              fructose FLOAT,
+              glucose FLOAT,
+              sucrose FLOAT,
+              total_sugar FLOAT,
+              portion_amount FLOAT NOT NULL,
+              portion_unit TEXT NOT NULL,
+              portion_grams FLOAT NOT NULL)"""
+    )
+
+
+def migrate_to_v5(connection: sqlite3.Connection):
+    """Adds the parsed food name of every cached query, an index on it, and a trigram full text index over it
+    for near miss lookups. SQLite builds without FTS5 skip the full text index and only match exact food names."""
+    connection.execute("ALTER TABLE SearchCache ADD COLUMN food TEXT")
+    rows = connection.execute("SELECT id, query FROM SearchCache").fetchall()
+    connection.executemany(
+        "UPDATE SearchCache SET food = ? WHERE id = ?",
+        [(parse_query(query).food, row_id) for row_id, query in rows],
+    )
+    connection.execute(
+        "CREATE INDEX IF NOT EXISTS SearchCache_food ON SearchCache (food)"
+    )
+    try:
+        connection.execute(
+            """CREATE VIRTUAL TABLE SearchCacheFoods USING fts5
+                  (food, content='SearchCache', content_rowid='id', tokenize='trigram')"""
+        )
+    except sqlite3.OperationalError as error:
+        logging.warning(f"No trigram index for cached foods: {error}")
+        return
+    # one statement per execute(): executescript() would commit the migration's transaction early
+    for trigger in (
+        """CREATE TRIGGER SearchCache_insert_food AFTER INSERT ON SearchCache BEGIN
+               INSERT INTO SearchCacheFoods (rowid, food) VALUES (new.id, new.food);
+           END""",
+        """CREATE TRIGGER SearchCache_delete_food AFTER DELETE ON SearchCache BEGIN
+               INSERT INTO SearchCacheFoods (SearchCacheFoods, rowid, food) VALUES ('delete', old.id, old.food);
+           END""",
+        """CREATE TRIGGER SearchCache_update_food AFTER UPDATE OF food ON SearchCache BEGIN
+               INSERT INTO SearchCacheFoods (SearchCacheFoods, rowid, food) VALUES ('delete', old.id, old.food);
+               INSERT INTO SearchCacheFoods (rowid, food) VALUES (new.id, new.food);
+           END""",
+    ):
+        connection.execute(trigger)
+    connection.execute(
+        "INSERT INTO SearchCacheFoods (SearchCacheFoods) VALUES ('rebuild')"
+    )
+
+
+def safe_food_values(row: str) -> str:
+    """SafeFoods column values for a SearchCache row referenced as row (new, old or SearchCache)."""
+    return (
+        f"{row}.food, {row}.query, {row}.name, {row}.serving_unit, {row}.quantity, "
+        f"{row}.serving_size_grams, {row}.fructose_per_gram, "
+        f"{row}.fructose_per_gram * {row}.serving_size_grams / {row}.quantity, {row}.verdict_version"
+    )
+
+
+def safe_food_condition(row: str) -> str:
+    """Whether a SearchCache row belongs in SafeFoods: materialized, with a food name and every figure needed."""
+    return (
+        f"{row}.verdict_version IS NOT NULL AND {row}.fructose_per_gram IS NOT NULL AND {row}.food != '' "
+        f"AND {row}.serving_size_grams IS NOT NULL AND {row}.quantity > 0"
+    )
+
+
+def create_safe_food_triggers(connection: sqlite3.Connection):
+    """Creates the triggers that keep SafeFoods in step with SearchCache. When several searches share a food
+    name the latest verdict written wins; deleting it promotes the most searched remaining one."""
+    # one statement per execute(): executescript() would commit the migration's transaction early
+    for trigger in (
+        f"""CREATE TRIGGER SearchCache_insert_safe_food AFTER INSERT ON SearchCache
+               WHEN {safe_food_condition("new")} BEGIN
+               INSERT OR REPLACE INTO SafeFoods VALUES ({safe_food_values("new")});
+           END""",
+        f"""CREATE TRIGGER SearchCache_update_safe_food AFTER UPDATE ON SearchCache
+               WHEN old.verdict_version IS NOT new.verdict_version
+                   OR old.fructose_per_gram IS NOT new.fructose_per_gram
+                   OR old.serving_size_grams IS NOT new.serving_size_grams
+                   OR old.quantity IS NOT new.quantity OR old.food IS NOT new.food BEGIN
+               DELETE FROM SafeFoods WHERE query = old.query;
+               INSERT OR REPLACE INTO SafeFoods
+                   SELECT {safe_food_values("new")} WHERE {safe_food_condition("new")};
+           END""",
+        f"""CREATE TRIGGER SearchCache_delete_safe_food AFTER DELETE ON SearchCache BEGIN
+               DELETE FROM SafeFoods WHERE query = old.query;
+               INSERT OR IGNORE INTO SafeFoods
+                   SELECT {safe_food_values("SearchCache")} FROM SearchCache
+                   WHERE SearchCache.food = old.food AND {safe_food_condition("SearchCache")}
+                   ORDER BY SearchCache.hit_count DESC LIMIT 1;
+           END""",
+    ):
+        connection.execute(trigger)
+
+
+def migrate_to_v6(connection: sqlite3.Connection):
+    """Adds SafeFoods: one row per cached food name with a materialized verdict, indexed by fructose per gram
+    and per single serving so foods can be listed lowest fructose first without reading SearchCache. Triggers
+    keep it in step with SearchCache (see create_safe_food_triggers())."""
+    connection.execute(
+        """CREATE TABLE SafeFoods (food TEXT PRIMARY KEY, query TEXT NOT NULL, name TEXT, serving_unit TEXT,
+           quantity FLOAT, serving_size_grams FLOAT, fructose_per_gram FLOAT NOT NULL,
+           fructose_per_serving FLOAT NOT NULL, verdict_version INTEGER NOT NULL)"""
+    )
+    connection.execute(
+        """CREATE INDEX SafeFoods_fructose_per_gram
+           ON SafeFoods (verdict_version, fructose_per_gram, food)"""
+    )
+    connection.execute(
+        """CREATE INDEX SafeFoods_fructose_per_serving
+           ON SafeFoods (verdict_version, fructose_per_serving, food)"""
+    )
+    create_safe_food_triggers(connection)
+    connection.execute(
+        f"""INSERT OR REPLACE INTO SafeFoods
+            SELECT {safe_food_values("SearchCache")} FROM SearchCache
+            WHERE {safe_food_condition("SearchCache")} ORDER BY SearchCache.hit_count"""
+    )
+
+
+def migrate_to_v7(connection: sqlite3.Connection):
+    """Adds UnmatchedQueries, the shared negative cache of queries Nutritionix had no usable food for, and
+    QuarantinedSearches, where cached rows whose payload or verdict cannot be used are moved for inspection."""
+    connection.execute(
+        """CREATE TABLE UnmatchedQueries (query TEXT PRIMARY KEY NOT NULL, reason TEXT NOT NULL,
+           expires_at FLOAT NOT NULL)"""
+    )
+    connection.execute(
+        """CREATE TABLE QuarantinedSearches (id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+           query TEXT NOT NULL, raw TEXT, hit_count INTEGER, reason TEXT NOT NULL,
+           quarantined_at DATETIME DEFAULT CURRENT_TIMESTAMP)"""
+    )
+
+
+def migrate_to_v8(connection: sqlite3.Connection):
+    """Adds UpstreamQuota, the token bucket every worker draws from before calling Nutritionix, and UpstreamUsage,
+    the calls made per UTC day and priority lane, so quota accounting survives restarts."""
+    connection.execute(
+        """CREATE TABLE UpstreamQuota (name TEXT PRIMARY KEY NOT NULL, tokens FLOAT NOT NULL,
+           updated_at FLOAT NOT NULL)"""
+    )
+    connection.execute(
+        """CREATE TABLE UpstreamUsage (day TEXT NOT NULL, lane TEXT NOT NULL, calls INTEGER NOT NULL DEFAULT 0,
+           PRIMARY KEY (day, lane))"""
+    )
+
+
+def migrate_to_v9(connection: sqlite3.Connection):
+    """Adds refreshed_at, when each cached payload was last fetched from Nutritionix. Existing payloads are left at
+    NULL, so each is refreshed in the background the next time it is served (see needs_refresh())."""
+    connection.execute("ALTER TABLE SearchCache ADD COLUMN refreshed_at FLOAT")
+
+
+def get_primary_food(description: str) -> str:
+    """The food a FoodData Central description is about: its first comma separated part reduced by
+    queries.parse_query(), e.g. "apple" for "Apples, raw, with skin"."""
+    return parse_query(description.split(",")[0]).food
+
+
+def migrate_to_v10(connection: sqlite3.Connection):
+    """Adds the primary food name of every imported food and an index on it, so an ordinary search such as "apple"
+    finds "Apples, raw, with skin" (see lookup_local_food())."""
+    connection.execute("ALTER TABLE LocalFoods ADD COLUMN food TEXT")
+    rows = connection.execute("SELECT name, description FROM LocalFoods").fetchall()
+    connection.executemany(
+        "UPDATE LocalFoods SET food = ? WHERE name = ?",
+        [(get_primary_food(description), name) for name, description in rows],
+    )
+    connection.execute(
+        "CREATE INDEX IF NOT EXISTS LocalFoods_food ON LocalFoods (food)"
+    )
+
+
+MIGRATIONS = {
+    1: migrate_to_v1,
+    2: migrate_to_v2,
+    3: migrate_to_v3,
+    4: migrate_to_v4,
+    5: migrate_to_v5,
+    6: migrate_to_v6,
+    7: migrate_to_v7,
+    8: migrate_to_v8,
+    9: migrate_to_v9,
+    10: migrate_to_v10,
+}
+
+LOCAL_FOOD_COLUMNS = (
+    "name",
+    "fdc_id",
+    "description",
+    "fructose",
+    "glucose",
+    "sucrose",
+    "total_sugar",
+    "portion_amount",
+    "portion_unit",
+    "portion_grams",
+    "food",
+)
+
+# whether an imported food has any sugar figure; NULL nutrients are left out of its response and would count as 0 g
+LOCAL_FOOD_HAS_SUGARS = (
+    "(total_sugar IS NOT NULL OR fructose IS NOT NULL OR sucrose IS NOT NULL)"
+)
+
+UPSERT_LOCAL_FOOD = f"""INSERT INTO LocalFoods ({", ".join(LOCAL_FOOD_COLUMNS)})
+    VALUES ({", ".join("?" for _ in LOCAL_FOOD_COLUMNS)})
+    ON CONFLICT (name) DO UPDATE SET {", ".join(f"{column} = excluded.{column}" for column in LOCAL_FOOD_COLUMNS[1:])}"""
+
+
+def record_search(
+    connection: sqlite3.Connection,
+    search_query: str,
+    parsed_nutrient_response: dict,
+    raw: str = "",
+    verdict: Union[dict, None] = None,
+):
+    """Upserts a search into the cache, bumping its hit count and last seen timestamp. The verdict, from
+    nutrients.NutrientVerdict.materialized_verdict, is stored alongside the raw payload when given."""
+    connection.execute(
+        UPSERT_SEARCH,
+        search_record_parameters(search_query, parsed_nutrient_response, raw, verdict),
+    )
+    connection.commit()
+
+
+def search_record_parameters(
+    search_query: str,
+    parsed_nutrient_response: dict,
+    raw: str = "",
+    verdict: Union[dict, None] = None,
+) -> tuple:
+    """Bound parameters for UPSERT_SEARCH."""
+    return (
+        normalize_query(search_query),
+        parse_query(search_query).food,
+        parsed_nutrient_response["name"],
+        parsed_nutrient_response["serving_unit"],
+        parsed_nutrient_response["serving_size_grams"],
+        parsed_nutrient_response["item"],
+        parsed_nutrient_response["measure"],
+        parsed_nutrient_response["quantity"],
+        parsed_nutrient_response["fructose"],
+        parsed_nutrient_response["glucose"],
+        parsed_nutrient_response["sucrose"],
+        encode_payload(raw),
+        time.time() if raw else None,
+        *verdict_column_values(verdict),
+        1,
+        None,
+        None,
+    )
+
+
+def update_cached_response(
+    connection: sqlite3.Connection,
+    search_query: str,
+    parsed_nutrient_response: dict,
+    raw: str,
+    verdict: dict,
+):
+    """Stores a freshly fetched payload and its verdict on an existing row without counting it as a search, so
+    prefetching does not change hit counts or recency."""
+    columns = CACHE_COLUMNS + FRESHNESS_COLUMNS + VERDICT_COLUMNS
+    parameters = search_record_parameters(
+        search_query, parsed_nutrient_response, raw, verdict
+    )
+    # search_record_parameters() starts with the QUERY_COLUMNS keys and ends with the hit count and timestamps
+    column_values = parameters[
+        1 + len(QUERY_COLUMNS) : 1 + len(QUERY_COLUMNS) + len(columns)
+    ]
+    connection.execute(
+        f"UPDATE SearchCache SET {', '.join(f'{column} = ?' for column in columns)} WHERE query = ?",
+        (*column_values, normalize_query(search_query)),
+    )
+    connection.commit()
+
+
+def lookup_raw_response(
+    connection: sqlite3.Connection, search_query: str
+) -> Union[str, None]:
+    """Returns the lowercased raw API response cached for a query, or None if there is no usable row."""
+    cursor = connection.execute(
+        "SELECT raw FROM SearchCache WHERE query = ? AND raw != ''",
+        (normalize_query(search_query),),
+    )
+    row = cursor.fetchone()
+    return None if row is None else decode_payload(row[0]).lower()
+
+
+def needs_refresh(
+    connection: sqlite3.Connection,
+    search_query: str,
+    ttl_seconds: float,
+    now: Union[float, None] = None,
+) -> bool:
+    """Whether the Nutritionix payload cached for a query was fetched more than ttl_seconds ago, or before fetch
+    times were recorded. Rows without a payload, such as local food results, have nothing to refresh."""
+    row = connection.execute(
+        """SELECT 1 FROM SearchCache
+           WHERE query = ? AND raw != '' AND (refreshed_at IS NULL OR refreshed_at < ?)""",
+        (
+            normalize_query(search_query),
+            (time.time() if now is None else now) - ttl_seconds,
+        ),
+    ).fetchone()
+    return row is not None
+
+
+def verdict_column_values(verdict: Union[dict, None]) -> tuple:
+    if verdict is None:
+        return tuple(None for _ in VERDICT_COLUMNS)
+    return (
+        verdict["total_sugar"],
+        verdict["fructose_per_gram"],
+        int(verdict["has_detailed_nutrients"]),
+        VERDICT_VERSION,
+    )
+
+
+def lookup_local_food(
+    connection: sqlite3.Connection, search_query: str
+) -> Union[dict, None]:
+    """Returns the imported food whose normalized description equals the normalized query or, for a query without an
+    amount, the food whose primary food name (see get_primary_food()) is the query's food, or None. Of several foods
+    with that name a raw one wins, then the shortest description: "apple" finds "Apples, raw, with skin" rather than
+    "Apples, canned, sweetened, sliced, drained, heated". A query with an amount or a size is left to the other
+    tiers, since the local food only describes its first portion, and so is a food without any sugar figures, which
+    would otherwise evaluate as sugar free."""
+    cursor = connection.execute(
+        f"SELECT {', '.join(LOCAL_FOOD_COLUMNS)}, {LOCAL_FOOD_HAS_SUGARS} FROM LocalFoods WHERE name = ?",
+        (normalize_query(search_query),),
+    )
+    row = cursor.fetchone()
+    if row is not None:
+        if not row[-1]:
+            return None
+        row = row[:-1]
+    parsed_query = parse_query(search_query)
+    if (
+        row is None
+        and parsed_query.food
+        and parsed_query.quantity is None
+        and parsed_query.unit is None
+        and parsed_query.size is None
+    ):
+        cursor = connection.execute(
+            f"""SELECT {', '.join(LOCAL_FOOD_COLUMNS)} FROM LocalFoods
+                WHERE food = ? AND {LOCAL_FOOD_HAS_SUGARS}
+                ORDER BY instr(name, ', raw') = 0, length(name), fdc_id LIMIT 1""",
+            (parsed_query.food,),
+        )
+        row = cursor.fetchone()
+    if row is None:
+        return None
+    return dict(zip(LOCAL_FOOD_COLUMNS, row))
+
+
+# materialized verdict keys and the SearchCache columns they are stored in
+MATERIALIZED_VERDICT_COLUMNS = {
+    "name": "name",
+    "serving_unit": "serving_unit",
+    "item": "item",
+    "measure": "measure",
+    "quantity": "quantity",
+    "serving_size_grams": "serving_size_grams",
+    "fructose": "fructose_n",
+    "glucose": "glucose_n",
+    "sucrose": "sucrose",
+    "total_sugar": "total_sugar",
+    "fructose_per_gram": "fructose_per_gram",
+    "has_detailed_nutrients": "has_detailed_nutrients",
+}
+
+
+def lookup_verdict(
+    connection: sqlite3.Connection, search_query: str
+) -> Union[dict, None]:
+    """Returns the materialized verdict cached for a query, or None if the row is missing or not yet materialized."""
+    cursor = connection.execute(
+        f"""SELECT {", ".join(MATERIALIZED_VERDICT_COLUMNS.values())}
+            FROM SearchCache WHERE query = ? AND verdict_version = ?""",
+        (normalize_query(search_query), VERDICT_VERSION),
+    )
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    return dict(zip(MATERIALIZED_VERDICT_COLUMNS, row))
+
+
+def lookup_food_matches(connection: sqlite3.Connection, food: str) -> list[dict]:
+    """Returns the materialized verdicts of every cached query for a parsed food name (see queries.parse_query),
+    each with the cached "query" and its "hit_count", most searched first."""
+    if not food:
+        return []
+    rows = connection.execute(
+        f"""SELECT query, hit_count, {", ".join(MATERIALIZED_VERDICT_COLUMNS.values())}
+            FROM SearchCache WHERE food = ? AND verdict_version = ?
+            ORDER BY hit_count DESC, id""",
+        (food, VERDICT_VERSION),
+    ).fetchall()
+    return [
+        dict(zip(("query", "hit_count", *MATERIALIZED_VERDICT_COLUMNS), row))
+        for row in rows
+    ]
+
+
+def search_similar_foods(
+    connection: sqlite3.Connection, food: str, limit: int = 20
+) -> list[str]:
+    """Returns distinct cached food names sharing at least one trigram with food, best ranked first. Returns an
+    empty list when the trigram index is unavailable or food is shorter than three characters."""
+    trigrams = {food[start : start + 3] for start in range(len(food) - 2)}
+    if not trigrams or not table_exists(connection, "SearchCacheFoods"):
+        return []
+    match = " OR ".join('"' + trigram.replace('"', '""') + '"' for trigram in trigrams)
+    rows = connection.execute(
+        """SELECT food FROM SearchCacheFoods WHERE SearchCacheFoods MATCH ?
+           GROUP BY food ORDER BY MIN(rank) LIMIT ?""",
+        (match, limit),
+    ).fetchall()
+    return [food_name for food_name, in rows if food_name]
+
+
+SAFE_FOOD_COLUMNS = (
+    "food",
+    "query",
+    "name",
+    "serving_unit",
+    "quantity",
+    "serving_size_grams",
+    "fructose_per_gram",
+    "fructose_per_serving",
+)
+# SafeFoods columns that can be listed in order, each with its own index
+SAFE_FOOD_ORDERS = ("fructose_per_serving", "fructose_per_gram")
+
+
+def list_safe_foods(
+    connection: sqlite3.Connection,
+    order_by: str = "fructose_per_serving",
+    max_fructose: Union[float, None] = None,
+    limit: int = 20,
+    offset: int = 0,
+) -> list[dict]:
+    """Returns one page of cached foods with a current verdict, lowest fructose first, one per parsed food name.
+
+    Args:
+    - order_by(String) - one of SAFE_FOOD_ORDERS
+    - max_fructose(float) - only foods with at most this many grams of fructose in the order_by column
+    """
+    if order_by not in SAFE_FOOD_ORDERS:
+        raise ValueError(f"order_by must be one of {', '.join(SAFE_FOOD_ORDERS)}")
+    rows = connection.execute(
+        f"""SELECT {", ".join(SAFE_FOOD_COLUMNS)} FROM SafeFoods
+            WHERE verdict_version = ? AND {order_by} <= ?
+            ORDER BY {order_by}, food LIMIT ? OFFSET ?""",
+        (
+            VERDICT_VERSION,
+            float("inf") if max_fructose is None else max_fructose,
+            limit,
+            offset,
+        ),
+    ).fetchall()
+    return [dict(zip(SAFE_FOOD_COLUMNS, row)) for row in rows]
+
+
+def quarantine_search(
+    connection: sqlite3.Connection, search_query: str, reason: str
+) -> bool:
+    """Moves the cached row for a query to QuarantinedSearches, so it is no longer served and the next search
+    fetches a fresh answer. Returns whether a row was moved."""
+    query = normalize_query(search_query)
+    with connection:
+        connection.execute(
+            """INSERT INTO QuarantinedSearches (query, raw, hit_count, reason)
+               SELECT query, raw, hit_count, ? FROM SearchCache WHERE query = ?""",
+            (reason, query),
+        )
+        cursor = connection.execute("DELETE FROM SearchCache WHERE query = ?", (query,))
+    return cursor.rowcount > 0
+
+
+def record_unmatched_query(
+    connection: sqlite3.Connection, search_query: str, reason: str, ttl_seconds: float
+):
+    """Remembers for ttl_seconds that Nutritionix had no usable food for a query. Expired entries are dropped."""
+    now = time.time()
+    with connection:
+        connection.execute("DELETE FROM UnmatchedQueries WHERE expires_at < ?", (now,))
+        connection.execute(
+            """INSERT INTO UnmatchedQueries (query, reason, expires_at) VALUES (?, ?, ?)
+               ON CONFLICT (query) DO UPDATE SET reason = excluded.reason, expires_at = excluded.expires_at""",
+            (normalize_query(search_query), reason, now + ttl_seconds),
+        )
+
+
+def lookup_unmatched_query(
+    connection: sqlite3.Connection, search_query: str
+) -> Union[str, None]:
+    """Returns why a query is in the negative cache, or None if it is not or its entry has expired."""
+    row = connection.execute(
+        "SELECT reason FROM UnmatchedQueries WHERE query = ? AND expires_at >= ?",
+        (normalize_query(search_query), time.time()),
+    ).fetchone()
+    return None if row is None else row[0]
+
+
+def get_quota_day(now: float) -> str:
+    return time.strftime("%Y-%m-%d", time.gmtime(now))
+
+
+def take_upstream_token(
+    connection: sqlite3.Connection,
+    lane: str,
+    capacity: float,
+    refill_per_second: float,
+    reserved_tokens: float = 0,
+    daily_limit: int = 0,
+    reserved_daily_calls: int = 0,
+    now: Union[float, None] = None,
+) -> float:
+    """Takes one token from the shared Nutritionix bucket and counts the call against today's quota for lane.
+
+    Args:
+    - capacity(float) - most tokens the bucket holds; a new bucket starts full
+    - refill_per_second(float) - tokens added per second
+    - reserved_tokens(float) / reserved_daily_calls(int) - tokens and daily calls this lane must leave for others
+    - daily_limit(int) - calls allowed per UTC day across every lane, 0 for no limit
+
+    Returns 0.0 when a token was taken, otherwise the seconds until one could be, or math.inf when today's quota
+    is spent. Runs in one write transaction, so every worker sharing the database draws from the same bucket.
+    """
+    now = time.time() if now is None else now
+    day = get_quota_day(now)
+    with connection:
+        # refill first: the write takes the database lock before anything is read
+        connection.execute(
+            """INSERT INTO UpstreamQuota (name, tokens, updated_at) VALUES ('nutritionix', ?, ?)
+               ON CONFLICT (name) DO UPDATE SET
+                   tokens = MIN(?, tokens + MAX(excluded.updated_at - updated_at, 0) * ?),
+                   updated_at = MAX(excluded.updated_at, updated_at)""",
+            (capacity, now, capacity, refill_per_second),
+        )
+        if daily_limit:
+            calls_today = connection.execute(
+                "SELECT COALESCE(SUM(calls), 0) FROM UpstreamUsage WHERE day = ?",
+                (day,),
+            ).fetchone()[0]
+            if calls_today >= daily_limit - reserved_daily_calls:
+                return math.inf
+        tokens = connection.execute(
+            "SELECT tokens FROM UpstreamQuota WHERE name = 'nutritionix'"
+        ).fetchone()[0]
+        if tokens < 1 + reserved_tokens:
+            return (1 + reserved_tokens - tokens) / refill_per_second
+        connection.execute(
+            "UPDATE UpstreamQuota SET tokens = tokens - 1 WHERE name = 'nutritionix'"
+        )
+        connection.execute(
+            """INSERT INTO UpstreamUsage (day, lane, calls) VALUES (?, ?, 1)
+               ON CONFLICT (day, lane) DO UPDATE SET calls = calls + 1""",
+            (day, lane),
+        )
+    return 0.0
+
+
+def count_upstream_calls(
+    connection: sqlite3.Connection, now: Union[float, None] = None
+) -> dict[str, int]:
+    """Returns the Nutritionix calls made so far today (UTC) per lane."""
+    day = get_quota_day(time.time() if now is None else now)
+    return dict(
+        connection.execute(
+            "SELECT lane, calls FROM UpstreamUsage WHERE day = ?", (day,)
+        ).fetchall()
+    )
+
+
+def backfill_verdicts(
+    connection: sqlite3.Connection,
+    materialize: Callable[[dict], dict],
+    batch_size: int = 100,
+    quarantine: bool = False,
+) -> tuple[int, int]:
+    """Materializes verdicts for rows that have a raw payload but no current verdict.
+
+    Args:
+    - materialize(callable) - builds a verdict from a parsed raw response, e.g. model.materialize_verdict_from_response
+    - batch_size(int) - rows written per transaction
+    - quarantine(bool) - move rows whose payload cannot be parsed to QuarantinedSearches
+
+    Returns the number of rows materialized and the number whose payload could not be parsed.
+    """
+    materialized = failed = 0
+    quarantined: list[tuple[str, str]] = []
+    rows = connection.execute(
+        """SELECT id, query, raw FROM SearchCache
+           WHERE raw != '' AND (verdict_version IS NULL OR verdict_version != ?)""",
+        (VERDICT_VERSION,),
+    ).fetchall()
+    for start in range(0, len(rows), batch_size):
+        with connection:
+            for row_id, query, raw in rows[start : start + batch_size]:
+                try:
+                    verdict = materialize(json.loads(decode_payload(raw).lower()))
+                except UNUSABLE_RESPONSE_ERRORS as error:
+                    logging.debug(f"Could not materialize verdict for {query}")
+                    failed += 1
+                    if quarantine:
+                        quarantined.append((query, f"Unusable payload: {error!r}"))
+                    continue
+                connection.execute(
+                    f"""UPDATE SearchCache SET name = ?, serving_unit = ?, item = ?, measure = ?, quantity = ?,
+                           serving_size_grams = ?, fructose_n = ?, glucose_n = ?, sucrose = ?,
+                           {" = ?, ".join(VERDICT_COLUMNS)} = ?
+                       WHERE id = ?""",
+                    (
+                        verdict["name"],
+                        verdict["serving_unit"],
+                        verdict["item"],
+                        verdict["measure"],
+                        verdict["quantity"],
+                        verdict["serving_size_grams"],
+                        verdict["fructose"],
+                        verdict["glucose"],
+                        verdict["sucrose"],
+                        *verdict_column_values(verdict),
+                        row_id,
+                    ),
+                )
+                materialized += 1
+    for query, reason in quarantined:
+        quarantine_search(connection, query, reason)
+    return materialized, failed
+
+
+def compact_payloads(
+    connection: sqlite3.Connection, batch_size: int = 100
+) -> tuple[int, int, int]:
+    """Rewrites payloads stored as response text before payloads were compressed with encode_payload().
+
+    Returns the number of rows rewritten and their payload size in bytes before and after.
+    """
+    rewritten = bytes_before = bytes_after = 0
+    rows = connection.execute(
+        "SELECT id, raw FROM SearchCache WHERE typeof(raw) = 'text' AND raw != ''"
+    ).fetchall()
+    for start in range(0, len(rows), batch_size):
+        with connection:
+            for row_id, raw in rows[start : start + batch_size]:
+                payload = encode_payload(raw)
+                connection.execute(
+                    "UPDATE SearchCache SET raw = ? WHERE id = ?", (payload, row_id)
+                )
+                rewritten += 1
+                bytes_before += len(raw.encode("utf-8"))
+                bytes_after += len(payload)
+    return rewritten, bytes_before, bytes_after
+
+
+def time_payload_reads(connection: sqlite3.Connection, passes: int = 5) -> float:
+    """Mean milliseconds to read and parse one cached payload, as a raw cache hit does."""
+    queries = [
+        query
+        for (query,) in connection.execute(
+            "SELECT query FROM SearchCache WHERE raw != ''"
+        )
+    ]
+    if not queries:
+        return 0.0
+    started = time.perf_counter()
+    for _ in range(passes):
+        for query in queries:
+            payload = lookup_raw_response(connection, query)
+            # a row quarantined or deleted since the query list was read has no payload left to parse
+            if payload is not None:
+                json.loads(payload)
+    return (time.perf_counter() - started) * 1000 / (passes * len(queries))
+
+
+def load_verdict_columns(connection: sqlite3.Connection) -> tuple[list, ...]:
+    """Returns the queries with a current materialized verdict and their nutrient columns, one list per column:
+    query, fructose, glucose, sucrose, total_sugar, quantity, serving_size_grams."""
+    rows = connection.execute(
+        """SELECT query, fructose_n, glucose_n, sucrose, total_sugar, quantity, serving_size_grams
+           FROM SearchCache WHERE verdict_version = ? AND quantity IS NOT NULL AND serving_size_grams IS NOT NULL""",
+        (VERDICT_VERSION,),
+    ).fetchall()
+    if not rows:
+        return tuple([] for _ in range(7))
+    return tuple(list(column) for column in zip(*rows))
+
+
+class CacheStore:
+    """Shared access to the cache database for the web app.
+
+    Each thread reuses one connection in WAL mode, so readers never wait on the writer and the sqlite3
+    statement cache keeps the lookup and upsert statements prepared. Writes are handed to a background
+    thread that commits everything queued so far in a single transaction, so a request never waits on a
+    commit. close() (registered with atexit for the shared instance) drains the queue before returning.
+    SQLite connections must not be used across fork(), so a parent process closes the store before forking
+    workers (see gunicorn.conf.py); each worker then opens its own connections on first use.
+
+    Args:
+    - database_path(String) - path of the SQLite file
+    - write_behind(bool) - queue writes for the background thread; when False they commit immediately
+    - max_batch_size(int) - most writes committed in one transaction
+    - retry_backoff_seconds(float) - wait before the second attempt at a batch that hit a locked database,
+      doubled for every further attempt
+    """
+
+    def __init__(
+        self,
+        database_path: str = DATABASE_PATH,
+        write_behind: bool = True,
+        max_batch_size: int = 256,
+        retry_backoff_seconds: float = 0.05,
+    ):
+        self.database_path = database_path
+        self.write_behind = write_behind
+        self.max_batch_size = max_batch_size
+        self.retry_backoff_seconds = retry_backoff_seconds
+        self._local = threading.local()
+        self._connections: list[sqlite3.Connection] = []
+        self._lock = threading.Lock()
+        self._migrated = False
+        self._writes: queue.Queue = queue.Queue()
+        self._writer: Union[threading.Thread, None] = None
+
+    def open_connection(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(
+            self.database_path,
+            timeout=5.0,
+            cached_statements=256,
+            check_same_thread=False,
+        )
+        connection.execute("PRAGMA journal_mode = WAL")
+        connection.execute("PRAGMA synchronous = NORMAL")
+        # reads go through a memory map of the file, so every worker process shares the same cached pages
+        connection.execute(f"PRAGMA mmap_size = {SQLITE_MMAP_SIZE}")
+        with self._lock:
+            if not self._migrated:
+                migrate(connection)
+                self._migrated = True
+            self._connections.append(connection)
+        return connection
+
+    def connection(self) -> sqlite3.Connection:
+        """Returns the calling thread's connection, opening it on first use."""
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = self._local.connection = self.open_connection()
+        return connection
+
+    def lookup_verdict(self, search_query: str) -> Union[dict, None]:
+        return lookup_verdict(self.connection(), search_query)
+
+    def lookup_raw_response(self, search_query: str) -> Union[str, None]:
+        return lookup_raw_response(self.connection(), search_query)
+
+    def lookup_local_food(self, search_query: str) -> Union[dict, None]:
+        return lookup_local_food(self.connection(), search_query)
+
+    def needs_refresh(self, search_query: str, ttl_seconds: float) -> bool:
+        return needs_refresh(self.connection(), search_query, ttl_seconds)
+
+    def update_cached_response(
+        self,
+        search_query: str,
+        parsed_nutrient_response: dict,
+        raw: str,
+        verdict: dict,
+    ):
+        update_cached_response(
+            self.connection(), search_query, parsed_nutrient_response, raw, verdict
+        )
+
+    def lookup_food_matches(self, food: str) -> list[dict]:
+        return lookup_food_matches(self.connection(), food)
+
+    def search_similar_foods(self, food: str, limit: int = 20) -> list[str]:
+        return search_similar_foods(self.connection(), food, limit)
+
+    def list_safe_foods(self, **page) -> list[dict]:
+        return list_safe_foods(self.connection(), **page)
+
+    def lookup_unmatched_query(self, search_query: str) -> Union[str, None]:
+        return lookup_unmatched_query(self.connection(), search_query)
+
+    def record_unmatched_query(
+        self, search_query: str, reason: str, ttl_seconds: float
+    ):
+        record_unmatched_query(self.connection(), search_query, reason, ttl_seconds)
+
+    def quarantine_search(self, search_query: str, reason: str) -> bool:
+        return quarantine_search(self.connection(), search_query, reason)
+
+    def take_upstream_token(self, lane: str, **budget) -> float:
+        return take_upstream_token(self.connection(), lane, **budget)
+
+    def count_upstream_calls(self) -> dict[str, int]:
+        return count_upstream_calls(self.connection())
+
+    def record_search(
+        self,
+        search_query: str,
+        parsed_nutrient_response: dict,
+        raw: str = "",
+        verdict: Union[dict, None] = None,
+    ):
+        parameters = search_record_parameters(
+            search_query, parsed_nutrient_response, raw, verdict
+        )
+        if not self.write_behind:
+            with self.connection() as connection:
+                connection.execute(UPSERT_SEARCH, parameters)
+            return
+        self.start_writer()
+        self._writes.put(parameters)
+
+    def start_writer(self):
+        if self._writer is not None and self._writer.is_alive():
+            return
+        with self._lock:
+            if self._writer is None or not self._writer.is_alive():
+                self._writer = threading.Thread(
+                    target=self.write_queued_searches,
+                    name="cache-write-behind",
+                    daemon=True,
+                )
+                self._writer.start()
+
+    def write_queued_searches(self):
+        connection = None
+        stopping = False
+        while not stopping:
+            batch = [self._writes.get()]
+            while len(batch) < self.max_batch_size:
+                try:
+                    batch.append(self._writes.get_nowait())
+                except queue.Empty:
+                    break
+            stopping = batch[-1] is None
+            writes = [parameters for parameters in batch if parameters is not None]
+            try:
+                if connection is None:
+                    connection = self.open_connection()
+                self.commit_batch(connection, writes)
+            except Exception:
+                # the thread must survive a failed batch, or every later write is lost and flush() never returns
+                logging.exception(f"Dropped {len(writes)} cache writes")
+            finally:
+                for _ in batch:
+                    self._writes.task_done()
+
+    def commit_batch(
+        self, connection: sqlite3.Connection, writes: list, attempts: int = 5
+    ):
+        """Commits writes in one transaction, retrying with exponential backoff while the database is locked.
+        Raises the last sqlite3.OperationalError when every attempt failed."""
+        for attempt in range(attempts):
+            if attempt:
+                time.sleep(self.retry_backoff_seconds * 2 ** (attempt - 1))
+            try:
+                with connection:
+                    connection.executemany(UPSERT_SEARCH, writes)
+                logging.debug(f"Wrote {len(writes)} searches to cache")
+                return
+            except sqlite3.OperationalError as error:
+                logging.warning(
+                    f"Cache write attempt {attempt + 1} of {attempts} failed: {error}"
+                )
+                if attempt + 1 == attempts:
+                    raise
+
+    def claim_inflight_fetch(
+        self, search_query: str, owner: str, ttl_seconds: float
+    ) -> bool:
+        """Marks a query as being fetched by owner, unless another live owner already holds it. Returns whether
+        the claim succeeded. A claim that is not completed within ttl_seconds can be taken over."""
+        now = time.time()
+        with self.connection() as connection:
+            connection.execute(
+                "DELETE FROM InflightFetches WHERE expires_at < ?", (now,)
+            )
+            cursor = connection.execute(
+                """INSERT INTO InflightFetches (query, owner, expires_at, raw) VALUES (?, ?, ?, NULL)
+                   ON CONFLICT (query) DO NOTHING""",
+                (normalize_query(search_query), owner, now + ttl_seconds),
+            )
+        return cursor.rowcount == 1
+
+    def complete_inflight_fetch(
+        self, search_query: str, owner: str, raw: str, linger_seconds: float
+    ):
+        """Publishes the fetched response to waiting workers for linger_seconds."""
+        with self.connection() as connection:
+            connection.execute(
+                "UPDATE InflightFetches SET raw = ?, expires_at = ? WHERE query = ? AND owner = ?",
+                (
+                    raw,
+                    time.time() + linger_seconds,
+                    normalize_query(search_query),
+                    owner,
+                ),
+            )
+
+    def release_inflight_fetch(self, search_query: str, owner: str):
+        with self.connection() as connection:
+            connection.execute(
+                "DELETE FROM InflightFetches WHERE query = ? AND owner = ? AND raw IS NULL",
+                (normalize_query(search_query), owner),
+            )
+
+    def get_inflight_fetch(self, search_query: str) -> Union[tuple, None]:
+        """Returns (raw, expires_at) for a live in-flight fetch, where raw is None until it completes."""
+        return (
+            self.connection()
+            .execute(
+                "SELECT raw, expires_at FROM InflightFetches WHERE query = ? AND expires_at >= ?",
+                (normalize_query(search_query), time.time()),
+            )
+            .fetchone()
+        )
+
+    def flush(self, timeout: Union[float, None] = None):
+        """Blocks until every queued write has been committed or dropped. Raises TimeoutError when writes are
+        still queued after timeout seconds, and RuntimeError when the writer thread is gone with writes queued."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._writes.all_tasks_done:
+            while self._writes.unfinished_tasks:
+                if self._writer is None or not self._writer.is_alive():
+                    raise RuntimeError(
+                        f"Cache writer is not running; {self._writes.unfinished_tasks} write(s) queued"
+                    )
+                wait_seconds = 0.1
+                if deadline is not None:
+                    wait_seconds = min(wait_seconds, deadline - time.monotonic())
+                    if wait_seconds <= 0:
+                        raise TimeoutError(
+                            f"{self._writes.unfinished_tasks} cache write(s) still queued after {timeout}s"
+                        )
+                self._writes.all_tasks_done.wait(wait_seconds)
+
+    def close(self):
+        if self._writer is not None:
+            self._writes.put(None)
+            self._writer.join()
+            self._writer = None
+        with self._lock:
+            for connection in self._connections:
+                connection.close()
+            self._connections.clear()
+            self._migrated = False
+        self._local = threading.local()
+
+
+cache_store = CacheStore()
+atexit.register(cache_store.close)
+
+
+def summarize(connection: sqlite3.Connection) -> dict:
+    summary = {
+        "schema_version": get_schema_version(connection),
+        "cached_queries": connection.execute(
+            "SELECT COUNT(*) FROM SearchCache"
+        ).fetchone()[0],
+        "total_hits": connection.execute(
+            "SELECT COALESCE(SUM(hit_count), 0) FROM SearchCache"
+        ).fetchone()[0],
+    }
+    if summary["schema_version"] >= 2:
+        summary["materialized_verdicts"] = connection.execute(
+            "SELECT COUNT(*) FROM SearchCache WHERE verdict_version = ?",
+            (VERDICT_VERSION,),
+        ).fetchone()[0]
+    if summary["schema_version"] >= 4:
+        summary["local_foods"] = connection.execute(
+            "SELECT COUNT(*) FROM LocalFoods"
+        ).fetchone()[0]
+    if summary["schema_version"] >= 7:
+        summary["unmatched_queries"] = connection.execute(
+            "SELECT COUNT(*) FROM UnmatchedQueries WHERE expires_at >= ?",
+            (time.time(),),
+        ).fetchone()[0]
+        summary["quarantined_searches"] = connection.execute(
+            "SELECT COUNT(*) FROM QuarantinedSearches"
+        ).fetchone()[0]
+    if summary["schema_version"] >= 8:
+        summary["upstream_calls_today"] = sum(count_upstream_calls(connection).values())
+    if table_exists(connection, "Searches"):
+        summary["legacy_rows"] = connection.execute(
+            "SELECT COUNT(*) FROM Searches"
+        ).fetchone()[0]
+    return summary
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Manage the searches.db cache.")
+    parser.add_argument("--database", default=DATABASE_PATH)
+    subcommands = parser.add_subparsers(dest="command", required=True)
+    subcommands.add_parser(
+        "migrate", help="upgrade the cache schema to the latest version"
+    )
+    backfill = subcommands.add_parser(
+        "backfill",
+        help="materialize verdicts for cached rows parsed before they were stored",
+    )
+    backfill.add_argument(
+        "--quarantine",
+        action="store_true",
+        help="move rows whose payload cannot be parsed to QuarantinedSearches",
+    )
+    rescore = subcommands.add_parser(
+        "rescore",
+        help="count cached foods under a fructose threshold using the materialized verdicts",
+    )
+    rescore.add_argument("--grams-allowed", type=float, default=3)
+    compact = subcommands.add_parser(
+        "compact",
+        help="trim and compress payloads stored before compression, then vacuum",
+    )
+    compact.add_argument(
+        "--drop-legacy",
+        action="store_true",
+        help="also drop the Searches table kept from schema v0",
+    )
+    args = parser.parse_args(argv)
+
+    if args.command == "migrate":
+        connection = sqlite3.connect(args.database)
+        version_before = get_schema_version(connection)
+        applied = migrate(connection)
+        summary = summarize(connection)
+        print(
+            f"{args.database}: schema v{version_before} -> v{summary['schema_version']} "
+            f"({applied} migration(s) applied)"
+        )
+        for key, value in summary.items():
+            print(f"  {key}: {value}")
+        connection.close()
+    elif args.command == "backfill":
+        from model import materialize_verdict_from_response
+
+        connection = connect(args.database)
+        materialized, failed = backfill_verdicts(
+            connection, materialize_verdict_from_response, quarantine=args.quarantine
+        )
+        print(
+            f"{args.database}: materialized {materialized} verdict(s), "
+            f"{failed} row(s) could not be parsed"
+            + (" and were quarantined" if args.quarantine and failed else "")
+        )
+        connection.close()
+    elif args.command == "rescore":
+        from nutrients import NutrientBatch
+
+        connection = connect(args.database)
+        started = time.perf_counter()
+        queries, *columns = load_verdict_columns(connection)
+        verdicts = NutrientBatch(*columns).evaluate(args.grams_allowed)
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        under_limit = int(verdicts["is_under_allowable_fructose_limit"].sum())
+        print(
+            f"{args.database}: {under_limit} of {len(queries)} cached food(s) are under "
+            f"{args.grams_allowed:g}g of fructose per serving ({elapsed_ms:.1f} ms)"
+        )
+        connection.close()
+    elif args.command == "compact":
+        connection = connect(args.database)
+        size_before = os.path.getsize(args.database)
+        read_ms_before = time_payload_reads(connection)
+        rewritten, bytes_before, bytes_after = compact_payloads(connection)
+        if args.drop_legacy and table_exists(connection, "Searches"):
+            with connection:
+                connection.execute("DROP TABLE Searches")
+        connection.execute("VACUUM")
+        size_after = os.path.getsize(args.database)
+        read_ms_after = time_payload_reads(connection)
+        print(
+            f"{args.database}: compacted {rewritten} payload(s), "
+            f"{bytes_before:,} -> {bytes_after:,} bytes"
+        )
+        print(f"  file size: {size_before:,} -> {size_after:,} bytes")
+        print(
+            f"  cache hit read: {read_ms_before:.3f} -> {read_ms_after:.3f} ms per payload"
+        )
+        connection.close()
+    return 0
+
 
-connection = sqlite3.connect('searches.db')
-cursor = connection.cursor()
-cursor.execute('''CREATE TABLE IF NOT EXISTS Searches
-              (id INTEGER PRIMARY Key AUTOINCREMENT NOT NULL,
-              Timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-                name TEXT,
-			   serving_unit TEXT,
-			    serving_size_grams FLOAT,
-				item TEXT,
-				measure TEXT,
-				quantity FLOAT,
-				fructose_n FLOAT,
-				glucose_n FLOAT,
-				sucrose FLOAT)''')
\ No newline at end of file
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,361 @@
+"""Imports USDA FoodData Central dumps into the LocalFoods table, so common foods resolve without calling Nutritionix.
+
+    python fooddata.py import FoodData_Central_sr_legacy_food_csv_2018-04/
+    python fooddata.py import FoodData_Central_foundation_food_json_2022-10-28.json
+
+CSV dumps are directories holding food.csv, food_nutrient.csv, food_portion.csv and (optionally)
+measure_unit.csv. They are streamed into temporary tables and joined in SQLite. JSON dumps hold a single
+array of foods, which is decoded one food at a time. Neither format is ever fully loaded into memory.
+"""
+import os
+import csv
+import sys
+import json
+import sqlite3
+import logging
+import argparse
+from typing import IO, Iterable, Iterator, Union
+
+import db
+from nutrients import FRUCTOSE_ID, GLUCOSE_ID, SUCROSE_ID, TOTAL_SUGAR_ID
+
+# FoodData Central nutrient ids; their nutrient numbers are the attr_ids Nutritionix uses
+FDC_NUTRIENT_COLUMNS = {
+    1012: "fructose",
+    1011: "glucose",
+    1010: "sucrose",
+    2000: "total_sugar",
+}
+# older Standard Reference foods only report "Sugars, Total NLEA"
+FDC_FALLBACK_TOTAL_SUGAR_ID = 1063
+LOCAL_NUTRIENT_ATTR_IDS = (
+    (FRUCTOSE_ID, "fructose"),
+    (GLUCOSE_ID, "glucose"),
+    (SUCROSE_ID, "sucrose"),
+    (TOTAL_SUGAR_ID, "total_sugar"),
+)
+UNDETERMINED_MEASURE_UNIT = "undetermined"
+CSV_BATCH_SIZE = 5000
+
+
+def describe_portion(
+    measure_unit: Union[str, None],
+    modifier: Union[str, None],
+    portion_description: Union[str, None],
+) -> str:
+    """Serving unit text for a portion, e.g. 'cup, sliced' or 'medium (3" dia)'."""
+    parts = [
+        part
+        for part in (
+            measure_unit if measure_unit != UNDETERMINED_MEASURE_UNIT else None,
+            modifier,
+        )
+        if part
+    ]
+    return ", ".join(parts) or portion_description or "serving"
+
+
+def build_local_food(
+    fdc_id: Union[int, None],
+    description: str,
+    nutrients: dict,
+    portion: Union[tuple, None],
+) -> tuple:
+    """Returns the LocalFoods row for a food, keyed by its normalized description and indexed by its primary food
+    name (see db.get_primary_food()). nutrients maps FDC nutrient id to grams per 100 g and portion is
+    (amount, serving unit, gram weight); foods without a portion are described per 100 g."""
+    columns = {
+        column: nutrients.get(nutrient_id)
+        for nutrient_id, column in FDC_NUTRIENT_COLUMNS.items()
+    }
+    if columns["total_sugar"] is None:
+        columns["total_sugar"] = nutrients.get(FDC_FALLBACK_TOTAL_SUGAR_ID)
+    portion_amount, portion_unit, portion_grams = portion or (100.0, "g", 100.0)
+    return (
+        db.normalize_query(description),
+        fdc_id,
+        description,
+        columns["fructose"],
+        columns["glucose"],
+        columns["sucrose"],
+        columns["total_sugar"],
+        portion_amount,
+        portion_unit,
+        portion_grams,
+        db.get_primary_food(description),
+    )
+
+
+def build_food_response(local_food: dict) -> dict:
+    """Describes an imported food as a Nutritionix natural nutrients response for its first portion, so it can be
+    evaluated and cached exactly like an API answer."""
+    scale = local_food["portion_grams"] / 100
+    return {
+        "foods": [
+            {
+                "food_name": local_food["name"],
+                "serving_qty": local_food["portion_amount"],
+                "serving_unit": local_food["portion_unit"],
+                "serving_weight_grams": local_food["portion_grams"],
+                "tags": {
+                    "item": local_food["name"],
+                    "measure": local_food["portion_unit"],
+                    "quantity": str(float(local_food["portion_amount"])),
+                },
+                "full_nutrients": [
+                    {"attr_id": attr_id, "value": local_food[column] * scale}
+                    for attr_id, column in LOCAL_NUTRIENT_ATTR_IDS
+                    if local_food[column] is not None
+                ],
+            }
+        ]
+    }
+
+
+def iterate_json_array(file: IO[str], chunk_size: int = 1 << 16) -> Iterator:
+    """Yields the items of the first JSON array in the file one at a time, reading chunk_size characters at a time."""
+    decoder = json.JSONDecoder()
+    buffer = ""
+    while "[" not in buffer:
+        chunk = file.read(chunk_size)
+        if not chunk:
+            return
+        buffer = chunk
+    buffer = buffer[buffer.index("[") + 1 :]
+    while True:
+        buffer = buffer.lstrip().removeprefix(",").lstrip()
+        if buffer.startswith("]"):
+            return
+        try:
+            item, end = decoder.raw_decode(buffer)
+        except json.JSONDecodeError:
+            chunk = file.read(chunk_size)
+            if not chunk:
+                raise
+            buffer += chunk
+            continue
+        yield item
+        buffer = buffer[end:]
+
+
+def read_json_food(food: dict) -> tuple:
+    """Returns the LocalFoods row for one food of a FoodData Central JSON dump (Foundation, SR Legacy, Survey or
+    Branded)."""
+    nutrients = {}
+    for food_nutrient in food.get("foodNutrients", []):
+        nutrient_id = (food_nutrient.get("nutrient") or {}).get(
+            "id", food_nutrient.get("nutrientId")
+        )
+        amount = food_nutrient.get("amount", food_nutrient.get("value"))
+        if amount is not None:
+            nutrients[nutrient_id] = float(amount)
+    portions = sorted(
+        (
+            portion
+            for portion in food.get("foodPortions", [])
+            if portion.get("gramWeight")
+        ),
+        key=lambda portion: portion.get("sequenceNumber") or 0,
+    )
+    portion = None
+    if portions:
+        portion = (
+            float(portions[0].get("amount") or 1),
+            describe_portion(
+                (portions[0].get("measureUnit") or {}).get("name"),
+                portions[0].get("modifier"),
+                portions[0].get("portionDescription"),
+            ),
+            float(portions[0]["gramWeight"]),
+        )
+    elif food.get("servingSize") and food.get("servingSizeUnit") == "g":
+        portion = (
+            1.0,
+            food.get("householdServingFullText") or "serving",
+            float(food["servingSize"]),
+        )
+    return build_local_food(food.get("fdcId"), food["description"], nutrients, portion)
+
+
+def read_fooddata_json(path: str) -> Iterator[tuple]:
+    with open(path, encoding="utf-8") as file:
+        for food in iterate_json_array(file):
+            yield read_json_food(food)
+
+
+def import_foods(
+    connection: sqlite3.Connection, local_foods: Iterable[tuple], batch_size: int = 500
+) -> int:
+    """Upserts LocalFoods rows, committing every batch_size rows. Returns the number of rows written."""
+    imported = 0
+    batch = []
+    for local_food in local_foods:
+        batch.append(local_food)
+        if len(batch) >= batch_size:
+            with connection:
+                connection.executemany(db.UPSERT_LOCAL_FOOD, batch)
+            imported += len(batch)
+            batch = []
+    if batch:
+        with connection:
+            connection.executemany(db.UPSERT_LOCAL_FOOD, batch)
+        imported += len(batch)
+    return imported
+
+
+def stage_csv(
+    connection: sqlite3.Connection,
+    path: str,
+    table: str,
+    columns: tuple,
+    keep_row=lambda row: True,
+):
+    """Streams the named columns of a FoodData Central CSV file into a temporary table."""
+    connection.execute(f"CREATE TEMP TABLE {table} ({', '.join(columns)})")
+    with open(path, newline="", encoding="utf-8") as file:
+        reader = csv.DictReader(file)
+        batch = []
+        for row in reader:
+            if not keep_row(row):
+                continue
+            batch.append(tuple(row.get(column) or None for column in columns))
+            if len(batch) >= CSV_BATCH_SIZE:
+                connection.executemany(
+                    f"INSERT INTO {table} VALUES ({', '.join('?' for _ in columns)})",
+                    batch,
+                )
+                batch = []
+        connection.executemany(
+            f"INSERT INTO {table} VALUES ({', '.join('?' for _ in columns)})", batch
+        )
+
+
+def import_fooddata_csv(connection: sqlite3.Connection, directory: str) -> int:
+    """Imports a FoodData Central CSV dump directory. Returns the number of foods written."""
+    sugar_nutrient_ids = {
+        str(nutrient_id)
+        for nutrient_id in (*FDC_NUTRIENT_COLUMNS, FDC_FALLBACK_TOTAL_SUGAR_ID)
+    }
+    with connection:
+        stage_csv(
+            connection,
+            os.path.join(directory, "food.csv"),
+            "fdc_food",
+            ("fdc_id", "description"),
+        )
+        stage_csv(
+            connection,
+            os.path.join(directory, "food_nutrient.csv"),
+            "fdc_food_nutrient",
+            ("fdc_id", "nutrient_id", "amount"),
+            lambda row: row["nutrient_id"] in sugar_nutrient_ids,
+        )
+        stage_csv(
+            connection,
+            os.path.join(directory, "food_portion.csv"),
+            "fdc_food_portion",
+            (
+                "id",
+                "fdc_id",
+                "seq_num",
+                "amount",
+                "measure_unit_id",
+                "portion_description",
+                "modifier",
+                "gram_weight",
+            ),
+            lambda row: bool(row.get("gram_weight")),
+        )
+        measure_unit_path = os.path.join(directory, "measure_unit.csv")
+        if os.path.exists(measure_unit_path):
+            stage_csv(connection, measure_unit_path, "fdc_measure_unit", ("id", "name"))
+        else:
+            connection.execute("CREATE TEMP TABLE fdc_measure_unit (id, name)")
+        connection.create_function(
+            "normalize_query", 1, db.normalize_query, deterministic=True
+        )
+        connection.create_function(
+            "describe_portion", 3, describe_portion, deterministic=True
+        )
+        connection.create_function(
+            "get_primary_food", 1, db.get_primary_food, deterministic=True
+        )
+        nutrient_columns = ",\n".join(
+            f"MAX(CASE WHEN CAST(nutrient_id AS INTEGER) = {nutrient_id} THEN CAST(amount AS FLOAT) END) AS {column}"
+            for nutrient_id, column in FDC_NUTRIENT_COLUMNS.items()
+        )
+        cursor = connection.execute(
+            f"""INSERT INTO LocalFoods ({", ".join(db.LOCAL_FOOD_COLUMNS)})
+                WITH nutrients AS (
+                    SELECT CAST(fdc_id AS INTEGER) AS fdc_id, {nutrient_columns},
+                        MAX(CASE WHEN CAST(nutrient_id AS INTEGER) = {FDC_FALLBACK_TOTAL_SUGAR_ID} THEN CAST(amount AS FLOAT) END)
+                            AS fallback_total_sugar
+                    FROM fdc_food_nutrient GROUP BY fdc_id
+                ),
+                portions AS (
+                    SELECT CAST(fdc_id AS INTEGER) AS fdc_id, amount, measure_unit_id, portion_description, modifier,
+                        gram_weight, ROW_NUMBER() OVER (
+                            PARTITION BY fdc_id
+                            ORDER BY seq_num IS NULL, CAST(seq_num AS INTEGER), CAST(id AS INTEGER)
+                        ) AS position
+                    FROM fdc_food_portion
+                )
+                SELECT normalize_query(food.description), CAST(food.fdc_id AS INTEGER), food.description,
+                    nutrients.fructose, nutrients.glucose, nutrients.sucrose,
+                    COALESCE(nutrients.total_sugar, nutrients.fallback_total_sugar),
+                    COALESCE(CAST(portions.amount AS FLOAT), CASE WHEN portions.fdc_id IS NULL THEN 100.0 ELSE 1.0 END),
+                    CASE WHEN portions.fdc_id IS NULL THEN 'g'
+                        ELSE describe_portion(measure_unit.name, portions.modifier, portions.portion_description) END,
+                    COALESCE(CAST(portions.gram_weight AS FLOAT), 100.0),
+                    get_primary_food(food.description)
+                FROM fdc_food AS food
+                LEFT JOIN nutrients ON nutrients.fdc_id = CAST(food.fdc_id AS INTEGER)
+                LEFT JOIN portions ON portions.fdc_id = CAST(food.fdc_id AS INTEGER) AND portions.position = 1
+                LEFT JOIN fdc_measure_unit AS measure_unit ON measure_unit.id = portions.measure_unit_id
+                WHERE food.description IS NOT NULL
+                ORDER BY CAST(food.fdc_id AS INTEGER)
+                ON CONFLICT (name) DO UPDATE SET
+                    {", ".join(f"{column} = excluded.{column}" for column in db.LOCAL_FOOD_COLUMNS[1:])}"""
+        )
+        imported = cursor.rowcount
+        for table in (
+            "fdc_food",
+            "fdc_food_nutrient",
+            "fdc_food_portion",
+            "fdc_measure_unit",
+        ):
+            connection.execute(f"DROP TABLE temp.{table}")
+    return imported
+
+
+def import_fooddata(connection: sqlite3.Connection, path: str) -> int:
+    """Imports a FoodData Central CSV directory or JSON file into LocalFoods. Returns the number of foods written."""
+    if os.path.isdir(path):
+        imported = import_fooddata_csv(connection, path)
+    else:
+        imported = import_foods(connection, read_fooddata_json(path))
+    logging.debug(f"Imported {imported} foods from {path}")
+    return imported
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Manage the local food database.")
+    parser.add_argument("--database", default=db.DATABASE_PATH)
+    subcommands = parser.add_subparsers(dest="command", required=True)
+    import_command = subcommands.add_parser(
+        "import", help="load a FoodData Central CSV directory or JSON file"
+    )
+    import_command.add_argument("path")
+    args = parser.parse_args(argv)
+
+    if args.command == "import":
+        connection = db.connect(args.database)
+        imported = import_fooddata(connection, args.path)
+        total = connection.execute("SELECT COUNT(*) FROM LocalFoods").fetchone()[0]
+        print(f"{args.database}: imported {imported} food(s), {total} in total")
+        connection.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
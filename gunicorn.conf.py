@@ -0,0 +1,36 @@
+"""Production gunicorn settings, read automatically from the working directory (see Procfile).
+
+    gunicorn
+    WEB_CONCURRENCY=4 GUNICORN_THREADS=8 WARM_CACHE_TOP_N=200 gunicorn
+
+main.py and model.py are imported once in the master (preload_app), and the memory cache warm-up finishes there
+before any worker is forked, so every worker starts with the same warm verdicts in copy-on-write memory. Workers
+share everything they fetch through searches.db in WAL mode, read through a shared memory map, and
+CROSS_PROCESS_FETCH_LOCK makes concurrent misses for the same query in different workers cost one Nutritionix call.
+"""
+import os
+import multiprocessing
+
+# read by singleflight.py when main is preloaded below
+os.environ.setdefault("CROSS_PROCESS_FETCH_LOCK", "1")
+
+wsgi_app = "main:app"
+bind = f"0.0.0.0:{os.environ.get('PORT', '8000')}"
+preload_app = True
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count() * 2 + 1))
+# threads overlap requests waiting on Nutritionix within a worker
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS", "4"))
+# Nutritionix reads time out after 10 seconds and are retried twice
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", "45"))
+keepalive = 5
+
+
+def when_ready(server):
+    """Runs in the master after the app is preloaded, before the first worker is forked."""
+    import db
+    import main
+
+    if main.memory_cache_warmup is not None:
+        main.memory_cache_warmup.join()
+    db.cache_store.close()
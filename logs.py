@@ -0,0 +1,62 @@
+"""Non-blocking application logging to mainlog.log.
+
+Request threads only put records on a queue; a listener thread formats and writes them, so a slow disk never
+delays a response. Messages longer than LOG_MAX_MESSAGE_LENGTH characters (e.g. raw API payloads) are cut
+before they are queued.
+"""
+import os
+import queue
+import atexit
+import logging
+from logging.handlers import QueueHandler, QueueListener
+from typing import Union
+
+LOG_FILENAME = os.environ.get("LOG_FILENAME", "mainlog.log")
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "DEBUG")
+LOG_MAX_MESSAGE_LENGTH = int(os.environ.get("LOG_MAX_MESSAGE_LENGTH", "500"))
+LOG_FORMAT = "%(asctime)s %(levelname)s %(name)s %(threadName)s: %(message)s"
+
+
+class TruncatingQueueHandler(QueueHandler):
+    """QueueHandler that merges the message arguments and cuts the result to max_message_length characters."""
+
+    def __init__(self, log_queue: queue.SimpleQueue, max_message_length: int):
+        super().__init__(log_queue)
+        self.max_message_length = max_message_length
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = super().prepare(record)
+        if len(record.msg) > self.max_message_length:
+            omitted = len(record.msg) - self.max_message_length
+            record.msg = f"{record.msg[: self.max_message_length]}... [{omitted} characters omitted]"
+        return record
+
+
+def configure_logging(
+    filename: str = LOG_FILENAME,
+    level: str = LOG_LEVEL,
+    max_message_length: int = LOG_MAX_MESSAGE_LENGTH,
+) -> Union[QueueListener, None]:
+    """Routes the root logger through a queue to filename. Does nothing if it is already configured."""
+    root_logger = logging.getLogger()
+    if any(isinstance(handler, QueueHandler) for handler in root_logger.handlers):
+        return None
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    file_handler = logging.FileHandler(filename, encoding="utf-8", delay=True)
+    file_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    listener = QueueListener(log_queue, file_handler)
+    listener.start()
+    atexit.register(listener.stop)
+
+    def start_listener_in_child():
+        # threads do not survive fork(), so a process forked after this (a preloaded gunicorn worker) needs its own
+        child_listener = QueueListener(log_queue, file_handler)
+        child_listener.start()
+        atexit.register(child_listener.stop)
+
+    os.register_at_fork(after_in_child=start_listener_in_child)
+    root_logger.addHandler(TruncatingQueueHandler(log_queue, max_message_length))
+    root_logger.setLevel(level)
+    # urllib3 logs every pooled connection event at DEBUG
+    logging.getLogger("urllib3").setLevel(logging.INFO)
+    return listener
@@ -1,120 +1,314 @@
-from flask import Flask, render_template, request
-from model import IngredientNutrientResult
-import fnmatch
+from flask import Flask, g, render_template, request
+from cache import rendered_result_cache
+from model import (
+    list_safe_foods,
+    resolve_ingredient,
+    resolve_ingredient_batch,
+    split_search_queries,
+)
+from metrics import (
+    CONTENT_TYPE,
+    begin_request,
+    cache_lookups,
+    finish_request,
+    registry,
+    span,
+)
+from nutritionix import UpstreamError
+from presentation import build_ingredient_result
+from db import SAFE_FOOD_ORDERS
+from profiling import (
+    PROFILE_HEADER,
+    PROFILE_PARAMETER,
+    finish_request_profile,
+    start_request_profile,
+)
+from warmup import start_memory_cache_warmup
+import os
+import json
+import hashlib
+from typing import Callable
 
 app = Flask(__name__)
 
 
+@app.before_request
+def start_request_timing():
+    g.request_started = begin_request()
+
+
+@app.after_request
+def record_request_timing(response):
+    """Counts the response and adds a Server-Timing header with the time spent in each stage."""
+    route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+    response.headers["Server-Timing"] = finish_request(
+        route, request.method, response.status_code, g.request_started
+    )
+    return response
+
+
+@app.before_request
+def start_profiling():
+    """Profiles the request when asked to, see profiling.py; otherwise costs a header and an argument lookup."""
+    g.request_profile = start_request_profile(
+        request.method,
+        request.path,
+        request.headers.get(PROFILE_HEADER) or request.args.get(PROFILE_PARAMETER),
+    )
+
+
+@app.after_request
+def finish_profiling(response):
+    if g.request_profile is not None:
+        response.headers["X-Profile-Id"] = finish_request_profile(g.request_profile)
+        g.request_profile = None
+    return response
+
+
+@app.teardown_request
+def stop_unfinished_profile(error):
+    # after_request handlers are skipped when a view raises
+    if g.get("request_profile") is not None:
+        finish_request_profile(g.request_profile)
+
+
+def render_search_page(**context) -> str:
+    with span("render"):
+        return render_template("search.html", **context)
+
+
+# loads the WARM_CACHE_TOP_N most searched verdicts into the memory cache in the background, see warmup.py;
+# gunicorn.conf.py waits for it before forking workers
+memory_cache_warmup = start_memory_cache_warmup(
+    int(os.environ.get("WARM_CACHE_TOP_N", "0"))
+)
+
+# most foods accepted in one batch request; every miss among them shares a single Nutritionix call
+MAX_BATCH_SIZE = 50
+
+# most foods returned in one page of /api/v1/safe_foods
+MAX_SAFE_FOODS_PAGE_SIZE = 100
+
+# bumped whenever build_ingredient_result() or search.html changes what a result looks like, so old ETags stop matching
+RESULT_FORMAT_VERSION = 1
+API_CACHE_CONTROL = (
+    f"public, max-age={int(os.environ.get('API_CACHE_MAX_AGE_SECONDS', '3600'))}"
+)
+
+
+def get_result_etag(search_query: str, NutrientResults) -> str:
+    """Deterministic across processes and restarts: a hash of everything build_ingredient_result() reads."""
+    verdict = NutrientResults.verdict
+    fingerprint = json.dumps(
+        [
+            RESULT_FORMAT_VERSION,
+            search_query,
+            verdict.materialized_verdict,
+            verdict.n_grams_fructose_allowed,
+            NutrientResults.match_confidence,
+            NutrientResults.scaled,
+            NutrientResults.matched_query,
+        ],
+        sort_keys=True,
+        default=str,
+    )
+    return hashlib.sha256(fingerprint.encode("utf-8")).hexdigest()[:32]
+
+
+def get_cached_rendering(kind: str, etag: str, render: Callable[[], str]):
+    """Returns the cached rendering of a result, rendering and storing it on a miss."""
+    rendering = rendered_result_cache.get((kind, etag))
+    cache_lookups.inc(
+        tier=f"rendered_{kind}", result="miss" if rendering is None else "hit"
+    )
+    if rendering is None:
+        rendering = render()
+        rendered_result_cache.set((kind, etag), rendering)
+    return rendering
+
+
 @app.route("/")
 def index():
     """Initial rendering of search page. Sets initial search as blank in order to not render blank
     results box.."""
     search_query: str = ""
-    return render_template("search.html", search_query=search_query)
+    return render_search_page(search_query=search_query)
 
 
 @app.route("/", methods=["GET", "POST"])
 def update():
     search_query = request.form["search_query"]
     try:
-        NutrientResults = IngredientNutrientResult(search_query)
+        NutrientResults = resolve_ingredient(search_query)
         NutrientResults.insert_results_into_cache()
     except KeyError:
-        return render_template("search.html", search_query="", error=True)
+        return render_search_page(search_query="", error=True)
+    except UpstreamError:
+        return render_search_page(search_query="", upstream_error=True)
     else:
-
-        search_results = NutrientResults.parsed_nutrient_response
-        fructose_serving_grams = round(
-            NutrientResults.grams_fructose_per_single_serving_of_ingredient, 1
-        )
-        fructose_proportion = (
-            NutrientResults.proportion_of_fructose_per_gram_of_ingredient
-        )
-        serving_unit_connecting_word = set_serving_unit_preposition(NutrientResults)
-        can_eat = set_display_word_for_allowable_food(NutrientResults)
-
-        return render_template(
-            "search.html",
-            search_query=search_query,
-            query_response=search_results,
-            t_fructose=NutrientResults.total_fructose,
-            total_sugar_calc=NutrientResults.total_sugars_calculated,
-            total_sugar_api=NutrientResults.total_sugar_from_api,
-            serving_unit=NutrientResults.serving_unit,
-            quantity=NutrientResults.quantity_of_servings,
-            serving_size_grams=NutrientResults.total_weight_grams,
-            name=NutrientResults.ingredient_name,
-            can_eat=can_eat,
-            under_limit=NutrientResults.is_under_allowable_fructose_limit,
-            f_serving_grams=fructose_serving_grams,
-            details=NutrientResults.has_detailed_nutrients,
-            f_proportion=fructose_proportion,
-            connecting_word=serving_unit_connecting_word,
+        return get_cached_rendering(
+            "html",
+            get_result_etag(search_query, NutrientResults),
+            lambda: render_search_page(
+                **build_ingredient_result(search_query, NutrientResults)
+            ),
         )
 
 
+@app.route("/meal", methods=["POST"])
+def update_meal():
+    """Renders verdicts for a newline separated list of foods plus the fructose total for the whole meal."""
+    search_queries = split_search_queries(request.form["search_queries"])
+    if not search_queries or len(search_queries) > MAX_BATCH_SIZE:
+        return render_search_page(search_query="", error=True)
+    try:
+        batch_results = resolve_ingredient_batch(search_queries)
+    except UpstreamError:
+        return render_search_page(search_query="", upstream_error=True)
+    for _, NutrientResults in batch_results:
+        if NutrientResults is not None:
+            NutrientResults.insert_results_into_cache()
+    return render_search_page(search_query="", meal=build_meal_result(batch_results))
+
+
 @app.route("/api/v1/get_single_ingredient", methods=["GET"])
 def get_single_ingredient_result():
     if "search_query" in request.args:
         search_query = request.args["search_query"]
         try:
-            NutrientResults = IngredientNutrientResult(search_query)
-            # disabled due to lack of support for writing to sqlite3 dbs in Deta.sh
-            # #todo - migrate to deta.sh db or new hosting service
-            # NutrientResults.insert_results_into_cache()
+            NutrientResults = resolve_ingredient(search_query)
+            NutrientResults.insert_results_into_cache()
         except KeyError:
-            return render_template("search.html", search_query="", error=True)
-        else:
-
-            search_results = NutrientResults.parsed_nutrient_response
-            fructose_serving_grams = round(
-                NutrientResults.grams_fructose_per_single_serving_of_ingredient, 1
-            )
-            fructose_proportion = (
-                NutrientResults.proportion_of_fructose_per_gram_of_ingredient
-            )
-            serving_unit_connecting_word = set_serving_unit_preposition(NutrientResults)
-            can_eat = set_display_word_for_allowable_food(NutrientResults)
-
-            return dict(
-                search_query=search_query,
-                query_response=search_results,
-                t_fructose=NutrientResults.total_fructose,
-                total_sugar_calc=NutrientResults.total_sugars_calculated,
-                total_sugar_api=NutrientResults.total_sugar_from_api,
-                serving_unit=NutrientResults.serving_unit,
-                quantity=NutrientResults.quantity_of_servings,
-                serving_size_grams=NutrientResults.total_weight_grams,
-                name=NutrientResults.ingredient_name,
-                can_eat=can_eat,
-                under_limit=NutrientResults.is_under_allowable_fructose_limit,
-                f_serving_grams=fructose_serving_grams,
-                details=NutrientResults.has_detailed_nutrients,
-                f_proportion=fructose_proportion,
-                connecting_word=serving_unit_connecting_word,
+            return render_search_page(search_query="", error=True)
+        except UpstreamError:
+            return (
+                dict(
+                    search_query=search_query,
+                    error="Nutrition data is temporarily unavailable. Please try again.",
+                ),
+                503,
+                {"Cache-Control": "no-store"},
             )
+        else:
+            etag = get_result_etag(search_query, NutrientResults)
+            headers = {"Cache-Control": API_CACHE_CONTROL}
+            if request.if_none_match.contains(etag):
+                response = app.response_class(status=304, headers=headers)
+            else:
+                body = get_cached_rendering(
+                    "json",
+                    etag,
+                    lambda: app.json.response(
+                        build_ingredient_result(search_query, NutrientResults)
+                    ).get_data(),
+                )
+                response = app.response_class(
+                    body, mimetype="application/json", headers=headers
+                )
+            response.set_etag(etag)
+            return response
     else:
         return "Error: No query provided. Please specify a food."
 
 
-def set_display_word_for_allowable_food(NutrientResults):
-    if (
-        NutrientResults.is_under_allowable_fructose_limit
-    ):  # TODO maybe push this into Jinja?
-        can_eat = "can"
-    else:
-        can_eat = "cannot"
-    return can_eat
-
-
-def set_serving_unit_preposition(NutrientResults):
-    serving_unit = NutrientResults.serving_unit
-    if (
-        fnmatch.fnmatch(serving_unit.lower(), "*medium*")
-        or fnmatch.fnmatch(serving_unit.lower(), "*small*")
-        or fnmatch.fnmatch(serving_unit.lower(), "*large*")
-    ):
-        connecting_word = ""
-    else:
-        connecting_word = "of"
-    return connecting_word
+@app.route("/api/v1/get_ingredients", methods=["GET", "POST"])
+def get_ingredients_result():
+    """Batch version of get_single_ingredient. Takes newline separated foods in search_queries."""
+    if "search_queries" not in request.values:
+        return "Error: No query provided. Please specify a list of foods."
+    search_queries = split_search_queries(request.values["search_queries"])
+    if not search_queries:
+        return "Error: No query provided. Please specify a list of foods."
+    if len(search_queries) > MAX_BATCH_SIZE:
+        return (
+            dict(error=f"Please specify at most {MAX_BATCH_SIZE} foods per request."),
+            400,
+        )
+    try:
+        batch_results = resolve_ingredient_batch(search_queries)
+    except UpstreamError:
+        return (
+            dict(
+                search_queries=search_queries,
+                error="Nutrition data is temporarily unavailable. Please try again.",
+            ),
+            503,
+        )
+    for _, NutrientResults in batch_results:
+        if NutrientResults is not None:
+            NutrientResults.insert_results_into_cache()
+    return build_meal_result(batch_results)
+
+
+@app.route("/api/v1/safe_foods", methods=["GET"])
+def get_safe_foods_result():
+    """Cached foods sorted by fructose, lowest first. See parse_safe_foods_args() for the query arguments."""
+    try:
+        page = parse_safe_foods_args(request.args)
+    except ValueError as error:
+        return dict(error=str(error)), 400
+    return build_safe_foods_result(page, list_safe_foods(**page))
+
+
+def parse_safe_foods_args(args) -> dict:
+    """Reads order_by (fructose_per_serving or fructose_per_gram), max_fructose (grams per serving or per gram,
+    matching order_by), limit (at most MAX_SAFE_FOODS_PAGE_SIZE) and offset. Raises ValueError on bad values."""
+    order_by = args.get("order_by", "fructose_per_serving")
+    if order_by not in SAFE_FOOD_ORDERS:
+        raise ValueError(f"order_by must be one of {', '.join(SAFE_FOOD_ORDERS)}.")
+    max_fructose = args.get("max_fructose", type=float)
+    if "max_fructose" in args and max_fructose is None:
+        raise ValueError("max_fructose must be a number of grams.")
+    limit = args.get("limit", 20, type=int)
+    offset = args.get("offset", 0, type=int)
+    if not 1 <= limit <= MAX_SAFE_FOODS_PAGE_SIZE or offset < 0:
+        raise ValueError(
+            f"limit must be between 1 and {MAX_SAFE_FOODS_PAGE_SIZE} and offset at least 0."
+        )
+    return dict(
+        order_by=order_by, max_fructose=max_fructose, limit=limit, offset=offset
+    )
+
+
+def build_safe_foods_result(page: dict, foods: list[dict]) -> dict:
+    """The requested page plus next_offset, which is None on the last page."""
+    return dict(
+        **page,
+        next_offset=page["offset"] + len(foods)
+        if len(foods) == page["limit"]
+        else None,
+        foods=foods,
+    )
+
+
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    """Counters and latency histograms of this process in the Prometheus text format."""
+    return registry.render(), 200, {"Content-Type": CONTENT_TYPE}
+
+
+def build_meal_result(batch_results) -> dict:
+    """Per food results plus the combined fructose for the meal. Foods without detailed sugars count their
+    total sugar towards the meal, matching the single food evaluation."""
+    foods = []
+    unmatched = []
+    meal_fructose = 0.0
+    n_grams_fructose_allowed = None
+    for search_query, NutrientResults in batch_results:
+        if NutrientResults is None:
+            unmatched.append(search_query)
+            continue
+        foods.append(build_ingredient_result(search_query, NutrientResults))
+        verdict = NutrientResults.verdict
+        if verdict.has_detailed_nutrients:
+            meal_fructose += verdict.total_fructose
+        else:
+            meal_fructose += verdict.total_sugar_from_api
+        n_grams_fructose_allowed = verdict.n_grams_fructose_allowed
+    return dict(
+        foods=foods,
+        unmatched=unmatched,
+        t_fructose=round(meal_fructose, 1),
+        under_limit=n_grams_fructose_allowed is not None
+        and meal_fructose <= n_grams_fructose_allowed,
+    )
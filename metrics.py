@@ -0,0 +1,305 @@
+"""Request timing spans, counters and histograms, served in the Prometheus text format at /metrics.
+
+Every process keeps its own figures; with several gunicorn workers each scrape sees the worker that answered it.
+"""
+import math
+import time
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Union
+
+# seconds; covers memory cache hits (well under a millisecond) up to Nutritionix timeouts
+DEFAULT_BUCKETS = (
+    0.0001,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+
+def escape_label_value(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(label_names: tuple, label_values: tuple, extra: str = "") -> str:
+    pairs = [
+        f'{name}="{escape_label_value(str(value))}"'
+        for name, value in zip(label_names, label_values)
+    ]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf"
+    return repr(float(value))
+
+
+class Counter:
+    """Monotonic count per label combination.
+
+    Args:
+    - name(String) - metric name, ending in _total by convention
+    - documentation(String) - HELP text
+    - label_names(tuple) - label keys every inc() must pass
+    """
+
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, label_names: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self._values: dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def label_values(self, labels: dict) -> tuple:
+        return tuple(labels[name] for name in self.label_names)
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self.label_values(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self.label_values(labels), 0.0)
+
+    def collect(self) -> list[str]:
+        with self._lock:
+            values = sorted(self._values.items())
+        if not values and not self.label_names:
+            values = [((), 0.0)]
+        return [
+            f"{self.name}{format_labels(self.label_names, key)} {format_value(value)}"
+            for key, value in values
+        ]
+
+
+class Histogram:
+    """Cumulative bucket counts, sum and count of observed values per label combination.
+
+    Args:
+    - buckets(tuple) - upper bounds, ascending; +Inf is added
+    """
+
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        label_names: tuple = (),
+        buckets: tuple = DEFAULT_BUCKETS,
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self.buckets = tuple(buckets) + (math.inf,)
+        self._values: dict[tuple, list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(labels[name] for name in self.label_names)
+        with self._lock:
+            entry = self._values.setdefault(key, [[0] * len(self.buckets), 0.0])
+            for index, upper_bound in enumerate(self.buckets):
+                if value <= upper_bound:
+                    entry[0][index] += 1
+                    break
+            entry[1] += value
+
+    def count(self, **labels) -> int:
+        key = tuple(labels[name] for name in self.label_names)
+        return sum(self._values.get(key, [[0], 0.0])[0])
+
+    def collect(self) -> list[str]:
+        with self._lock:
+            values = sorted(
+                (key, (list(bucket_counts), total))
+                for key, (bucket_counts, total) in self._values.items()
+            )
+        lines = []
+        for key, (bucket_counts, total) in values:
+            cumulative = 0
+            for upper_bound, bucket_count in zip(self.buckets, bucket_counts):
+                cumulative += bucket_count
+                le = f'le="{format_value(upper_bound)}"'
+                lines.append(
+                    f"{self.name}_bucket{format_labels(self.label_names, key, le)} {cumulative}"
+                )
+            lines.append(
+                f"{self.name}_sum{format_labels(self.label_names, key)} {format_value(total)}"
+            )
+            lines.append(
+                f"{self.name}_count{format_labels(self.label_names, key)} {cumulative}"
+            )
+        return lines
+
+
+class Gauge:
+    """A value read from function at scrape time."""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, function: Callable[[], float]):
+        self.name = name
+        self.documentation = documentation
+        self.function = function
+
+    def collect(self) -> list[str]:
+        return [f"{self.name} {format_value(self.function())}"]
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics: list[Union[Counter, Histogram, Gauge]] = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(
+        self, name: str, documentation: str, label_names: tuple = ()
+    ) -> Counter:
+        return self.register(Counter(name, documentation, label_names))
+
+    def histogram(
+        self,
+        name: str,
+        documentation: str,
+        label_names: tuple = (),
+        buckets: tuple = DEFAULT_BUCKETS,
+    ) -> Histogram:
+        return self.register(Histogram(name, documentation, label_names, buckets))
+
+    def gauge(
+        self, name: str, documentation: str, function: Callable[[], float]
+    ) -> Gauge:
+        return self.register(Gauge(name, documentation, function))
+
+    def render(self) -> str:
+        """The text exposition format read by Prometheus."""
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.collect())
+        return "\n".join(lines) + "\n"
+
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+registry = MetricsRegistry()
+
+cache_lookups = registry.counter(
+    "sophie_cache_lookups_total",
+    "Cache lookups by tier and result (hit, miss, or negative_hit for a cached no match answer).",
+    ("tier", "result"),
+)
+upstream_requests = registry.counter(
+    "sophie_upstream_requests_total",
+    "Nutritionix HTTP attempts by outcome (ok, retryable_status, connection_error, circuit_open, quota_exceeded, rejected).",
+    ("outcome",),
+)
+upstream_errors = registry.counter(
+    "sophie_upstream_errors_total",
+    "Nutritionix calls that raised UpstreamError after every retry.",
+)
+upstream_duration = registry.histogram(
+    "sophie_upstream_request_duration_seconds", "Duration of Nutritionix HTTP attempts."
+)
+upstream_calls_saved = registry.counter(
+    "sophie_upstream_calls_saved_total",
+    "Nutritionix calls avoided because the query was in the negative cache of unmatched foods.",
+)
+quarantined_searches = registry.counter(
+    "sophie_quarantined_searches_total",
+    "Cached searches moved to QuarantinedSearches because their payload or verdict could not be used.",
+)
+upstream_scheduled = registry.counter(
+    "sophie_upstream_scheduled_total",
+    "Nutritionix calls let through by the quota scheduler, by priority lane.",
+    ("lane",),
+)
+upstream_shed = registry.counter(
+    "sophie_upstream_shed_total",
+    "Nutritionix calls refused by the quota scheduler, by lane and reason (queue_full, timeout, daily_quota).",
+    ("lane", "reason"),
+)
+upstream_queue_wait = registry.histogram(
+    "sophie_upstream_queue_wait_seconds",
+    "Time a Nutritionix call waited for a quota token.",
+    ("lane",),
+)
+background_refreshes = registry.counter(
+    "sophie_background_refreshes_total",
+    "Background refreshes of stale cached searches by outcome (queued, duplicate, dropped, backoff, refreshed, failed).",
+    ("outcome",),
+)
+stage_duration = registry.histogram(
+    "sophie_stage_duration_seconds",
+    "Duration of each stage of resolving and rendering a search.",
+    ("stage",),
+)
+http_requests = registry.counter(
+    "sophie_http_requests_total",
+    "Responses by route, method and status.",
+    ("route", "method", "status"),
+)
+http_request_duration = registry.histogram(
+    "sophie_http_request_duration_seconds",
+    "Time from receiving a request to returning its response.",
+    ("route",),
+)
+
+# (stage, seconds) for each span of the current request; None outside a request
+request_spans: ContextVar[Union[list, None]] = ContextVar("request_spans", default=None)
+
+
+@contextmanager
+def span(stage: str):
+    """Times the enclosed block into stage_duration and the current request's Server-Timing breakdown."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - started
+        stage_duration.observe(duration, stage=stage)
+        spans = request_spans.get()
+        if spans is not None:
+            spans.append((stage, duration))
+
+
+def begin_request() -> float:
+    """Starts collecting spans for the current request and returns its start time."""
+    request_spans.set([])
+    return time.perf_counter()
+
+
+def finish_request(route: str, method: str, status: int, started: float) -> str:
+    """Records a finished request and returns its Server-Timing header value, with repeated stages summed."""
+    duration = time.perf_counter() - started
+    http_requests.inc(route=route, method=method, status=status)
+    http_request_duration.observe(duration, route=route)
+    totals: dict[str, float] = {}
+    for stage, stage_seconds in request_spans.get() or []:
+        totals[stage] = totals.get(stage, 0.0) + stage_seconds
+    totals["total"] = duration
+    request_spans.set(None)
+    return ", ".join(
+        f"{stage};dur={seconds * 1000:.2f}" for stage, seconds in totals.items()
+    )
@@ -1,338 +1,713 @@
+import os
 import json
-import sqlite3
 import logging
-import requests  # type: ignore
+from dataclasses import dataclass
+from difflib import SequenceMatcher
 from typing import Union
 
-logging.basicConfig(filename="mainlog.log", encoding="utf-8", level=logging.NOTSET)
+import db
+from cache import (
+    FRESHNESS_TTL_SECONDS,
+    NEGATIVE_CACHE_TTL_SECONDS,
+    freshness_checks,
+    nutrient_verdict_cache,
+    unmatched_query_cache,
+)
+from fooddata import build_food_response
+from logs import configure_logging
+from metrics import (
+    cache_lookups,
+    quarantined_searches,
+    registry,
+    span,
+    upstream_calls_saved,
+)
+from nutrients import (
+    N_GRAMS_FRUCTOSE_ALLOWED,
+    UNUSABLE_RESPONSE_ERRORS,
+    NutrientVerdict,
+    evaluate,
+    evaluate_materialized_verdict,
+    scale_materialized_verdict,
+)
+from queries import UNITS, ParsedQuery, parse_query
+from nutritionix import UpstreamError, nutritionix_client
+from quota import BACKGROUND, INTERACTIVE, upstream_scheduler
+from refresh import BackgroundRefresher
+from singleflight import fetch_once
+
+configure_logging()
+
+registry.gauge(
+    "sophie_memory_cache_entries",
+    "Verdicts held in this process's memory cache.",
+    lambda: len(nutrient_verdict_cache),
+)
+registry.gauge(
+    "sophie_upstream_circuit_open",
+    "1 while the Nutritionix circuit breaker is rejecting calls.",
+    lambda: float(nutritionix_client.circuit_breaker.state == "open"),
+)
+
+# cached foods whose name is less similar than this (difflib ratio) to the searched food are not used
+MIN_FUZZY_MATCH_RATIO = 0.88
+# cached sugar grams are rounded to 0.1, so scaling by a factor can be off by up to 0.05 * factor grams
+MAX_SCALED_ROUNDING_ERROR_GRAMS = 0.25
+
+
+class UnmatchedFoodError(KeyError):
+    """Nutritionix has no usable food for the query: no match, or a response that cannot be evaluated. A KeyError,
+    which the routes already answer with the no match page."""
+
+
+@dataclass(frozen=True, slots=True)
+class IngredientNutrientResult:
+    """A resolved query: the verdict for its food and, when it was fetched from the API, the raw response text to cache.
+
+    Args:
+    - search_query(String) - user entered search text
+    - verdict(NutrientVerdict) - nutrients and fructose verdict, see nutrients.evaluate()
+    - raw_response_from_api(String) - response body when the API was called, otherwise empty
+    - match_confidence(float) - 1.0 unless the verdict was borrowed from a similarly named cached food
+    - scaled(bool) - the verdict was scaled from a cached search for a different amount
+    - matched_query(String) - the cached search the verdict was derived from, if any
+    """
+
+    search_query: str
+    verdict: NutrientVerdict
+    raw_response_from_api: str = ""
+    match_confidence: float = 1.0
+    scaled: bool = False
+    matched_query: Union[str, None] = None
 
+    def insert_results_into_cache(self) -> bool:
+        """Queues an upsert of the query and search results into the SQLlite cache. Verdicts derived from another
+        cached search are not stored, so the cache only ever holds answers Nutritionix gave for the query itself."""
+        if self.matched_query is not None:
+            logging.debug(f"Not caching verdict derived from {self.matched_query}")
+            return False
+        with span("cache_write"):
+            db.cache_store.record_search(
+                self.search_query,
+                self.verdict.parsed_nutrient_response,
+                self.raw_response_from_api,
+                self.verdict.materialized_verdict,
+            )
+        logging.debug("Queued write to cache")
+        return True
 
-class IngredientNutrientResult:  # TODO should this be broken down in to subclasses?
-    """Main class to handle each query."""
-
-    def __init__(self, user_inputted_search_query: str):
-        """Creates search object and returns nutrients of object.
-
-        Args:
-        - search_query(String) - user entered search text
-        """
-        self.search_query: str = user_inputted_search_query
-        self.raw_response_from_api: str = ""
-        self.full_response_api: dict = self.get_nutrient_raw_response()
-        self.parsed_nutrient_response: dict[str, Union[float, str]] = {}
-
-        self.grams_fructose_per_single_serving_of_ingredient: float = 0.0
-        self.proportion_of_fructose_per_gram_of_ingredient: float = 0.0
-        self.total_fructose: float = 0.0  # total fructose
-
-        self.total_sugars_calculated: float = 0.0
-        self.total_sugar_from_api: float = 0.0
-
-        self.quantity_of_servings: float = 0.0
-        self.serving_unit = ""
-        self.total_weight_grams: float = 0.0
-
-        self.ingredient_name = ""
-
-        self.n_grams_fructose_allowed = 3
-
-        self.populate_parsed_ingredient_results()
-        self.set_allowable_limit_details()
 
-    def set_allowable_limit_details(self):
-        self.is_under_allowable_fructose_limit = (
-            self.evaluate_if_ingredient_is_under_allowable_fructose_limit()
-        )
-        if not self.is_under_allowable_fructose_limit:
-            (
-                self.grams_fructose_per_single_serving_of_ingredient,
-                self.proportion_of_fructose_per_gram_of_ingredient,
-            ) = self.get_allowed_amount_of_ingredient_under_limit()
-
-    def get_nutrient_raw_response(self) -> dict:
-        """Main application logic to handle calling API or Cache and parsing response into nutrients. If "Demo" is set to true when CallAPI object created - a stubbed response is loaded, otherwise, it attempts to call the cache. If no matche exists, it queries the live API."""
-        if not self.check_cache_for_match():
-            response = self.get_nutrient_data_from_api()
-            return response
-        else:
-            response = self.get_nutrient_data_from_cache()
-            if response is None:
-                raise TypeError
-            else:
-                return response
-
-    def populate_parsed_ingredient_results(self):
-        (
-            name,
-            serving_unit,
-            item,
-            measure,
-            quantity,
-            serving_weight_grams,
-            total_fructose,
-            total_glucose,
-            total_sucrose,
-            total_sugar,
-            total_fructose_calculated,
-            total_glucose_calculated,
-            total_sugar_calculated,
-        ) = self.parse_nutrient_data()
-        nutrient_response: dict[str, Union[float, str]] = {
-            "name": name,
-            "serving_unit": serving_unit,
-            "serving_size_grams": serving_weight_grams,
-            "item": item,
-            "measure": measure,
-            "quantity": quantity,
-            "fructose": total_fructose,
-            "glucose": total_glucose,
-            "sucrose": total_sucrose,
-            "t_fructose": total_fructose_calculated,
-            "t_glucose": total_glucose_calculated,
-            "t_sugar": total_sugar,
-            "t_sugar_calc": total_sugar_calculated,
-        }
-        self.parsed_nutrient_response = nutrient_response
-        self.total_fructose = float(total_fructose_calculated)
-        self.total_sugars_calculated = float(total_sugar_calculated)
-        self.total_sugar_from_api = float(total_sugar)
-        self.serving_unit = serving_unit
-        self.quantity_of_servings = float(quantity)
-        self.total_weight_grams = float(serving_weight_grams)
-        self.ingredient_name = name
-        self.has_detailed_nutrients = self.evaluate_granular_nutrients_exist()
-
-    def parse_nutrient_data(self):
-        name = self.full_response_api["foods"][0]["food_name"]
-        serving_unit = self.full_response_api["foods"][0]["serving_unit"]
-        item = self.full_response_api["foods"][0]["tags"]["item"]
-        measure = self.full_response_api["foods"][0]["tags"]["measure"]
-        quantity = self.full_response_api["foods"][0]["tags"]["quantity"]
-        serving_weight_grams = self.full_response_api["foods"][0][
-            "serving_weight_grams"
+def materialize_verdict_from_response(response: dict) -> dict:
+    """Parses a raw API response into the fields stored by the verdict backfill in db.py."""
+    return evaluate(response).materialized_verdict
+
+
+def lookup_cached_verdict(search_query: str) -> Union[dict, None]:
+    """Returns the precomputed nutrient fields for the query from the memory cache or, failing that, the SQLite cache."""
+    verdict = lookup_memory_verdict(search_query)
+    if verdict is None:
+        verdict = lookup_sqlite_verdict(search_query)
+    elif take_freshness_check(search_query):
+        refresh_if_stale(search_query)
+    return verdict
+
+
+def lookup_memory_verdict(search_query: str) -> Union[dict, None]:
+    with span("memory_lookup"):
+        verdict = nutrient_verdict_cache.get(db.normalize_query(search_query))
+    if verdict is not None:
+        logging.debug("Match in memory cache")
+    cache_lookups.inc(tier="memory", result="miss" if verdict is None else "hit")
+    return verdict
+
+
+def lookup_sqlite_verdict(search_query: str) -> Union[dict, None]:
+    """Returns the materialized verdict stored in SQLite for the query and keeps it in the memory cache."""
+    with span("sqlite_verdict_lookup"):
+        verdict = db.cache_store.lookup_verdict(search_query)
+    if verdict is not None:
+        logging.debug("Returned materialized verdict from cache")
+        cache_lookups.inc(tier="sqlite_verdict", result="hit")
+        nutrient_verdict_cache.set(db.normalize_query(search_query), verdict)
+        refresh_if_stale(search_query)
+    else:
+        cache_lookups.inc(tier="sqlite_verdict", result="miss")
+    return verdict
+
+
+def split_search_queries(search_queries: str) -> list[str]:
+    """Splits newline separated user input into one query per non blank line."""
+    return [line.strip() for line in search_queries.splitlines() if line.strip()]
+
+
+def match_foods_to_queries(foods: list[dict], search_queries: list[str]) -> dict:
+    """Maps each food in a combined natural language response back to the query line it came from.
+
+    A food belongs to an unclaimed line whose food words (see queries.parse_query()) include every word of the
+    food's name or item: "ham" matches "ham and eggs" but not "graham cracker", and "apple" not "pineapple". A line
+    naming exactly the food wins over lines that only mention it; a food that still fits several lines is dropped
+    rather than guessed, so a wrong verdict never reaches the cache. Position alone is never trusted: with one line
+    matching nothing and another producing two foods ("xyzzy", "ham and eggs") the counts still agree, and zipping
+    would give "xyzzy" the verdict for ham.
+    """
+    query_words = {
+        search_query: frozenset(parse_query(search_query).food.split())
+        for search_query in search_queries
+    }
+    matched: dict = {}
+    for food in foods:
+        names = {
+            frozenset(parse_query(name).food.split())
+            for name in (food.get("food_name"), (food.get("tags") or {}).get("item"))
+            if isinstance(name, str)
+        } - {frozenset()}
+        candidates = [
+            search_query
+            for search_query in search_queries
+            if search_query not in matched
+            and any(name <= query_words[search_query] for name in names)
+        ]
+        exact = [
+            search_query
+            for search_query in candidates
+            if query_words[search_query] in names
         ]
-        total_fructose = round(self.get_total_fructose(), 1)
-        total_glucose = round(self.get_total_glucose(), 1)
-        total_sucrose = round(self.get_total_sucrose(), 1)
-        total_sugar = round(self.get_total_sugar(), 1)
-        total_fructose_calculated = round(total_fructose + (total_sucrose / 2), 1)
-        total_glucose_calculated = round(total_glucose + (total_sucrose / 2), 1)
-        total_sugar_calculated = total_fructose + total_glucose + total_sucrose
-        return (
-            name,
-            serving_unit,
-            item,
-            measure,
-            quantity,
-            serving_weight_grams,
-            total_fructose,
-            total_glucose,
-            total_sucrose,
-            total_sugar,
-            total_fructose_calculated,
-            total_glucose_calculated,
-            total_sugar_calculated,
+        if len(exact) == 1:
+            matched[exact[0]] = food
+        elif len(candidates) == 1:
+            matched[candidates[0]] = food
+        elif candidates:
+            logging.debug(f"Dropped ambiguous batch food for lines {candidates}")
+    return matched
+
+
+def get_nutrient_data_from_cache(search_query: str) -> Union[dict, None]:
+    """Returns the raw API response cached in SQLite for the query, or None if there is no usable one. Rows whose
+    payload cannot be decoded or parsed are quarantined."""
+    logging.debug(f"Search query: {search_query}.")
+    try:
+        with span("sqlite_raw_lookup"):
+            raw = db.cache_store.lookup_raw_response(search_query)
+        if raw is None:
+            logging.debug("No match in cache")
+            cache_lookups.inc(tier="sqlite_raw", result="miss")
+            return None
+        with span("json_parse"):
+            response = json.loads(raw)
+        if not isinstance(response, dict):
+            raise ValueError(f"Expected a JSON object, got {type(response).__name__}")
+    except ValueError as error:
+        quarantine_cached_search(search_query, f"Unreadable payload: {error}")
+        cache_lookups.inc(tier="sqlite_raw", result="miss")
+        return None
+    if response == {}:
+        logging.debug("No match in cache")
+        cache_lookups.inc(tier="sqlite_raw", result="miss")
+        return None
+    logging.debug("Returned response from cache")
+    refresh_if_stale(search_query)
+    # a stored "couldn't match any of your foods" answer settles the query without an API call
+    cache_lookups.inc(
+        tier="sqlite_raw", result="hit" if response.get("foods") else "negative_hit"
+    )
+    return response
+
+
+def quarantine_cached_search(search_query: str, reason: str):
+    """Stops serving a cached search that cannot be used; the next search for it goes to Nutritionix again."""
+    logging.warning(f"Quarantining cached search {search_query!r}: {reason}")
+    nutrient_verdict_cache.invalidate(db.normalize_query(search_query))
+    if db.cache_store.quarantine_search(search_query, reason):
+        quarantined_searches.inc()
+
+
+def lookup_unmatched_query(search_query: str) -> bool:
+    """Whether Nutritionix recently had no usable food for the query, in this process or any other worker."""
+    cache_key = db.normalize_query(search_query)
+    with span("negative_lookup"):
+        reason = unmatched_query_cache.get(cache_key)
+        if reason is None:
+            reason = db.cache_store.lookup_unmatched_query(search_query)
+            if reason is not None:
+                unmatched_query_cache.set(cache_key, reason)
+    cache_lookups.inc(tier="negative", result="miss" if reason is None else "hit")
+    if reason is not None:
+        logging.debug(f"Match in negative cache: {reason}")
+    return reason is not None
+
+
+def remember_unmatched_query(search_query: str, reason: str):
+    """Adds the query to the negative cache for NEGATIVE_CACHE_TTL_SECONDS."""
+    logging.debug(f"No usable food for {search_query!r}: {reason}")
+    unmatched_query_cache.set(db.normalize_query(search_query), reason)
+    db.cache_store.record_unmatched_query(
+        search_query, reason, NEGATIVE_CACHE_TTL_SECONDS
+    )
+
+
+def evaluate_cached_verdict(
+    search_query: str,
+    verdict: dict,
+    n_grams_fructose_allowed: float = N_GRAMS_FRUCTOSE_ALLOWED,
+) -> Union[IngredientNutrientResult, None]:
+    """Evaluates a materialized verdict from the cache. Returns None, after quarantining its row, if it cannot be."""
+    try:
+        with span("evaluate"):
+            return IngredientNutrientResult(
+                search_query,
+                evaluate_materialized_verdict(verdict, n_grams_fructose_allowed),
+            )
+    except UNUSABLE_RESPONSE_ERRORS as error:
+        quarantine_cached_search(search_query, f"Unusable verdict: {error!r}")
+        return None
+
+
+def evaluate_cached_response(
+    search_query: str,
+    response: dict,
+    n_grams_fructose_allowed: float = N_GRAMS_FRUCTOSE_ALLOWED,
+) -> Union[IngredientNutrientResult, None]:
+    """Evaluates a raw response from the cache. Raises UnmatchedFoodError for a stored no match answer and returns
+    None, after quarantining its row, for a stored food that cannot be evaluated."""
+    if not response.get("foods"):
+        raise UnmatchedFoodError(search_query)
+    try:
+        with span("evaluate"):
+            return IngredientNutrientResult(
+                search_query, evaluate(response, n_grams_fructose_allowed)
+            )
+    except UNUSABLE_RESPONSE_ERRORS as error:
+        quarantine_cached_search(search_query, f"Unusable payload: {error!r}")
+        return None
+
+
+def evaluate_api_response(
+    search_query: str,
+    raw_response_from_api: str,
+    n_grams_fructose_allowed: float = N_GRAMS_FRUCTOSE_ALLOWED,
+) -> IngredientNutrientResult:
+    """Parses and evaluates a Nutritionix response. Raises UnmatchedFoodError when it has no usable food, after
+    adding the query to the negative cache if the response is a no match answer (no foods at all)."""
+    response = None
+    try:
+        with span("json_parse"):
+            response = json.loads(raw_response_from_api)
+        with span("evaluate"):
+            return IngredientNutrientResult(
+                search_query,
+                evaluate(response, n_grams_fructose_allowed),
+                raw_response_from_api,
+            )
+    except UNUSABLE_RESPONSE_ERRORS as error:
+        if isinstance(response, dict) and not response.get("foods"):
+            # Nutritionix explains a miss in "message", e.g. "We couldn't match any of your foods"
+            remember_unmatched_query(
+                search_query, response.get("message") or "No foods in response"
+            )
+        else:
+            # a body that is not a food list could be anything; asking again later is cheaper than a wrong miss
+            logging.warning(
+                f"Unusable Nutritionix response for {search_query!r}: {error!r}"
+            )
+        raise UnmatchedFoodError(search_query) from error
+
+
+def get_cached_unit(serving_unit: Union[str, None]) -> Union[str, None]:
+    """Maps a cached serving unit ("cups", "tbsp", 'medium (3" dia)') to a queries.UNITS unit, None for counted foods."""
+    words = (serving_unit or "").lower().replace(",", " ").split()
+    return UNITS.get(words[0]) if words else None
+
+
+def choose_scalable_verdict(
+    parsed_query: ParsedQuery, candidates: list[dict]
+) -> Union[tuple[dict, float], None]:
+    """Picks the cached verdict (see db.lookup_food_matches) that can answer a parsed query, and the factor to scale
+    it by. Searches without an amount only reuse searches without an amount, since both got Nutritionix's default
+    serving. Otherwise the units must agree; a verdict for the same amount wins, then the heaviest serving, whose
+    rounded sugar figures lose the least precision when scaled. Verdicts that would need scaling up too far for
+    their rounding to stay within MAX_SCALED_ROUNDING_ERROR_GRAMS are skipped, and so are verdicts for another size
+    ("3 large apples" is never scaled from "2 apples", which Nutritionix answers with medium ones)."""
+    best_match = None
+    for candidate in candidates:
+        cached_query = parse_query(candidate["query"])
+        if cached_query.size != parsed_query.size:
+            continue
+        if parsed_query.quantity is None:
+            if cached_query.quantity is None and cached_query.unit == parsed_query.unit:
+                return candidate, 1.0
+            continue
+        if get_cached_unit(candidate["serving_unit"]) != parsed_query.unit:
+            continue
+        try:
+            cached_quantity = float(candidate["quantity"])
+            cached_weight = float(candidate["serving_size_grams"])
+        except (TypeError, ValueError):
+            continue
+        if cached_quantity <= 0:
+            continue
+        factor = parsed_query.quantity / cached_quantity
+        if factor == 1:
+            return candidate, 1.0
+        if factor * 0.05 > MAX_SCALED_ROUNDING_ERROR_GRAMS:
+            continue
+        if best_match is None or cached_weight > best_match[2]:
+            best_match = (candidate, factor, cached_weight)
+    return None if best_match is None else best_match[:2]
+
+
+def lookup_similar_verdict(
+    search_query: str, n_grams_fructose_allowed: float = N_GRAMS_FRUCTOSE_ALLOWED
+) -> Union[IngredientNutrientResult, None]:
+    """Answers a query from a cached search for the same food, scaled to the requested amount: "3 apples" from
+    "2 apples", "blueberries" from "blueberry". Falls back to the most similar food name in the trigram index,
+    e.g. "bluebery", with the similarity as the match confidence. Returns None when no cached search fits."""
+    with span("similar_lookup"):
+        result = find_similar_verdict(search_query, n_grams_fructose_allowed)
+    cache_lookups.inc(tier="similar", result="miss" if result is None else "hit")
+    return result
+
+
+def find_similar_verdict(
+    search_query: str, n_grams_fructose_allowed: float
+) -> Union[IngredientNutrientResult, None]:
+    """lookup_similar_verdict() without the timing span and counter."""
+    parsed_query = parse_query(search_query)
+    if not parsed_query.food:
+        return None
+    match = choose_scalable_verdict(
+        parsed_query, db.cache_store.lookup_food_matches(parsed_query.food)
+    )
+    match_confidence = 1.0
+    if match is None:
+        similar_foods = sorted(
+            (
+                (SequenceMatcher(None, parsed_query.food, food).ratio(), food)
+                for food in db.cache_store.search_similar_foods(parsed_query.food)
+                if food != parsed_query.food
+            ),
+            reverse=True,
         )
-
-    def insert_results_into_cache(self) -> bool:
-        """Inserts query and search results into SQLlite DB using the response store in nute_response"""
-        connection = sqlite3.connect("searches.db")
-        f1 = self.search_query
-        name_v = self.parsed_nutrient_response["name"]
-        su_v = self.parsed_nutrient_response["serving_unit"]
-        ss = self.parsed_nutrient_response["serving_size_grams"]
-        i = self.parsed_nutrient_response["item"]
-        m = self.parsed_nutrient_response["measure"]
-        q = self.parsed_nutrient_response["quantity"]
-        f = self.parsed_nutrient_response["fructose"]
-        g = self.parsed_nutrient_response["glucose"]
-        s = self.parsed_nutrient_response["sucrose"]
-        raw = self.raw_response_from_api
-        cursor = connection.cursor()
-        cursor.execute(
-            """INSERT INTO searches (name,serving_unit,serving_size_grams,item,measure,quantity,fructose_n,glucose_n,sucrose,query,raw) VALUES (?,?,?,?,?,?,?,?,?,?,?);""",
-            (name_v, su_v, ss, i, m, q, f, g, s, f1, raw),
+        for ratio, food in similar_foods:
+            if ratio < MIN_FUZZY_MATCH_RATIO:
+                break
+            match = choose_scalable_verdict(
+                parsed_query, db.cache_store.lookup_food_matches(food)
+            )
+            if match is not None:
+                match_confidence = round(ratio, 2)
+                break
+    if match is None:
+        return None
+    candidate, factor = match
+    verdict = {key: candidate[key] for key in db.MATERIALIZED_VERDICT_COLUMNS}
+    # only searches with an amount are ever scaled
+    if factor != 1 and parsed_query.quantity is not None:
+        verdict = scale_materialized_verdict(verdict, factor, parsed_query.quantity)
+    logging.debug(
+        f"Derived verdict from cached search {candidate['query']} (x{factor:g}, confidence {match_confidence})"
+    )
+    return IngredientNutrientResult(
+        search_query,
+        evaluate_materialized_verdict(verdict, n_grams_fructose_allowed),
+        match_confidence=match_confidence,
+        scaled=factor != 1,
+        matched_query=candidate["query"],
+    )
+
+
+def get_nutrient_data_from_local_foods(search_query: str) -> Union[dict, None]:
+    """Returns the food imported by fooddata.py that the query names (see db.lookup_local_food()) as an API shaped
+    response, or None."""
+    with span("local_foods_lookup"):
+        local_food = db.cache_store.lookup_local_food(search_query)
+    if local_food is None:
+        cache_lookups.inc(tier="local_foods", result="miss")
+        return None
+    cache_lookups.inc(tier="local_foods", result="hit")
+    logging.debug("Match in local food database")
+    return build_food_response(local_food)
+
+
+def list_safe_foods(
+    order_by: str = "fructose_per_serving",
+    max_fructose: Union[float, None] = None,
+    limit: int = 20,
+    offset: int = 0,
+) -> list[dict]:
+    """One page of cached foods, lowest fructose first, read from the SafeFoods index (see db.list_safe_foods)."""
+    with span("safe_foods_lookup"):
+        return db.cache_store.list_safe_foods(
+            order_by=order_by, max_fructose=max_fructose, limit=limit, offset=offset
         )
-        connection.commit()
-        logging.debug("Successfully wrote to cache")
-        return True
 
-    def get_nutrient_data_from_api(self) -> dict:
-        """Handles the querying of the API, storing the response in json_response, and saving the last response to a text file for use in "demo mode"."""
-        payload = json.dumps(
-            {
-                "query": self.search_query,
-                "use_raw_foods": False,
-                "include_subrecipe": False,
-                "meal_type": 0,
-                "use_branded_foods": False,
-                "locale": "en_US",
-                "taxonomy": False,
-                "ingredient_statement": True,
-                "last_modified": False,
-            }
+
+def get_nutrient_data_from_api(search_query: str, lane: str = INTERACTIVE) -> str:
+    """Queries the API through the shared pooled client and returns the raw response text. Concurrent requests for the same
+    query share one call, which waits for a quota token in lane (see quota.UpstreamScheduler). Raises
+    nutritionix.UpstreamError when the API cannot be reached or the call is shed (quota.QuotaExceededError)."""
+    with span("upstream_fetch"):
+        raw_response_from_api = fetch_once(
+            search_query,
+            lambda: upstream_scheduler.call(
+                lane,
+                lambda acquire: nutritionix_client.fetch_natural_nutrients(
+                    search_query, acquire
+                ),
+            ),
+        )
+    logging.debug("Successful API call")
+    return raw_response_from_api
+
+
+def refresh_cached_search(search_query: str):
+    """Fetches a new payload for a cached query in the background lane and stores it over the cached row without
+    counting a search. Raises like get_nutrient_data_from_api() and evaluate_api_response(), leaving the row as is."""
+    raw_response_from_api = get_nutrient_data_from_api(search_query, lane=BACKGROUND)
+    result = evaluate_api_response(search_query, raw_response_from_api)
+    db.cache_store.update_cached_response(
+        search_query,
+        result.verdict.parsed_nutrient_response,
+        raw_response_from_api,
+        result.verdict.materialized_verdict,
+    )
+    nutrient_verdict_cache.set(
+        db.normalize_query(search_query), result.verdict.materialized_verdict
+    )
+
+
+background_refresher = BackgroundRefresher(
+    refresh_cached_search,
+    max_workers=int(os.environ.get("CACHE_REFRESH_WORKERS", "2")),
+    max_pending=int(os.environ.get("CACHE_REFRESH_QUEUE_SIZE", "64")),
+    backoff_seconds=float(os.environ.get("CACHE_REFRESH_BACKOFF_SECONDS", "60")),
+)
+
+
+def refresh_if_stale(search_query: str):
+    """Queues a background refresh when the payload cached for the query is older than FRESHNESS_TTL_SECONDS. The
+    caller serves the cached answer either way."""
+    if FRESHNESS_TTL_SECONDS <= 0:
+        return
+    with span("freshness_check"):
+        stale = db.cache_store.needs_refresh(search_query, FRESHNESS_TTL_SECONDS)
+    freshness_checks.set(db.normalize_query(search_query), True)
+    if stale:
+        logging.debug(f"Serving stale cache entry for {search_query!r}")
+        background_refresher.submit(search_query)
+
+
+def take_freshness_check(search_query: str) -> bool:
+    """Whether a memory cache hit for the query should call refresh_if_stale(): true for the first hit per
+    CACHE_FRESHNESS_CHECK_INTERVAL_SECONDS (see cache.py), so most hits do not read searches.db."""
+    if FRESHNESS_TTL_SECONDS <= 0:
+        return False
+    key = db.normalize_query(search_query)
+    if freshness_checks.get(key) is not None:
+        return False
+    freshness_checks.set(key, True)
+    return True
+
+
+def lookup_memory_result(
+    search_query: str, n_grams_fructose_allowed: float = N_GRAMS_FRUCTOSE_ALLOWED
+) -> Union[IngredientNutrientResult, None]:
+    """The first tier of resolve_ingredient(): evaluates the verdict held in the memory cache for the query. Does no
+    I/O, so the async path calls it on the event loop. An entry that cannot be evaluated is dropped and left for
+    lookup_stored_result() to quarantine. Returns None on a miss."""
+    verdict = lookup_memory_verdict(search_query)
+    if verdict is None:
+        return None
+    try:
+        with span("evaluate"):
+            return IngredientNutrientResult(
+                search_query,
+                evaluate_materialized_verdict(verdict, n_grams_fructose_allowed),
+            )
+    except UNUSABLE_RESPONSE_ERRORS:
+        nutrient_verdict_cache.invalidate(db.normalize_query(search_query))
+        return None
+
+
+def lookup_stored_result(
+    search_query: str, n_grams_fructose_allowed: float = N_GRAMS_FRUCTOSE_ALLOWED
+) -> Union[IngredientNutrientResult, None]:
+    """The tiers of resolve_ingredient() that read searches.db: the SQLite cache, the negative cache, cached searches
+    for the same or a similar food and the local food database. Cached rows that cannot be evaluated are quarantined
+    and skipped; stale SQLite hits are served as they are and refreshed in the background (see refresh_if_stale()).
+    Returns None when the query has to be fetched from Nutritionix.
+
+    Raises UnmatchedFoodError (a KeyError) when the food is known to have no match.
+    """
+    cache_key = db.normalize_query(search_query)
+    verdict = lookup_sqlite_verdict(search_query)
+    if verdict is not None:
+        result = evaluate_cached_verdict(
+            search_query, verdict, n_grams_fructose_allowed
         )
-        headers = {
-            "x-app-key": "",
-            "x-app-id": "",
-            "x-remote-user-id": "0",
-            "Content-Type": "application/json",
-        }
-        raw_response_from_nutritionix_API = requests.post(
-            "https://trackapi.nutritionix.com/v2/natural/nutrients",
-            headers=headers,
-            data=payload,
+        if result is not None:
+            return result
+    response = get_nutrient_data_from_cache(search_query)
+    if response is not None:
+        result = evaluate_cached_response(
+            search_query, response, n_grams_fructose_allowed
         )
-        self.raw_response_from_api = raw_response_from_nutritionix_API.text
-        response_json = json.loads(raw_response_from_nutritionix_API.text)
-        logging.debug("Successful API call")
-        logging.debug(response_json)
-        return response_json
-
-    def check_cache_for_match(self):
-        connection = sqlite3.connect("searches.db")
-        cursor = connection.cursor()
-        sq = self.search_query.lower()
-        logging.debug(f"User entered search: {self.search_query}")
-        cursor.execute(
-            "SELECT lower(raw) FROM Searches WHERE query = ? and raw != '' LIMIT 1",
-            (sq,),
+        if result is not None:
+            nutrient_verdict_cache.set(cache_key, result.verdict.materialized_verdict)
+            return result
+    if lookup_unmatched_query(search_query):
+        upstream_calls_saved.inc()
+        raise UnmatchedFoodError(search_query)
+    similar_result = lookup_similar_verdict(search_query, n_grams_fructose_allowed)
+    if similar_result is not None:
+        return similar_result
+    response = get_nutrient_data_from_local_foods(search_query)
+    if response is None:
+        return None
+    with span("evaluate"):
+        result = IngredientNutrientResult(
+            search_query, evaluate(response, n_grams_fructose_allowed)
         )
+    nutrient_verdict_cache.set(cache_key, result.verdict.materialized_verdict)
+    return result
+
+
+def lookup_stale_result(
+    search_query: str, n_grams_fructose_allowed: float = N_GRAMS_FRUCTOSE_ALLOWED
+) -> Union[IngredientNutrientResult, None]:
+    """An expired memory cache entry for the query, served rather than an error while Nutritionix is unhealthy."""
+    stale_verdict = nutrient_verdict_cache.get_stale(db.normalize_query(search_query))
+    if stale_verdict is None:
+        return None
+    logging.debug("Nutritionix unavailable - serving stale cache entry")
+    cache_lookups.inc(tier="memory", result="stale_hit")
+    return IngredientNutrientResult(
+        search_query,
+        evaluate_materialized_verdict(stale_verdict, n_grams_fructose_allowed),
+    )
+
+
+def resolve_ingredient(
+    search_query: str,
+    n_grams_fructose_allowed: float = N_GRAMS_FRUCTOSE_ALLOWED,
+    lane: str = INTERACTIVE,
+) -> IngredientNutrientResult:
+    """Looks up the query in the memory cache, then the tiers stored in searches.db (see lookup_stored_result()) and
+    then the API, and evaluates the food it resolves to. An API call waits for a quota token in lane.
+
+    Raises UnmatchedFoodError (a KeyError) when the food could not be matched and nutritionix.UpstreamError when the
+    API is unavailable and no expired memory cache entry exists for the query.
+    """
+    logging.debug(f"User entered search: {search_query}")
+    result = lookup_memory_result(search_query, n_grams_fructose_allowed)
+    if result is None:
+        result = lookup_stored_result(search_query, n_grams_fructose_allowed)
+    elif take_freshness_check(search_query):
+        refresh_if_stale(search_query)
+    if result is not None:
+        return result
+    try:
+        raw_response_from_api = get_nutrient_data_from_api(search_query, lane)
+    except UpstreamError:
+        result = lookup_stale_result(search_query, n_grams_fructose_allowed)
+        if result is None:
+            raise
+        return result
+    result = evaluate_api_response(
+        search_query, raw_response_from_api, n_grams_fructose_allowed
+    )
+    nutrient_verdict_cache.set(
+        db.normalize_query(search_query), result.verdict.materialized_verdict
+    )
+    return result
+
+
+def resolve_ingredient_batch(
+    search_queries: list[str], lane: str = INTERACTIVE
+) -> list[tuple[str, Union[IngredientNutrientResult, None]]]:
+    """Resolves a list of foods with at most one Nutritionix call.
+
+    Cache hits are built from their materialized verdict or cached raw response, then from cached searches for the
+    same or a similar food (see lookup_similar_verdict()), then foods in the local food database are evaluated; every remaining miss is sent in a single newline separated natural language query and each entry of the response's foods is parsed.
+    Returns (query, result) for every input line, in order, with None for foods that could not be matched.
+    Raises nutritionix.UpstreamError when misses exist and Nutritionix is unavailable or the call for lane is shed.
+    """
+    results: dict[str, Union[IngredientNutrientResult, None]] = {}
+    misses: list[str] = []
+    negative_hits = 0
+    for search_query in dict.fromkeys(search_queries):
+        verdict = lookup_cached_verdict(search_query)
+        if verdict is not None:
+            result = evaluate_cached_verdict(search_query, verdict)
+            if result is not None:
+                results[search_query] = result
+                continue
+        response = get_nutrient_data_from_cache(search_query)
+        if response is not None:
+            try:
+                result = evaluate_cached_response(search_query, response)
+            except UnmatchedFoodError:
+                results[search_query] = None
+                continue
+            if result is not None:
+                results[search_query] = result
+                continue
+        if lookup_unmatched_query(search_query):
+            negative_hits += 1
+            results[search_query] = None
+            continue
+        similar_result = lookup_similar_verdict(search_query)
+        if similar_result is not None:
+            results[search_query] = similar_result
+            continue
+        response = get_nutrient_data_from_local_foods(search_query)
+        if response is None:
+            misses.append(search_query)
+            continue
         try:
-            q = cursor.fetchone()[0]
-            q = json.loads(q)
-            if q != (None or {}):
-                logging.debug("Match in cache")
-                return True
-            else:
-                logging.debug("No match in cache")
-                logging.debug(q)
-                return False
-        except:
-            logging.debug("No match in cache - exception")
-            return False
-
-    def get_nutrient_data_from_cache(self) -> Union[dict, None]:
-        connection = sqlite3.connect("searches.db")
-        cursor = connection.cursor()
-        sq = self.search_query.lower()
-        logging.debug(f"Search query: {self.search_query}.")
-        cursor.execute(
-            "SELECT lower(raw) FROM Searches WHERE query = ? and raw != '' LIMIT 1",
-            (sq,),
+            results[search_query] = IngredientNutrientResult(
+                search_query, evaluate(response)
+            )
+        except UNUSABLE_RESPONSE_ERRORS:
+            # an imported food that cannot be evaluated is asked of Nutritionix instead
+            misses.append(search_query)
+
+    if negative_hits and not misses:
+        upstream_calls_saved.inc()
+    if misses:
+        combined_query = "\n".join(misses)
+        raw_response_from_api = fetch_once(
+            combined_query,
+            lambda: upstream_scheduler.call(
+                lane,
+                lambda acquire: nutritionix_client.fetch_natural_nutrients(
+                    combined_query, acquire
+                ),
+            ),
+            namespace="batch",
         )
+        logging.debug(f"Resolved {len(misses)} cache misses in one API call")
         try:
-            query = cursor.fetchone()[0]
-            query = json.loads(query)
-            if query != (None or {}):
-                logging.debug("Returned response from cache")
-                return query
-            else:
-                logging.debug("No match in cache - else")
-                logging.debug(query)
-                return None
-        except:
-            logging.debug("No match in cache - exception")
-            return None
-
-    def parse_ingredient_details(self) -> tuple:
-        """Parses json response into fields to set class variables"""
-        food_name = self.full_response_api["foods"][0]["food_name"]
-        serving_unit = self.full_response_api["foods"][0]["serving_unit"]
-        item = self.full_response_api["foods"][0]["tags"]["item"]
-        measure = self.full_response_api["foods"][0]["tags"]["measure"]
-        quantity = self.full_response_api["foods"][0]["tags"]["quantity"]
-        serving_weight_grams = self.full_response_api["foods"][0][
-            "serving_weight_grams"
-        ]
-        return food_name, serving_unit, serving_weight_grams, item, measure, quantity
-
-    def extract_nutrient_details(self, nutrient_id: int) -> int:
-        """Iterates over the set of nutrients in API response and returns the value for the nutrient id set in the attr_id param."""
-        nutrient_value = 0
-        nutrients = self.full_response_api["foods"][0]
-        for nutrient in nutrients["full_nutrients"]:
-            if nutrient["attr_id"] == nutrient_id:
-                nutrient_value = nutrient["value"]
-        if nutrient_value != 0:
-            return nutrient_value
-        else:
-            return 0
-
-    # TODO -  reduce these 5 methods dwon into a single list to pass into nutrient_search() method
-    def get_total_fructose(self) -> int:
-        nutrient_value = self.extract_nutrient_details(212)
-        return nutrient_value
-
-    def get_total_glucose(self) -> int:
-        nutrient_value = self.extract_nutrient_details(211)
-        return nutrient_value
-
-    def get_total_sucrose(self) -> int:
-        nutrient_value = self.extract_nutrient_details(210)
-        return nutrient_value
-
-    def get_total_sugar(self) -> int:
-        nutrient_value = self.extract_nutrient_details(269)
-        return nutrient_value
-
-    def evaluate_if_ingredient_is_under_allowable_fructose_limit(self) -> bool:
-        """Determines if a queried food is within fructose limit, handling the nuance of when the API returns granular sugar type details (details == True) and when it does not.
-        If it does not, it defaults to using the overall sugar quantity. This is risk adverse, but safer."""
-
-        if (
-            self.has_detailed_nutrients
-            and self.total_fructose <= self.n_grams_fructose_allowed
-        ):
-            self.is_under_allowable_fructose_limit = True
-            return self.is_under_allowable_fructose_limit
-
-        elif (
-            not self.has_detailed_nutrients
-            and self.total_sugar_from_api <= self.n_grams_fructose_allowed
-        ):
-            self.is_under_allowable_fructose_limit = True
-            return self.is_under_allowable_fructose_limit
-        else:
-            self.is_under_allowable_fructose_limit = False
-            return self.is_under_allowable_fructose_limit
-
-    def evaluate_granular_nutrients_exist(self) -> bool:
-        """Checks to see if granular details of sugars exist (quantity of any sugar is >0) and that the total sugar response from the API is not zero.
-        If this is true, we can assume that the food is either: not devoid of sugar or the api did not return detailed sugar amounts."""
-        if self.total_sugars_calculated == 0 and self.total_sugar_from_api != 0:
-            has_detailed_nutrients = False
-        else:
-            has_detailed_nutrients = True
-        print(f"detailed_nutrients is {has_detailed_nutrients}.")
-        print(f"total_sugar_calc is {self.total_sugars_calculated}.")
-        print(f"total_sugar_api is {self.total_sugar_from_api}.")
-        return has_detailed_nutrients
-
-    def get_allowed_amount_of_ingredient_under_limit(
-        self,
-    ) -> tuple[
-        float,
-        float,
-    ]:  # TODO this more complicated than it needs to be - can probably refactor to simplify
-        """Determines how much of a serving of a food can be eaten while keeping the quantity under the fructose limit."""
-        # if api returns granular fructose use that - otherwise, use the total sugar quantity #TODO should likely handle this at the class level rather then in this method
-        if self.total_fructose == 0:
-            total_fructose_adjusted = self.total_sugar_from_api
-        else:
-            total_fructose_adjusted = self.total_fructose
-
-        # determine amount of grams in a single serving by dividing the returned weight (n quantity of food) by the quantity (n)
-        grams_single_serving = self.total_weight_grams / self.quantity_of_servings
-
-        # determine amount of fructose in a single serving by dividing the returned amount of fructose (n quantity of food) by the quantity (n)
-        fructose_single_serving = total_fructose_adjusted / self.quantity_of_servings
-
-        # determine amount of fructose per gram of food by dividing the returned grams of fructose in a single serving by the grams of a single serving
-        fructose_per_gram = fructose_single_serving / grams_single_serving
-
-        # determine proportion of total allowed fructose within a single gram of food
-        f_serving_grams = self.n_grams_fructose_allowed / fructose_per_gram
-        serving_unit_proportion = f_serving_grams / grams_single_serving
-
-        return f_serving_grams, serving_unit_proportion
+            foods = json.loads(raw_response_from_api).get("foods", [])
+        except (AttributeError, ValueError):
+            foods = []
+        matched_foods = match_foods_to_queries(foods, misses)
+        for search_query in misses:
+            food = matched_foods.get(search_query)
+            if food is None:
+                # with some foods returned, an unplaced line may be a food we failed to match it to
+                if not foods:
+                    remember_unmatched_query(search_query, "No food in batch response")
+                results[search_query] = None
+                continue
+            single_food_response = json.dumps({"foods": [food]})
+            try:
+                result = evaluate_api_response(search_query, single_food_response)
+            except UnmatchedFoodError:
+                results[search_query] = None
+                continue
+            nutrient_verdict_cache.set(
+                db.normalize_query(search_query), result.verdict.materialized_verdict
+            )
+            results[search_query] = result
+
+    return [(search_query, results[search_query]) for search_query in search_queries]
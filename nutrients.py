@@ -0,0 +1,464 @@
+"""Nutrient extraction and fructose verdicts, free of any network or database access.
+
+evaluate() turns one API response into an immutable NutrientVerdict; NutrientBatch applies the same arithmetic
+to NumPy columns so a whole cache can be re-scored against a new threshold in one pass.
+"""
+from dataclasses import dataclass
+from typing import Any, Iterable, Union
+
+import numpy as np
+
+FRUCTOSE_ID = 212
+GLUCOSE_ID = 211
+SUCROSE_ID = 210
+TOTAL_SUGAR_ID = 269
+SUGAR_NUTRIENT_IDS = (FRUCTOSE_ID, GLUCOSE_ID, SUCROSE_ID, TOTAL_SUGAR_ID)
+
+N_GRAMS_FRUCTOSE_ALLOWED = 3
+
+
+def index_nutrients(food: dict) -> dict:
+    """Maps attr_id to value for one food of an API response. Later duplicates win, like the old per id scan."""
+    return {
+        nutrient["attr_id"]: nutrient["value"] for nutrient in food["full_nutrients"]
+    }
+
+
+def extract_nutrient_values(food: dict, nutrient_ids: Iterable[int]) -> list:
+    """Returns the value of each requested nutrient id, 0 for the ones the food does not list."""
+    nutrients = index_nutrients(food)
+    return [nutrients.get(nutrient_id, 0) for nutrient_id in nutrient_ids]
+
+
+def nutrient_matrix(foods: list[dict], nutrient_ids: Iterable[int]) -> np.ndarray:
+    """Returns a (len(foods), len(nutrient_ids)) float array of nutrient values."""
+    nutrient_ids = tuple(nutrient_ids)
+    matrix = np.zeros((len(foods), len(nutrient_ids)))
+    for row, food in enumerate(foods):
+        matrix[row] = extract_nutrient_values(food, nutrient_ids)
+    return matrix
+
+
+def calculate_sugar_totals(
+    total_fructose: float, total_glucose: float, total_sucrose: float
+) -> tuple[float, float, float]:
+    """Splits sucrose evenly into fructose and glucose. Returns total fructose, total glucose and the sum of all three sugars."""
+    total_fructose_calculated = round(total_fructose + (total_sucrose / 2), 1)
+    total_glucose_calculated = round(total_glucose + (total_sucrose / 2), 1)
+    total_sugar_calculated = total_fructose + total_glucose + total_sucrose
+    return total_fructose_calculated, total_glucose_calculated, total_sugar_calculated
+
+
+def evaluate_granular_nutrients_exist(
+    total_sugars_calculated: float, total_sugar_from_api: float
+) -> bool:
+    """Checks to see if granular details of sugars exist (quantity of any sugar is >0) and that the total sugar response from the API is not zero.
+    If this is true, we can assume that the food is either: not devoid of sugar or the api did not return detailed sugar amounts."""
+    return not (total_sugars_calculated == 0 and total_sugar_from_api != 0)
+
+
+def evaluate_if_ingredient_is_under_allowable_fructose_limit(
+    has_detailed_nutrients: bool,
+    total_fructose: float,
+    total_sugar_from_api: float,
+    n_grams_fructose_allowed: float = N_GRAMS_FRUCTOSE_ALLOWED,
+) -> bool:
+    """Determines if a queried food is within fructose limit, handling the nuance of when the API returns granular sugar type details (details == True) and when it does not.
+    If it does not, it defaults to using the overall sugar quantity. This is risk adverse, but safer."""
+    if has_detailed_nutrients:
+        return total_fructose <= n_grams_fructose_allowed
+    return total_sugar_from_api <= n_grams_fructose_allowed
+
+
+def get_fructose_per_gram(
+    total_fructose: float,
+    total_sugar_from_api: float,
+    quantity_of_servings: float,
+    total_weight_grams: float,
+) -> Union[float, None]:
+    """Grams of fructose (or total sugar, when no granular fructose is returned) per gram of food. None when the serving has no
+    quantity or weight."""
+    if quantity_of_servings == 0 or total_weight_grams == 0:
+        return None
+    # if api returns granular fructose use that - otherwise, use the total sugar quantity
+    if total_fructose == 0:
+        total_fructose_adjusted = total_sugar_from_api
+    else:
+        total_fructose_adjusted = total_fructose
+    grams_single_serving = total_weight_grams / quantity_of_servings
+    fructose_single_serving = total_fructose_adjusted / quantity_of_servings
+    return fructose_single_serving / grams_single_serving
+
+
+def get_allowed_amount_of_ingredient_under_limit(
+    fructose_per_gram: Union[float, None],
+    quantity_of_servings: float,
+    total_weight_grams: float,
+    n_grams_fructose_allowed: float = N_GRAMS_FRUCTOSE_ALLOWED,
+) -> tuple[float, float]:
+    """Determines how much of a serving of a food can be eaten while keeping the quantity under the fructose limit. Returns the
+    grams allowed and that amount as a proportion of a single serving."""
+    if fructose_per_gram is None:
+        raise ZeroDivisionError("serving has no quantity or weight")
+    grams_single_serving = total_weight_grams / quantity_of_servings
+    f_serving_grams = n_grams_fructose_allowed / fructose_per_gram
+    serving_unit_proportion = f_serving_grams / grams_single_serving
+    return f_serving_grams, serving_unit_proportion
+
+
+@dataclass(frozen=True, slots=True)
+class NutrientVerdict:
+    """Everything shown for one food: the nutrients parsed from the API and the verdict for n_grams_fructose_allowed.
+    Built by evaluate() and evaluate_materialized_verdict()."""
+
+    ingredient_name: str
+    serving_unit: str
+    item: str
+    measure: Union[str, None]
+    quantity: Union[str, float]
+    serving_size_grams: float
+    fructose: float
+    glucose: float
+    sucrose: float
+    total_sugar_from_api: float
+    total_fructose: float
+    total_glucose: float
+    total_sugars_calculated: float
+    has_detailed_nutrients: bool
+    fructose_per_gram: Union[float, None]
+    n_grams_fructose_allowed: float
+    is_under_allowable_fructose_limit: bool
+    grams_fructose_per_single_serving_of_ingredient: float = 0.0
+    proportion_of_fructose_per_gram_of_ingredient: float = 0.0
+
+    @property
+    def quantity_of_servings(self) -> float:
+        return float(self.quantity)
+
+    @property
+    def total_weight_grams(self) -> float:
+        return float(self.serving_size_grams)
+
+    @property
+    def parsed_nutrient_response(self) -> dict:
+        """The parsed fields rendered by the templates and written to the cache by db.record_search()."""
+        return {
+            "name": self.ingredient_name,
+            "serving_unit": self.serving_unit,
+            "serving_size_grams": self.serving_size_grams,
+            "item": self.item,
+            "measure": self.measure,
+            "quantity": self.quantity,
+            "fructose": self.fructose,
+            "glucose": self.glucose,
+            "sucrose": self.sucrose,
+            "t_fructose": self.total_fructose,
+            "t_glucose": self.total_glucose,
+            "t_sugar": self.total_sugar_from_api,
+            "t_sugar_calc": self.total_sugars_calculated,
+        }
+
+    @property
+    def materialized_verdict(self) -> dict:
+        """The parsed fields needed to rebuild this verdict without the raw response. None of them depend on n_grams_fructose_allowed."""
+        return {
+            "name": self.ingredient_name,
+            "serving_unit": self.serving_unit,
+            "item": self.item,
+            "measure": self.measure,
+            "quantity": self.quantity,
+            "serving_size_grams": self.serving_size_grams,
+            "fructose": self.fructose,
+            "glucose": self.glucose,
+            "sucrose": self.sucrose,
+            "total_sugar": self.total_sugar_from_api,
+            "fructose_per_gram": self.fructose_per_gram,
+            "has_detailed_nutrients": self.has_detailed_nutrients,
+        }
+
+
+# name, serving unit, item, measure, quantity and serving weight as the API sent them, then sugar grams
+ParsedFood = tuple[Any, Any, Any, Any, Any, Any, float, float, float, float]
+
+
+def parse_food(food: dict) -> ParsedFood:
+    """Returns name, serving unit, item, measure, quantity, serving weight and the fructose, glucose, sucrose and total sugar
+    grams (rounded to 0.1) of one entry of an API response's foods list."""
+    total_fructose, total_glucose, total_sucrose, total_sugar = (
+        round(nutrient_value, 1)
+        for nutrient_value in extract_nutrient_values(food, SUGAR_NUTRIENT_IDS)
+    )
+    return (
+        food["food_name"],
+        food["serving_unit"],
+        food["tags"]["item"],
+        food["tags"]["measure"],
+        food["tags"]["quantity"],
+        food["serving_weight_grams"],
+        total_fructose,
+        total_glucose,
+        total_sucrose,
+        total_sugar,
+    )
+
+
+def build_verdict(
+    name,
+    serving_unit,
+    item,
+    measure,
+    quantity,
+    serving_size_grams,
+    fructose,
+    glucose,
+    sucrose,
+    total_sugar,
+    n_grams_fructose_allowed: float = N_GRAMS_FRUCTOSE_ALLOWED,
+) -> NutrientVerdict:
+    (
+        total_fructose_calculated,
+        total_glucose_calculated,
+        total_sugar_calculated,
+    ) = calculate_sugar_totals(fructose, glucose, sucrose)
+    total_fructose = float(total_fructose_calculated)
+    total_sugar_from_api = float(total_sugar)
+    quantity_of_servings = float(quantity)
+    total_weight_grams = float(serving_size_grams)
+    has_detailed_nutrients = evaluate_granular_nutrients_exist(
+        float(total_sugar_calculated), total_sugar_from_api
+    )
+    fructose_per_gram = get_fructose_per_gram(
+        total_fructose, total_sugar_from_api, quantity_of_servings, total_weight_grams
+    )
+    is_under_allowable_fructose_limit = (
+        evaluate_if_ingredient_is_under_allowable_fructose_limit(
+            has_detailed_nutrients,
+            total_fructose,
+            total_sugar_from_api,
+            n_grams_fructose_allowed,
+        )
+    )
+    allowed_amount = (0.0, 0.0)
+    if not is_under_allowable_fructose_limit:
+        allowed_amount = get_allowed_amount_of_ingredient_under_limit(
+            fructose_per_gram,
+            quantity_of_servings,
+            total_weight_grams,
+            n_grams_fructose_allowed,
+        )
+    return NutrientVerdict(
+        name,
+        serving_unit,
+        item,
+        measure,
+        quantity,
+        serving_size_grams,
+        fructose,
+        glucose,
+        sucrose,
+        total_sugar_from_api,
+        total_fructose,
+        total_glucose_calculated,
+        float(total_sugar_calculated),
+        has_detailed_nutrients,
+        fructose_per_gram,
+        n_grams_fructose_allowed,
+        is_under_allowable_fructose_limit,
+        *allowed_amount,
+    )
+
+
+# what evaluate() and evaluate_materialized_verdict() raise for a response or verdict without a usable food: a
+# missing foods list, missing or null fields, or a serving without weight that is over the limit
+UNUSABLE_RESPONSE_ERRORS = (
+    KeyError,
+    IndexError,
+    TypeError,
+    ValueError,
+    ZeroDivisionError,
+)
+
+
+def evaluate(
+    response: dict, n_grams_fructose_allowed: float = N_GRAMS_FRUCTOSE_ALLOWED
+) -> NutrientVerdict:
+    """Evaluates the first food of an API response. Raises one of UNUSABLE_RESPONSE_ERRORS when the response has no
+    usable food, e.g. the 404 "We couldn't match any of your foods" body."""
+    return build_verdict(*parse_food(response["foods"][0]), n_grams_fructose_allowed)
+
+
+def evaluate_materialized_verdict(
+    verdict: dict, n_grams_fructose_allowed: float = N_GRAMS_FRUCTOSE_ALLOWED
+) -> NutrientVerdict:
+    """Evaluates the fields stored by NutrientVerdict.materialized_verdict against a threshold."""
+    return build_verdict(
+        verdict["name"],
+        verdict["serving_unit"],
+        verdict["item"],
+        verdict["measure"],
+        verdict["quantity"],
+        verdict["serving_size_grams"],
+        verdict["fructose"],
+        verdict["glucose"],
+        verdict["sucrose"],
+        verdict["total_sugar"],
+        n_grams_fructose_allowed,
+    )
+
+
+def scale_materialized_verdict(verdict: dict, factor: float, quantity: float) -> dict:
+    """Returns a copy of a materialized verdict for factor times its amount, e.g. a cached "2 apples" verdict
+    scaled by 1.5 answers "3 apples". Sugar grams are rounded like parse_food(); fructose per gram is unchanged.
+    """
+    scaled_verdict = dict(verdict)
+    for key in ("fructose", "glucose", "sucrose", "total_sugar"):
+        scaled_verdict[key] = round(float(verdict[key]) * factor, 1)
+    scaled_verdict["serving_size_grams"] = round(
+        float(verdict["serving_size_grams"]) * factor, 2
+    )
+    scaled_verdict["quantity"] = quantity
+    return scaled_verdict
+
+
+# the parts of a food entry read by parse_food() and model.match_foods_to_queries()
+FOOD_FIELDS = ("food_name", "serving_qty", "serving_unit", "serving_weight_grams")
+TAG_FIELDS = ("item", "measure", "quantity")
+
+
+def trim_response(response: dict) -> dict:
+    """Drops everything evaluate() never reads from an API response (photos, alternative measures, the other
+    nutrients), leaving a response it evaluates identically. Responses without foods are returned unchanged."""
+    if not isinstance(response.get("foods"), list):
+        return response
+    return {
+        "foods": [
+            {
+                **{field: food[field] for field in FOOD_FIELDS if field in food},
+                "tags": {
+                    field: (food.get("tags") or {}).get(field) for field in TAG_FIELDS
+                },
+                "full_nutrients": [
+                    nutrient
+                    for nutrient in food.get("full_nutrients") or []
+                    if nutrient.get("attr_id") in SUGAR_NUTRIENT_IDS
+                ],
+            }
+            for food in response["foods"]
+        ]
+    }
+
+
+def round_like_python(values: np.ndarray, digits: int = 1) -> np.ndarray:
+    """np.round() scales by 10**digits before rounding, so values just below a tie (0.15 is stored as
+    0.1499...) can round the other way from Python's round(). Those near ties are redone with round()."""
+    values = np.asarray(values, dtype=float)
+    rounded = np.round(values, digits)
+    scaled = values * 10**digits
+    near_tie = np.isclose(scaled - np.floor(scaled), 0.5, rtol=0, atol=1e-9)
+    for index in zip(*np.nonzero(near_tie)):
+        rounded[index] = round(float(values[index]), digits)
+    return rounded
+
+
+class NutrientBatch:
+    """Threshold independent nutrient columns for many foods, evaluated like evaluate().
+
+    Args:
+    - fructose/glucose/sucrose/total_sugar(array) - grams per serving, already rounded to 0.1 as parsed from the API
+    - quantity(array) - number of servings the weights refer to
+    - serving_size_grams(array) - weight of quantity servings
+    """
+
+    def __init__(
+        self,
+        fructose,
+        glucose,
+        sucrose,
+        total_sugar,
+        quantity,
+        serving_size_grams,
+    ):
+        self.fructose = np.asarray(fructose, dtype=float)
+        self.glucose = np.asarray(glucose, dtype=float)
+        self.sucrose = np.asarray(sucrose, dtype=float)
+        self.total_sugar_from_api = np.asarray(total_sugar, dtype=float)
+        self.quantity_of_servings = np.asarray(quantity, dtype=float)
+        self.total_weight_grams = np.asarray(serving_size_grams, dtype=float)
+
+        # calculate_sugar_totals(): half of sucrose is fructose
+        self.total_fructose = round_like_python(self.fructose + self.sucrose / 2)
+        self.total_sugars_calculated = self.fructose + self.glucose + self.sucrose
+        self.has_detailed_nutrients = ~(
+            (self.total_sugars_calculated == 0) & (self.total_sugar_from_api != 0)
+        )
+        self.fructose_per_gram = self.get_fructose_per_gram()
+
+    @classmethod
+    def from_foods(cls, foods: list[dict]) -> "NutrientBatch":
+        """Builds a batch from entries of API responses' foods lists."""
+        nutrients = round_like_python(nutrient_matrix(foods, SUGAR_NUTRIENT_IDS))
+        return cls(
+            nutrients[:, 0],
+            nutrients[:, 1],
+            nutrients[:, 2],
+            nutrients[:, 3],
+            [float(food["tags"]["quantity"]) for food in foods],
+            [float(food["serving_weight_grams"]) for food in foods],
+        )
+
+    @classmethod
+    def from_verdicts(cls, verdicts: list[dict]) -> "NutrientBatch":
+        """Builds a batch from materialized verdicts (see NutrientVerdict.materialized_verdict)."""
+        return cls(
+            [verdict["fructose"] for verdict in verdicts],
+            [verdict["glucose"] for verdict in verdicts],
+            [verdict["sucrose"] for verdict in verdicts],
+            [verdict["total_sugar"] for verdict in verdicts],
+            [float(verdict["quantity"]) for verdict in verdicts],
+            [float(verdict["serving_size_grams"]) for verdict in verdicts],
+        )
+
+    def __len__(self) -> int:
+        return len(self.total_fructose)
+
+    def get_fructose_per_gram(self) -> np.ndarray:
+        """Same as get_fructose_per_gram(), with NaN where that returns None."""
+        total_fructose_adjusted = np.where(
+            self.total_fructose == 0, self.total_sugar_from_api, self.total_fructose
+        )
+        with np.errstate(divide="ignore", invalid="ignore"):
+            grams_single_serving = self.total_weight_grams / self.quantity_of_servings
+            fructose_single_serving = (
+                total_fructose_adjusted / self.quantity_of_servings
+            )
+            fructose_per_gram = fructose_single_serving / grams_single_serving
+        return np.where(
+            (self.quantity_of_servings == 0) | (self.total_weight_grams == 0),
+            np.nan,
+            fructose_per_gram,
+        )
+
+    def evaluate(
+        self, n_grams_fructose_allowed: float = N_GRAMS_FRUCTOSE_ALLOWED
+    ) -> dict:
+        """Returns the verdict columns evaluate() sets for the threshold: whether each food is under
+        the limit and, for the ones that are not, the grams and serving proportion that stay under it (0 otherwise).
+        """
+        is_under_allowable_fructose_limit = np.where(
+            self.has_detailed_nutrients,
+            self.total_fructose <= n_grams_fructose_allowed,
+            self.total_sugar_from_api <= n_grams_fructose_allowed,
+        )
+        with np.errstate(divide="ignore", invalid="ignore"):
+            grams_single_serving = self.total_weight_grams / self.quantity_of_servings
+            f_serving_grams = n_grams_fructose_allowed / self.fructose_per_gram
+            serving_unit_proportion = f_serving_grams / grams_single_serving
+        return {
+            "is_under_allowable_fructose_limit": is_under_allowable_fructose_limit,
+            "grams_fructose_per_single_serving_of_ingredient": np.where(
+                is_under_allowable_fructose_limit, 0.0, f_serving_grams
+            ),
+            "proportion_of_fructose_per_gram_of_ingredient": np.where(
+                is_under_allowable_fructose_limit, 0.0, serving_unit_proportion
+            ),
+        }
@@ -0,0 +1,285 @@
+"""Pooled client for the Nutritionix natural language nutrients endpoint."""
+import os
+import json
+import time
+import random
+import logging
+import threading
+from contextlib import contextmanager
+from typing import Callable, Iterator, NoReturn, Union
+
+import requests  # type: ignore
+from requests.adapters import HTTPAdapter  # type: ignore
+
+from metrics import upstream_duration, upstream_errors, upstream_requests
+
+NUTRITIONIX_URL = os.environ.get("NUTRITIONIX_URL", "https://trackapi.nutritionix.com")
+NATURAL_NUTRIENTS_PATH = "/v2/natural/nutrients"
+
+# status codes worth retrying
+RETRYABLE_STATUS_CODES = frozenset({429, 500, 502, 503, 504})
+# the one error status that is a real answer: "We couldn't match any of your foods"
+NO_MATCH_STATUS_CODE = 404
+# bad or missing credentials; every call fails the same way until the configuration is fixed
+AUTH_ERROR_STATUS_CODES = frozenset({401, 403})
+# the quota is spent; only retried by callers that do not budget their calls (see fetch_natural_nutrients())
+QUOTA_EXCEEDED_STATUS_CODE = 429
+
+
+class UpstreamError(Exception):
+    """Nutritionix could not be reached, timed out or kept returning server errors."""
+
+
+class CircuitOpenError(UpstreamError):
+    """Raised without calling Nutritionix while the circuit breaker is open."""
+
+
+class CircuitBreaker:
+    """Stops calling Nutritionix after repeated failures.
+
+    After failure_threshold consecutive failures the breaker opens and every call fails fast. Once
+    reset_timeout_seconds have passed a single trial call is let through (half open); its outcome
+    closes the breaker again or restarts the timeout.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(
+        self,
+        failure_threshold: int = 5,
+        reset_timeout_seconds: float = 30.0,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout_seconds = reset_timeout_seconds
+        self.clock = clock
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self._lock = threading.Lock()
+
+    def allow_request(self) -> bool:
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if (
+                self.state == self.OPEN
+                and self.clock() - self.opened_at >= self.reset_timeout_seconds
+            ):
+                self.state = self.HALF_OPEN
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.consecutive_failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.consecutive_failures += 1
+            if (
+                self.state == self.HALF_OPEN
+                or self.consecutive_failures >= self.failure_threshold
+            ):
+                if self.state != self.OPEN:
+                    logging.warning("Nutritionix circuit breaker opened")
+                self.state = self.OPEN
+                self.opened_at = self.clock()
+
+    def release_trial(self):
+        """Ends a call that got no answer either way, e.g. one shed by the quota scheduler. A half open breaker
+        lets the next call be the trial instead of waiting forever for this one's outcome."""
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self.state = self.OPEN
+
+
+class NutritionixClient:
+    """Keeps a pool of keep-alive connections to Nutritionix and bounds how long a request can take.
+
+    Args:
+    - base_url(String) - scheme and host of the API, overridable to point at stub_nutritionix.py
+    - connect_timeout(float) / read_timeout(float) - seconds, passed to requests separately
+    - max_retries(int) - extra attempts after a connection error, timeout or retryable status
+    - backoff_seconds(float) - base of the exponential backoff; each wait is jittered between 0 and the cap
+    - pool_size(int) - connections kept open per host
+    """
+
+    def __init__(
+        self,
+        base_url: str = NUTRITIONIX_URL,
+        app_id: str = os.environ.get("NUTRITIONIX_APP_ID", ""),
+        app_key: str = os.environ.get("NUTRITIONIX_APP_KEY", ""),
+        connect_timeout: float = 3.05,
+        read_timeout: float = 10.0,
+        max_retries: int = 2,
+        backoff_seconds: float = 0.25,
+        pool_size: int = 10,
+        circuit_breaker: Union[CircuitBreaker, None] = None,
+        sleep: Callable[[float], None] = time.sleep,
+    ):
+        self.base_url = base_url.rstrip("/")
+        self.app_id = app_id
+        self.app_key = app_key
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        self.circuit_breaker = circuit_breaker or CircuitBreaker()
+        self.sleep = sleep
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def build_payload(self, search_query: str) -> str:
+        return json.dumps(
+            {
+                "query": search_query,
+                "use_raw_foods": False,
+                "include_subrecipe": False,
+                "meal_type": 0,
+                "use_branded_foods": False,
+                "locale": "en_US",
+                "taxonomy": False,
+                "ingredient_statement": True,
+                "last_modified": False,
+            }
+        )
+
+    def build_headers(self) -> dict:
+        return {
+            "x-app-key": self.app_key,
+            "x-app-id": self.app_id,
+            "x-remote-user-id": "0",
+            "Content-Type": "application/json",
+        }
+
+    def get_backoff_delay(self, attempt: int) -> float:
+        """Full jitter: a random wait between 0 and backoff_seconds * 2^attempt."""
+        return random.uniform(0, self.backoff_seconds * (2**attempt))
+
+    def check_quota_response(self, status_code: int, attempt: int):
+        """Raises UpstreamError for a 429 to a budgeted call: retrying would only spend more of a quota that is
+        already gone. Nutritionix did answer, so the circuit breaker does not count it as a failure."""
+        if status_code != QUOTA_EXCEEDED_STATUS_CODE:
+            return
+        upstream_requests.inc(outcome="quota_exceeded")
+        upstream_errors.inc()
+        self.circuit_breaker.release_trial()
+        raise UpstreamError(
+            f"Nutritionix quota exceeded after {attempt + 1} attempt(s): HTTP {status_code}"
+        )
+
+    def begin_call(self):
+        """Raises CircuitOpenError, without calling the API, while the breaker is open."""
+        if not self.circuit_breaker.allow_request():
+            upstream_requests.inc(outcome="circuit_open")
+            upstream_errors.inc()
+            raise CircuitOpenError("Nutritionix circuit breaker is open")
+
+    @contextmanager
+    def releasing_trial_on_shed(self) -> Iterator[None]:
+        """Wraps taking a quota token: a call shed before it got an answer ends a half open breaker's trial."""
+        try:
+            yield
+        except UpstreamError:
+            self.circuit_breaker.release_trial()
+            raise
+
+    def record_connection_error(
+        self, error: Exception, attempt: int, attempt_started: float
+    ) -> str:
+        """Accounts for an attempt that got no response and returns the error to report if it was the last one."""
+        upstream_duration.observe(time.perf_counter() - attempt_started)
+        upstream_requests.inc(outcome="connection_error")
+        last_error = repr(error)
+        logging.debug(f"Nutritionix attempt {attempt + 1} failed: {last_error}")
+        return last_error
+
+    def check_response(
+        self, status_code: int, attempt: int, attempt_started: float, budgeted: bool
+    ) -> Union[str, None]:
+        """Decides what an attempt's response means: None when its body is the answer, or the error to retry on.
+        Raises UpstreamError for a response no retry will change (see check_quota_response())."""
+        upstream_duration.observe(time.perf_counter() - attempt_started)
+        if budgeted:
+            self.check_quota_response(status_code, attempt)
+        if status_code in RETRYABLE_STATUS_CODES:
+            upstream_requests.inc(outcome="retryable_status")
+            last_error = f"HTTP {status_code}"
+            logging.debug(f"Nutritionix attempt {attempt + 1} failed: {last_error}")
+            return last_error
+        if not (200 <= status_code < 300 or status_code == NO_MATCH_STATUS_CODE):
+            self.reject_response(status_code)
+        upstream_requests.inc(outcome="ok")
+        self.circuit_breaker.record_success()
+        return None
+
+    def reject_response(self, status_code: int) -> NoReturn:
+        """Raises UpstreamError for an error status that is neither retryable nor a no match answer, so its body is
+        never taken for a food that does not exist. Credential errors count as breaker failures."""
+        upstream_requests.inc(outcome="rejected")
+        upstream_errors.inc()
+        if status_code in AUTH_ERROR_STATUS_CODES:
+            logging.error(f"Nutritionix rejected the credentials: HTTP {status_code}")
+            self.circuit_breaker.record_failure()
+        else:
+            self.circuit_breaker.release_trial()
+        raise UpstreamError(f"Nutritionix rejected the request: HTTP {status_code}")
+
+    def give_up(self, last_error: str) -> NoReturn:
+        upstream_errors.inc()
+        self.circuit_breaker.record_failure()
+        raise UpstreamError(
+            f"Nutritionix failed after {self.max_retries + 1} attempts: {last_error}"
+        )
+
+    def fetch_natural_nutrients(
+        self, search_query: str, acquire: Union[Callable[[], None], None] = None
+    ) -> str:
+        """Posts a natural language query and returns the response text. Raises UpstreamError when every
+        attempt fails and CircuitOpenError without calling the API while the breaker is open.
+
+        Args:
+        - acquire(callable) - called before every attempt, retries included, to take a quota token (see
+          quota.UpstreamScheduler.call()); raises to stop. A 429 is not retried when it is given.
+        """
+        self.begin_call()
+        payload = self.build_payload(search_query)
+        last_error = ""
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                self.sleep(self.get_backoff_delay(attempt - 1))
+            if acquire is not None:
+                with self.releasing_trial_on_shed():
+                    acquire()
+            attempt_started = time.perf_counter()
+            try:
+                response = self.session.post(
+                    self.base_url + NATURAL_NUTRIENTS_PATH,
+                    headers=self.build_headers(),
+                    data=payload,
+                    timeout=self.timeout,
+                )
+            except requests.RequestException as error:
+                last_error = self.record_connection_error(
+                    error, attempt, attempt_started
+                )
+                continue
+            error_to_retry = self.check_response(
+                response.status_code, attempt, attempt_started, acquire is not None
+            )
+            if error_to_retry is None:
+                return response.text
+            last_error = error_to_retry
+        self.give_up(last_error)
+
+
+nutritionix_client = NutritionixClient(
+    connect_timeout=float(os.environ.get("NUTRITIONIX_CONNECT_TIMEOUT", "3.05")),
+    read_timeout=float(os.environ.get("NUTRITIONIX_READ_TIMEOUT", "10")),
+    max_retries=int(os.environ.get("NUTRITIONIX_MAX_RETRIES", "2")),
+)
@@ -0,0 +1,58 @@
+"""Turns a resolved food into the fields the search page, the JSON API and bulk output show."""
+import fnmatch
+
+
+def build_ingredient_result(search_query, NutrientResults) -> dict:
+    """Fields shared by the search page and the JSON API for a single food."""
+    verdict = NutrientResults.verdict
+    search_results = verdict.parsed_nutrient_response
+    fructose_serving_grams = round(
+        verdict.grams_fructose_per_single_serving_of_ingredient, 1
+    )
+    fructose_proportion = verdict.proportion_of_fructose_per_gram_of_ingredient
+    serving_unit_connecting_word = set_serving_unit_preposition(verdict)
+    can_eat = set_display_word_for_allowable_food(verdict)
+
+    return dict(
+        search_query=search_query,
+        query_response=search_results,
+        t_fructose=verdict.total_fructose,
+        total_sugar_calc=verdict.total_sugars_calculated,
+        total_sugar_api=verdict.total_sugar_from_api,
+        serving_unit=verdict.serving_unit,
+        quantity=verdict.quantity_of_servings,
+        serving_size_grams=verdict.total_weight_grams,
+        name=verdict.ingredient_name,
+        can_eat=can_eat,
+        under_limit=verdict.is_under_allowable_fructose_limit,
+        f_serving_grams=fructose_serving_grams,
+        details=verdict.has_detailed_nutrients,
+        f_proportion=fructose_proportion,
+        connecting_word=serving_unit_connecting_word,
+        match_confidence=NutrientResults.match_confidence,
+        scaled=NutrientResults.scaled,
+        matched_query=NutrientResults.matched_query,
+    )
+
+
+def set_display_word_for_allowable_food(NutrientResults):
+    if (
+        NutrientResults.is_under_allowable_fructose_limit
+    ):  # TODO maybe push this into Jinja?
+        can_eat = "can"
+    else:
+        can_eat = "cannot"
+    return can_eat
+
+
+def set_serving_unit_preposition(NutrientResults):
+    serving_unit = NutrientResults.serving_unit
+    if (
+        fnmatch.fnmatch(serving_unit.lower(), "*medium*")
+        or fnmatch.fnmatch(serving_unit.lower(), "*small*")
+        or fnmatch.fnmatch(serving_unit.lower(), "*large*")
+    ):
+        connecting_word = ""
+    else:
+        connecting_word = "of"
+    return connecting_word
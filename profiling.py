@@ -0,0 +1,305 @@
+"""Opt-in profiling of single requests, for finding where a slow query spends its time in production.
+
+A profiled request is run under cProfile and a stack sampler, and leaves two files in PROFILE_DIRECTORY: a .prof
+dump readable with pstats or snakeviz, and a .folded file of collapsed stacks for flamegraph.pl or speedscope.
+Profiling is off unless one of these is set:
+
+    PROFILE_SAMPLE_RATE=0.01 flask --app main run          # profile 1% of requests
+    PROFILE_SECRET=... python profiling.py sign /api/v1/get_single_ingredient
+    curl -H "X-Profile: <token>" ".../api/v1/get_single_ingredient?search_query=apple"
+
+A token is an HMAC of the path and an expiry, so only holders of PROFILE_SECRET can turn profiling on; it may
+also be passed as the ?profile= query parameter. Each token profiles one request per process, so a token that leaks
+from a log cannot be replayed to slow the server down. The response of a profiled request names its files in an
+X-Profile-Id header. Summarize everything collected with `python profiling.py summary`.
+"""
+import os
+import re
+import sys
+import time
+import hmac
+import pstats
+import random
+import hashlib
+import cProfile
+import argparse
+import threading
+from collections import Counter
+from typing import Union
+
+PROFILE_DIRECTORY = os.environ.get("PROFILE_DIRECTORY", "profiles")
+# fraction of requests profiled without a token
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", "0"))
+# key for signed profiling tokens; tokens are rejected while it is empty
+PROFILE_SECRET = os.environ.get("PROFILE_SECRET", "")
+PROFILE_HEADER = "X-Profile"
+PROFILE_PARAMETER = "profile"
+SAMPLE_INTERVAL_SECONDS = float(os.environ.get("PROFILE_SAMPLE_INTERVAL", "0.001"))
+
+# one profiled request at a time per process; requests arriving meanwhile run unprofiled
+profiling_lock = threading.Lock()
+# signatures of the tokens already used in this process, with their expiry; forgotten once they expire
+used_profile_tokens: dict[str, int] = {}
+used_profile_tokens_lock = threading.Lock()
+
+
+def get_profile_signature(path: str, secret: str, expires: int) -> str:
+    return hmac.new(
+        secret.encode("utf-8"), f"{expires}:{path}".encode("utf-8"), hashlib.sha256
+    ).hexdigest()
+
+
+def sign_profile_token(
+    path: str, secret: str, ttl_seconds: float = 600, now: Union[float, None] = None
+) -> str:
+    """Returns a token that enables profiling of requests to path until ttl_seconds from now."""
+    expires = int((time.time() if now is None else now) + ttl_seconds)
+    return f"{expires}.{get_profile_signature(path, secret, expires)}"
+
+
+def verify_profile_token(
+    token: str, path: str, secret: str, now: Union[float, None] = None
+) -> bool:
+    expires, _, signature = token.partition(".")
+    if not secret or not expires.isdigit():
+        return False
+    if int(expires) < (time.time() if now is None else now):
+        return False
+    return hmac.compare_digest(
+        signature, get_profile_signature(path, secret, int(expires))
+    )
+
+
+def claim_profile_token(
+    token: str, path: str, secret: str, now: Union[float, None] = None
+) -> bool:
+    """verify_profile_token(), accepting each token only once per process."""
+    now = time.time() if now is None else now
+    if not verify_profile_token(token, path, secret, now):
+        return False
+    expires, _, signature = token.partition(".")
+    with used_profile_tokens_lock:
+        for used_signature, used_expires in list(used_profile_tokens.items()):
+            if used_expires < now:
+                del used_profile_tokens[used_signature]
+        if signature in used_profile_tokens:
+            return False
+        used_profile_tokens[signature] = int(expires)
+    return True
+
+
+def should_profile(path: str, token: Union[str, None]) -> bool:
+    """Whether to profile a request: it carries a valid, unused token for its path, or it falls in the sampled
+    fraction."""
+    if token and claim_profile_token(token, path, PROFILE_SECRET):
+        return True
+    return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+
+def format_frame(frame) -> str:
+    code = frame.f_code
+    name = f"{os.path.basename(code.co_filename)}:{code.co_name}"
+    # flamegraph.pl splits stacks on ";" and the count on the last space
+    return name.replace(";", "_").replace(" ", "_")
+
+
+class StackSampler:
+    """Counts the collapsed stacks of one thread, sampled every interval_seconds from a background thread.
+
+    Args:
+    - thread_id(int) - threading.get_ident() of the thread to sample
+    """
+
+    def __init__(
+        self, thread_id: int, interval_seconds: float = SAMPLE_INTERVAL_SECONDS
+    ):
+        self.thread_id = thread_id
+        self.interval_seconds = interval_seconds
+        self.stacks: Counter = Counter()
+        self._stopped = threading.Event()
+        self._thread: Union[threading.Thread, None] = None
+
+    def sample(self):
+        frame = sys._current_frames().get(self.thread_id)
+        frames = []
+        while frame is not None:
+            frames.append(format_frame(frame))
+            frame = frame.f_back
+        if frames:
+            self.stacks[";".join(reversed(frames))] += 1
+
+    def run(self):
+        while not self._stopped.wait(self.interval_seconds):
+            self.sample()
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self.run, name="profile-sampler", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self) -> Counter:
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+        return self.stacks
+
+
+class RequestProfile:
+    """cProfile and a StackSampler around one request on the calling thread.
+
+    Args:
+    - label(String) - e.g. "GET /api/v1/get_single_ingredient", used in the file names
+    - directory(String) - where the .prof and .folded files are written
+    """
+
+    def __init__(self, label: str, directory: str = PROFILE_DIRECTORY):
+        self.label = label
+        self.directory = directory
+        self.profile_id = "{}-{}-{}".format(
+            time.strftime("%Y%m%dT%H%M%S"),
+            os.getpid(),
+            re.sub(r"[^A-Za-z0-9]+", "_", label).strip("_")[:80],
+        )
+        self.profiler = cProfile.Profile()
+        self.sampler = StackSampler(threading.get_ident())
+        self.running = False
+
+    def start(self):
+        self.running = True
+        self.sampler.start()
+        self.profiler.enable()
+
+    def stop(self) -> str:
+        """Stops profiling and writes both files. Returns the profile id, the file name without its extension."""
+        if not self.running:
+            return self.profile_id
+        self.profiler.disable()
+        stacks = self.sampler.stop()
+        self.running = False
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, self.profile_id)
+        # the timestamp is per second, so a second profile of the same route in it gets a suffix
+        suffix = 1
+        while os.path.exists(path + ".prof"):
+            suffix += 1
+            path = os.path.join(self.directory, f"{self.profile_id}-{suffix}")
+        self.profile_id = os.path.basename(path)
+        self.profiler.dump_stats(path + ".prof")
+        with open(path + ".folded", "w", encoding="utf-8") as folded_file:
+            for stack, count in stacks.most_common():
+                folded_file.write(f"{stack} {count}\n")
+        return self.profile_id
+
+
+def start_request_profile(
+    method: str, path: str, token: Union[str, None]
+) -> Union[RequestProfile, None]:
+    """Starts profiling the current request if should_profile() says so and no other request is being profiled.
+    Returns the running profile, to be stopped with finish_request_profile(), or None."""
+    # the lock first, so a token is not used up by a request that could not be profiled anyway
+    if not profiling_lock.acquire(blocking=False):
+        return None
+    if not should_profile(path, token):
+        profiling_lock.release()
+        return None
+    profile = RequestProfile(f"{method} {path}", PROFILE_DIRECTORY)
+    try:
+        profile.start()
+    except BaseException:
+        profiling_lock.release()
+        raise
+    return profile
+
+
+def finish_request_profile(profile: RequestProfile) -> str:
+    """Stops a profile from start_request_profile() and returns its id. Calling it again does nothing."""
+    if not profile.running:
+        return profile.profile_id
+    try:
+        return profile.stop()
+    finally:
+        profiling_lock.release()
+
+
+def list_profiles(directory: str, extension: str) -> list[str]:
+    if not os.path.isdir(directory):
+        return []
+    return sorted(
+        os.path.join(directory, name)
+        for name in os.listdir(directory)
+        if name.endswith(extension)
+    )
+
+
+def count_self_samples(folded_paths: list[str]) -> Counter:
+    """Sums the samples of each stack's innermost frame across .folded files."""
+    counts: Counter = Counter()
+    for folded_path in folded_paths:
+        with open(folded_path, encoding="utf-8") as folded_file:
+            for line in folded_file:
+                stack, _, count = line.rstrip("\n").rpartition(" ")
+                if stack and count.isdigit():
+                    counts[stack.rpartition(";")[2]] += int(count)
+    return counts
+
+
+def summarize_profiles(
+    directory: str, top: int = 20, sort: str = "cumulative", stream=sys.stdout
+) -> int:
+    """Prints the top functions across every .prof file in directory and the frames with the most samples across
+    every .folded file. Returns the number of profiles read."""
+    profile_paths = list_profiles(directory, ".prof")
+    if not profile_paths:
+        print(f"No profiles in {directory}", file=stream)
+        return 0
+    print(f"{len(profile_paths)} profile(s) in {directory}", file=stream)
+    stats = pstats.Stats(*profile_paths, stream=stream)
+    stats.strip_dirs().sort_stats(sort).print_stats(top)
+    samples = count_self_samples(list_profiles(directory, ".folded"))
+    total_samples = sum(samples.values())
+    if total_samples:
+        print(f"Most sampled frames ({total_samples} samples):", file=stream)
+        for frame, count in samples.most_common(top):
+            print(f"{count / total_samples:8.1%} {count:8d}  {frame}", file=stream)
+    return len(profile_paths)
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Request profiling tools.")
+    subcommands = parser.add_subparsers(dest="command", required=True)
+    summary = subcommands.add_parser(
+        "summary", help="top functions across collected profiles"
+    )
+    summary.add_argument("--directory", default=PROFILE_DIRECTORY)
+    summary.add_argument("--top", type=int, default=20)
+    summary.add_argument(
+        "--sort", default="cumulative", choices=("cumulative", "tottime", "ncalls")
+    )
+    sign = subcommands.add_parser(
+        "sign", help="print a token that enables profiling of one request to a path"
+    )
+    sign.add_argument("path", help="request path, e.g. /api/v1/get_single_ingredient")
+    sign.add_argument(
+        "--ttl", type=float, default=600, help="seconds the token is valid"
+    )
+    args = parser.parse_args(argv)
+
+    if args.command == "summary":
+        return 0 if summarize_profiles(args.directory, args.top, args.sort) else 1
+    if not PROFILE_SECRET:
+        print(
+            "Set PROFILE_SECRET to the server's value to sign tokens", file=sys.stderr
+        )
+        return 1
+    token = sign_profile_token(args.path, PROFILE_SECRET, args.ttl)
+    print(token)
+    print(
+        f"Send it as a {PROFILE_HEADER} header or ?{PROFILE_PARAMETER}= parameter",
+        file=sys.stderr,
+    )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
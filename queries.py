@@ -0,0 +1,129 @@
+"""Splits a search like "2 cups of blueberries" into a quantity, a unit and a canonical food name.
+
+Searches that differ only in spacing, plurals, filler words or amount share the same food name, so a cached
+answer for one can be scaled to serve the others.
+"""
+import re
+from dataclasses import dataclass
+from fractions import Fraction
+from typing import Union
+
+NUMBER_WORDS = {
+    "a": 1,
+    "an": 1,
+    "one": 1,
+    "two": 2,
+    "three": 3,
+    "four": 4,
+    "five": 5,
+    "six": 6,
+    "seven": 7,
+    "eight": 8,
+    "nine": 9,
+    "ten": 10,
+    "eleven": 11,
+    "twelve": 12,
+    "dozen": 12,
+    "fifteen": 15,
+    "twenty": 20,
+    "thirty": 30,
+    "forty": 40,
+    "fourty": 40,
+    "fifty": 50,
+    "hundred": 100,
+    "half": 0.5,
+}
+
+UNITS = {
+    "cup": "cup",
+    "cups": "cup",
+    "c": "cup",
+    "tablespoon": "tbsp",
+    "tablespoons": "tbsp",
+    "tbsp": "tbsp",
+    "tbs": "tbsp",
+    "tbl": "tbsp",
+    "teaspoon": "tsp",
+    "teaspoons": "tsp",
+    "tsp": "tsp",
+    "slice": "slice",
+    "slices": "slice",
+    "handful": "handful",
+    "handfuls": "handful",
+    "piece": "piece",
+    "pieces": "piece",
+    "serving": "serving",
+    "servings": "serving",
+    "g": "g",
+    "gram": "g",
+    "grams": "g",
+    "oz": "oz",
+    "ounce": "oz",
+    "ounces": "oz",
+    "lb": "lb",
+    "lbs": "lb",
+    "pound": "lb",
+    "pounds": "lb",
+}
+
+STOP_WORDS = frozenset({"a", "an", "the", "of", "some"})
+# kept out of the food name but not dropped: Nutritionix weighs "a large apple" and "an apple" differently
+SIZES = frozenset({"small", "medium", "large"})
+
+# "2", "1.5", ".5", "1/3" and "1 1/2"
+QUANTITY_PATTERN = re.compile(r"^(\d+\s+\d+/\d+|\d+/\d+|\d*\.\d+|\d+)(?=\s|$|[a-z])")
+
+
+@dataclass(frozen=True, slots=True)
+class ParsedQuery:
+    """quantity is None when the search gives no amount; unit is None for counted foods ("3 apples"); size is one of
+    SIZES or None when the search names none."""
+
+    quantity: Union[float, None]
+    unit: Union[str, None]
+    food: str
+    size: Union[str, None] = None
+
+
+def parse_quantity(text: str) -> float:
+    whole, _, fraction = text.partition(" ")
+    if fraction:
+        return float(int(whole) + Fraction(fraction.strip()))
+    return float(Fraction(text))
+
+
+def singularize(word: str) -> str:
+    if len(word) > 4 and word.endswith("ies"):
+        return word[:-3] + "y"
+    if len(word) > 3 and word.endswith(("oes", "ches", "shes", "sses", "xes")):
+        return word[:-2]
+    if len(word) > 3 and word.endswith("s") and not word.endswith(("ss", "us", "is")):
+        return word[:-1]
+    return word
+
+
+def parse_query(search_query: str) -> ParsedQuery:
+    """Parses a leading amount ("2", "1/3", "two", "a"), unit ("cups of", "tbsp") and size ("large") off a search
+    and reduces the rest to lowercase singular words without filler words."""
+    text = " ".join((search_query or "").lower().split())
+    quantity = None
+    match = QUANTITY_PATTERN.match(text)
+    if match:
+        quantity = parse_quantity(match.group(1))
+        text = text[match.end() :].strip()
+    words = text.split(" ") if text else []
+    if quantity is None and words and words[0] in NUMBER_WORDS:
+        quantity = float(NUMBER_WORDS[words.pop(0)])
+    size = next((word for word in words if word in SIZES), None)
+    words = [word for word in words if word not in SIZES]
+    unit = None
+    while words and words[0] in STOP_WORDS:
+        words.pop(0)
+    if words and words[0] in UNITS and len(words) > 1:
+        unit = UNITS[words.pop(0)]
+    food_words = [
+        singularize(word.strip(".,")) for word in words if word not in STOP_WORDS
+    ]
+    return ParsedQuery(
+        quantity, unit, " ".join(word for word in food_words if word), size
+    )
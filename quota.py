@@ -0,0 +1,182 @@
+"""Budgets Nutritionix calls against its per minute and daily quotas, with priority lanes.
+
+Every request to Nutritionix, retries included, takes a token from a bucket stored in searches.db (see
+db.take_upstream_token()), so the budget is shared by all gunicorn workers and survives restarts. Interactive
+requests go first: background work (cache warm-up, bulk jobs) must leave part of both budgets unused and yields to
+interactive callers waiting in the same process. Callers that cannot get a token in time are shed with
+QuotaExceededError instead of queueing forever.
+"""
+import os
+import math
+import asyncio
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from typing import Any, Callable, Iterator, Union
+
+import db
+from metrics import upstream_queue_wait, upstream_scheduled, upstream_shed
+from nutritionix import UpstreamError
+
+INTERACTIVE = "interactive"
+BACKGROUND = "background"
+LANES = (INTERACTIVE, BACKGROUND)
+
+
+class QuotaExceededError(UpstreamError):
+    """Raised without calling Nutritionix when a call is shed: its lane's queue is full, no token became free in
+    time or today's quota is spent. An UpstreamError, so the routes answer it like an unavailable API."""
+
+    def __init__(self, lane: str, reason: str):
+        super().__init__(f"Nutritionix {lane} call shed: {reason}")
+        self.lane = lane
+        self.reason = reason
+
+
+class UpstreamScheduler:
+    """Token bucket in front of the Nutritionix client.
+
+    Args:
+    - calls_per_minute(float) - bucket capacity and refill rate
+    - calls_per_day(int) - calls allowed per UTC day, 0 for no daily limit
+    - background_reserve(float) - fraction of both budgets the background lane must leave for interactive calls
+    - max_queue_depth(dict) - callers per lane allowed to wait for a token; more are shed at once
+    - max_wait_seconds(dict) - how long a caller per lane may wait; one that would wait longer is shed at once
+    - poll_interval_seconds(float) - how often a background caller checks whether interactive callers are done
+    """
+
+    def __init__(
+        self,
+        calls_per_minute: float = 120,
+        calls_per_day: int = 0,
+        background_reserve: float = 0.25,
+        max_queue_depth: Union[dict, None] = None,
+        max_wait_seconds: Union[dict, None] = None,
+        poll_interval_seconds: float = 0.05,
+        clock: Callable[[], float] = time.time,
+        sleep: Callable[[float], None] = time.sleep,
+    ):
+        self.calls_per_minute = calls_per_minute
+        self.calls_per_day = calls_per_day
+        self.background_reserve = background_reserve
+        self.max_queue_depth = {
+            INTERACTIVE: 64,
+            BACKGROUND: 4,
+            **(max_queue_depth or {}),
+        }
+        self.max_wait_seconds = {
+            INTERACTIVE: 2.0,
+            BACKGROUND: 60.0,
+            **(max_wait_seconds or {}),
+        }
+        self.poll_interval_seconds = poll_interval_seconds
+        self.clock = clock
+        self.sleep = sleep
+        self.waiting = dict.fromkeys(LANES, 0)
+        self._lock = threading.Lock()
+
+    def get_budget(self, lane: str) -> dict:
+        """Arguments for db.take_upstream_token(): the bucket, the daily limit and what lane must leave unused."""
+        reserve = self.background_reserve if lane == BACKGROUND else 0.0
+        return dict(
+            capacity=self.calls_per_minute,
+            refill_per_second=self.calls_per_minute / 60,
+            reserved_tokens=math.floor(self.calls_per_minute * reserve),
+            daily_limit=self.calls_per_day,
+            reserved_daily_calls=math.floor(self.calls_per_day * reserve),
+            now=self.clock(),
+        )
+
+    def shed(self, lane: str, reason: str):
+        upstream_shed.inc(lane=lane, reason=reason)
+        logging.warning(f"Shed Nutritionix {lane} call: {reason}")
+        raise QuotaExceededError(lane, reason)
+
+    def enter_queue(self, lane: str):
+        with self._lock:
+            if self.waiting[lane] >= self.max_queue_depth[lane]:
+                self.shed(lane, "queue_full")
+            self.waiting[lane] += 1
+
+    def leave_queue(self, lane: str):
+        with self._lock:
+            self.waiting[lane] -= 1
+
+    def try_take_token(self, lane: str, deadline: float) -> float:
+        """One attempt at taking a token for lane: returns 0 once it is taken, else the seconds to wait before the
+        next attempt. Sheds the call when that wait would pass deadline or today's quota is spent."""
+        if lane == BACKGROUND and self.waiting[INTERACTIVE]:
+            wait_seconds = self.poll_interval_seconds
+        else:
+            wait_seconds = db.cache_store.take_upstream_token(
+                lane, **self.get_budget(lane)
+            )
+            if not wait_seconds:
+                return 0.0
+            if math.isinf(wait_seconds):
+                self.shed(lane, "daily_quota")
+        if self.clock() + wait_seconds > deadline:
+            self.shed(lane, "timeout")
+        return wait_seconds
+
+    def record_scheduled(self, lane: str, started: float):
+        upstream_scheduled.inc(lane=lane)
+        upstream_queue_wait.observe(self.clock() - started, lane=lane)
+
+    def acquire(self, lane: str = INTERACTIVE):
+        """Blocks until a token is taken for lane. Raises QuotaExceededError when the call is shed."""
+        self.enter_queue(lane)
+        started = self.clock()
+        deadline = started + self.max_wait_seconds[lane]
+        try:
+            while True:
+                wait_seconds = self.try_take_token(lane, deadline)
+                if not wait_seconds:
+                    break
+                self.sleep(wait_seconds)
+        finally:
+            self.leave_queue(lane)
+        self.record_scheduled(lane, started)
+
+    async def acquire_async(self, lane: str = INTERACTIVE):
+        """acquire() for coroutines: waits on the event loop instead of blocking a thread, and only takes the token
+        (a short SQLite write) in a worker thread."""
+        self.enter_queue(lane)
+        started = self.clock()
+        deadline = started + self.max_wait_seconds[lane]
+        try:
+            while True:
+                wait_seconds = await asyncio.to_thread(
+                    self.try_take_token, lane, deadline
+                )
+                if not wait_seconds:
+                    break
+                await asyncio.sleep(wait_seconds)
+        finally:
+            self.leave_queue(lane)
+        self.record_scheduled(lane, started)
+
+    @contextmanager
+    def reserved_queue_slots(self, lane: str, callers: int) -> Iterator[None]:
+        """Lets callers more callers wait in lane's queue while the block runs, e.g. the worker threads of a bulk job,
+        so they queue for tokens next to the lane's other callers instead of being shed with queue_full."""
+        with self._lock:
+            self.max_queue_depth[lane] += callers
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.max_queue_depth[lane] -= callers
+
+    def call(self, lane: str, function: Callable[[Callable[[], None]], Any]) -> Any:
+        """Runs function (a Nutritionix call) with a hook that takes a token for lane. The client calls the hook
+        before every attempt (see NutritionixClient.fetch_natural_nutrients()), so retries are budgeted too."""
+        return function(lambda: self.acquire(lane))
+
+
+upstream_scheduler = UpstreamScheduler(
+    calls_per_minute=float(os.environ.get("NUTRITIONIX_CALLS_PER_MINUTE", "120")),
+    calls_per_day=int(os.environ.get("NUTRITIONIX_CALLS_PER_DAY", "0")),
+    background_reserve=float(os.environ.get("NUTRITIONIX_BACKGROUND_RESERVE", "0.25")),
+)
@@ -0,0 +1,114 @@
+"""Stale-while-revalidate for the SQLite cache: a stale hit is served at once and refreshed in the background.
+
+A cached payload older than CACHE_FRESHNESS_TTL_SECONDS (see cache.py) is still answered from the cache; the
+request only queues a refresh here, which fetches a new payload in the quota scheduler's background lane and
+stores it over the row. Requests never wait on a refresh; only a query with no cached data at all goes to
+Nutritionix in the request path. A query whose refresh failed is not refreshed again until a backoff, doubled per
+consecutive failure, has passed.
+"""
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Union
+
+import db
+from cache import MemoryCache
+from metrics import background_refreshes
+
+
+class BackgroundRefresher:
+    """Runs refreshes of cached searches on a bounded pool of threads, one at a time per query.
+
+    Args:
+    - refresh(callable) - fetches and stores a fresh answer for a query, e.g. model.refresh_cached_search
+    - max_workers(int) - refreshes running at once
+    - max_pending(int) - refreshes queued or running; more are dropped and queued again by a later stale hit
+    - backoff_seconds(float) - how long a query is not refreshed after a failed refresh, doubled per further failure
+    - max_backoff_seconds(float) - the longest such pause
+    """
+
+    def __init__(
+        self,
+        refresh: Callable[[str], None],
+        max_workers: int = 2,
+        max_pending: int = 64,
+        backoff_seconds: float = 60.0,
+        max_backoff_seconds: float = 3600.0,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.refresh = refresh
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.backoff_seconds = backoff_seconds
+        self.max_backoff_seconds = max_backoff_seconds
+        self.clock = clock
+        self._pending: set[str] = set()
+        # (consecutive failures, time of the next attempt) per query; forgotten a while after the last failure
+        self._failures = MemoryCache(
+            max_size=1024, ttl_seconds=2 * max_backoff_seconds, clock=clock
+        )
+        self._condition = threading.Condition()
+        # started on first use, so gunicorn workers forked from a preloaded master each get their own threads
+        self._executor: Union[ThreadPoolExecutor, None] = None
+
+    def submit(self, search_query: str) -> bool:
+        """Queues a refresh of the query unless one is already pending, the queue is full or the query is backing
+        off after a failed refresh. Never blocks on the refresh itself. Returns whether it was queued."""
+        key = db.normalize_query(search_query)
+        failures = self._failures.get(key)
+        with self._condition:
+            if key in self._pending:
+                background_refreshes.inc(outcome="duplicate")
+                return False
+            if failures is not None and self.clock() < failures[1]:
+                background_refreshes.inc(outcome="backoff")
+                return False
+            if len(self._pending) >= self.max_pending:
+                background_refreshes.inc(outcome="dropped")
+                return False
+            self._pending.add(key)
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    self.max_workers, thread_name_prefix="cache-refresh"
+                )
+            executor = self._executor
+        background_refreshes.inc(outcome="queued")
+        executor.submit(self.run, key)
+        return True
+
+    def run(self, search_query: str):
+        try:
+            self.refresh(search_query)
+        except Exception as error:
+            # the stale row keeps being served and a hit after the backoff queues another attempt
+            background_refreshes.inc(outcome="failed")
+            logging.warning(f"Background refresh of {search_query!r} failed: {error!r}")
+            self.record_failure(search_query)
+        else:
+            self._failures.invalidate(search_query)
+            background_refreshes.inc(outcome="refreshed")
+            logging.debug(f"Refreshed cached search {search_query!r}")
+        finally:
+            with self._condition:
+                self._pending.discard(search_query)
+                self._condition.notify_all()
+
+    def record_failure(self, search_query: str):
+        previous = self._failures.get(search_query)
+        failures = 1 if previous is None else previous[0] + 1
+        delay = min(
+            self.backoff_seconds * 2 ** (failures - 1), self.max_backoff_seconds
+        )
+        self._failures.set(search_query, (failures, self.clock() + delay))
+
+    def join(self, timeout: Union[float, None] = None) -> bool:
+        """Blocks until no refresh is queued or running. Returns False if timeout passed first."""
+        with self._condition:
+            return self._condition.wait_for(lambda: not self._pending, timeout)
+
+    def close(self):
+        with self._condition:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
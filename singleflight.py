@@ -0,0 +1,135 @@
+"""Collapses concurrent identical Nutritionix fetches into one call."""
+import os
+import time
+import uuid
+import logging
+import threading
+from typing import Any, Callable, Hashable, Union
+
+import db
+
+
+class InflightCall:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Union[BaseException, None] = None
+
+
+class SingleFlight:
+    """Runs a function once per key at a time within the process.
+
+    The first caller for a key runs the function; callers arriving while it is running block and receive
+    the same result (or exception) instead of calling it again.
+    """
+
+    def __init__(self):
+        self.leaders = 0
+        self.followers = 0
+        self._calls: dict[Hashable, InflightCall] = {}
+        self._lock = threading.Lock()
+
+    def do(self, key: Hashable, function: Callable[[], Any]) -> Any:
+        with self._lock:
+            inflight = self._calls.get(key)
+            if inflight is None:
+                call = self._calls[key] = InflightCall()
+                self.leaders += 1
+            else:
+                call = inflight
+                self.followers += 1
+        if inflight is not None:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = function()
+        except BaseException as error:
+            call.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+
+class CrossProcessFetchLock:
+    """Lets gunicorn workers share one fetch per query through the InflightFetches table in searches.db.
+
+    Args:
+    - ttl_seconds(float) - how long a claim is honoured before another worker may take it over
+    - linger_seconds(float) - how long a finished response stays readable for waiting workers
+    - poll_interval_seconds(float) - how often a waiting worker checks for the response
+    """
+
+    def __init__(
+        self,
+        ttl_seconds: float = 15.0,
+        linger_seconds: float = 5.0,
+        poll_interval_seconds: float = 0.05,
+    ):
+        self.ttl_seconds = ttl_seconds
+        self.linger_seconds = linger_seconds
+        self.poll_interval_seconds = poll_interval_seconds
+        self.token = uuid.uuid4().hex
+
+    @property
+    def owner(self) -> str:
+        # read per call: workers forked from a preloaded gunicorn master share the instance but not the pid
+        return f"{os.getpid()}-{self.token}"
+
+    def fetch(self, search_query: str, function: Callable[[], str]) -> str:
+        """Returns the raw response another worker fetched for the query, or runs function and publishes its
+        result. Falls back to fetching directly if the other worker fails or its claim expires."""
+        store = db.cache_store
+        deadline = time.monotonic() + self.ttl_seconds
+        while not store.claim_inflight_fetch(
+            search_query, self.owner, self.ttl_seconds
+        ):
+            inflight = store.get_inflight_fetch(search_query)
+            if inflight is not None and inflight[0] is not None:
+                logging.debug("Reused response fetched by another worker")
+                return inflight[0]
+            if time.monotonic() >= deadline:
+                return function()
+            time.sleep(self.poll_interval_seconds)
+        try:
+            raw = function()
+        except BaseException:
+            store.release_inflight_fetch(search_query, self.owner)
+            raise
+        store.complete_inflight_fetch(
+            search_query, self.owner, raw, self.linger_seconds
+        )
+        return raw
+
+
+upstream_fetches = SingleFlight()
+
+# off by default: with a single worker the in-process SingleFlight already covers every request
+cross_process_fetch_lock: Union[CrossProcessFetchLock, None] = (
+    CrossProcessFetchLock()
+    if os.environ.get("CROSS_PROCESS_FETCH_LOCK", "0") == "1"
+    else None
+)
+
+
+def fetch_once(
+    search_query: str, function: Callable[[], str], namespace: str = ""
+) -> str:
+    """Runs function (a Nutritionix fetch for search_query) at most once across concurrent identical queries.
+
+    Args:
+    - namespace(String) - kind of fetch, e.g. "batch" for newline separated queries, whose normalized text could
+      otherwise equal a single query's ("apple\nbanana" and "apple banana")
+    """
+    lock_key = f"{namespace}\x00{search_query}" if namespace else search_query
+
+    def fetch() -> str:
+        if cross_process_fetch_lock is None:
+            return function()
+        return cross_process_fetch_lock.fetch(lock_key, function)
+
+    return upstream_fetches.do((namespace, db.normalize_query(search_query)), fetch)
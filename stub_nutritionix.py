@@ -0,0 +1,230 @@
+"""Local stand-in for the Nutritionix natural language endpoint, for offline tests and benchmarks.
+
+Serves the raw responses recorded in searches.db, can inject latency and errors and can enforce a quota:
+
+    python stub_nutritionix.py --port 8099 --latency 0.2 --error-rate 0.1
+    NUTRITIONIX_URL=http://127.0.0.1:8099 flask --app main run
+"""
+import sys
+import json
+import time
+import random
+import sqlite3
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Union
+
+import db
+
+NO_MATCH_RESPONSE = {"message": "We couldn't match any of your foods"}
+QUOTA_EXCEEDED_RESPONSE = {"message": "usage limits exceeded"}
+
+
+def synthesize_food_response(query: str) -> dict:
+    """A plausible single food response for any query, deterministic per query, for load tests."""
+    name = db.normalize_query(query) or "food"
+    rng = random.Random(name)
+    fructose, glucose, sucrose = (round(rng.uniform(0, 8), 2) for _ in range(3))
+    return {
+        "foods": [
+            {
+                "food_name": name,
+                "serving_qty": 1,
+                "serving_unit": "cup",
+                "serving_weight_grams": round(rng.uniform(20, 250), 1),
+                "tags": {"item": name, "measure": None, "quantity": "1.0"},
+                "full_nutrients": [
+                    {"attr_id": 210, "value": sucrose},
+                    {"attr_id": 211, "value": glucose},
+                    {"attr_id": 212, "value": fructose},
+                    {"attr_id": 269, "value": round(fructose + glucose + sucrose, 2)},
+                ],
+            }
+        ]
+    }
+
+
+def load_recorded_responses(database_path: str = db.DATABASE_PATH) -> dict:
+    """Returns the parsed raw responses cached in searches.db keyed by normalized query."""
+    connection = sqlite3.connect(database_path)
+    if db.table_exists(connection, "SearchCache"):
+        rows = connection.execute(
+            "SELECT query, raw FROM SearchCache WHERE raw != ''"
+        ).fetchall()
+    else:
+        rows = connection.execute(
+            "SELECT query, raw FROM Searches WHERE raw != '' AND query IS NOT NULL ORDER BY id"
+        ).fetchall()
+    connection.close()
+    responses = {}
+    for query, raw in rows:
+        try:
+            response = json.loads(db.decode_payload(raw))
+        except ValueError:
+            continue
+        if response.get("foods"):
+            responses[db.normalize_query(query)] = response
+    return responses
+
+
+class StubNutritionixHandler(BaseHTTPRequestHandler):
+    server: "StubNutritionixServer"
+    protocol_version = "HTTP/1.1"
+    # send headers and body in one segment; separate small writes stall keep-alive clients on delayed ACKs
+    wbufsize = 64 * 1024
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        query = json.loads(body or b"{}").get("query", "")
+        status, response = self.server.respond(query)
+        encoded = json.dumps(response).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(encoded)))
+        self.end_headers()
+        self.wfile.write(encoded)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubNutritionixServer(ThreadingHTTPServer):
+    """Threaded HTTP server answering POST /v2/natural/nutrients.
+
+    Args:
+    - responses(dict) - response body per normalized query; unknown queries get the 404 "no match" body
+    - latency_seconds(float) - delay added before every response
+    - error_rate(float) - fraction of requests answered with error_status
+    - fail_next(int) - number of upcoming requests answered with error_status regardless of error_rate
+    - synthesize_unknown(bool) - answer unknown queries with synthesize_food_response() instead of a 404
+    - quota(int) - requests answered per quota_window_seconds before the rest get a 429, 0 for no limit
+    """
+
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(
+        self,
+        address: tuple = ("127.0.0.1", 0),
+        responses: Union[dict, None] = None,
+        latency_seconds: float = 0.0,
+        error_rate: float = 0.0,
+        error_status: int = 500,
+        fail_next: int = 0,
+        synthesize_unknown: bool = False,
+        quota: int = 0,
+        quota_window_seconds: float = 60.0,
+    ):
+        super().__init__(address, StubNutritionixHandler)
+        self.responses = responses if responses is not None else {}
+        self.latency_seconds = latency_seconds
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.fail_next = fail_next
+        self.synthesize_unknown = synthesize_unknown
+        self.quota = quota
+        self.quota_window_seconds = quota_window_seconds
+        self.quota_rejections = 0
+        self.answered_at: list[float] = []
+        self.call_count = 0
+        self.queries: list[str] = []
+        self._lock = threading.Lock()
+        self._thread: Union[threading.Thread, None] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        # an AF_INET server address is a (str, int) pair; the bytes variant only exists for AF_UNIX
+        assert isinstance(host, str)
+        return f"http://{host}:{port}"
+
+    def respond(self, query: str) -> tuple[int, dict]:
+        with self._lock:
+            self.call_count += 1
+            self.queries.append(query)
+            failing = self.fail_next > 0 or random.random() < self.error_rate
+            if self.fail_next > 0:
+                self.fail_next -= 1
+            if self.quota:
+                now = time.monotonic()
+                self.answered_at = [
+                    answered_at
+                    for answered_at in self.answered_at
+                    if now - answered_at < self.quota_window_seconds
+                ]
+                if len(self.answered_at) >= self.quota:
+                    self.quota_rejections += 1
+                    return 429, QUOTA_EXCEEDED_RESPONSE
+                self.answered_at.append(now)
+        if self.latency_seconds:
+            time.sleep(self.latency_seconds)
+        if failing:
+            return self.error_status, {"message": "Injected upstream error"}
+        # like the real endpoint, a multi line query returns the foods of every line it could match
+        foods = []
+        for line in query.splitlines() or [query]:
+            response = self.responses.get(db.normalize_query(line))
+            if response is None and self.synthesize_unknown:
+                response = synthesize_food_response(line)
+            if response is not None:
+                foods.extend(response["foods"])
+        if not foods:
+            return 404, NO_MATCH_RESPONSE
+        return 200, {"foods": foods}
+
+    def start(self) -> "StubNutritionixServer":
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Run a local stub Nutritionix API.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8099)
+    parser.add_argument("--database", default=db.DATABASE_PATH)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--error-status", type=int, default=500)
+    parser.add_argument(
+        "--quota",
+        type=int,
+        default=0,
+        help="answer 429 after this many requests per --quota-window seconds",
+    )
+    parser.add_argument("--quota-window", type=float, default=60.0)
+    parser.add_argument(
+        "--synthesize-unknown",
+        action="store_true",
+        help="answer unknown foods with generated nutrients instead of a 404",
+    )
+    args = parser.parse_args(argv)
+
+    server = StubNutritionixServer(
+        (args.host, args.port),
+        responses=load_recorded_responses(args.database),
+        latency_seconds=args.latency,
+        error_rate=args.error_rate,
+        error_status=args.error_status,
+        synthesize_unknown=args.synthesize_unknown,
+        quota=args.quota,
+        quota_window_seconds=args.quota_window,
+    )
+    print(f"Stub Nutritionix serving {len(server.responses)} foods on {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,127 +1,2113 @@
+import io
+import os
+import json
+import queue
+import asyncio
+import logging
+import pstats
+import sqlite3
+import tempfile
+import time
+import threading
 import unittest
-from model import IngredientNutrientResult
+from typing import Any
+from unittest import mock
+
+import db
+import asgi
+import benchmark
+import bulk
+import fooddata
+import logs
+import metrics
+import quota
+import model
+import profiling
+import singleflight
+import warmup
+from cache import MemoryCache
+import main
+from model import materialize_verdict_from_response, resolve_ingredient
+from nutrients import (
+    NutrientBatch,
+    evaluate,
+    evaluate_granular_nutrients_exist,
+    evaluate_if_ingredient_is_under_allowable_fructose_limit,
+    evaluate_materialized_verdict,
+    extract_nutrient_values,
+    round_like_python,
+    trim_response,
+)
+from queries import ParsedQuery, parse_query
+from refresh import BackgroundRefresher
+from nutritionix import (
+    CircuitBreaker,
+    CircuitOpenError,
+    NutritionixClient,
+    UpstreamError,
+)
+from stub_nutritionix import StubNutritionixServer, load_recorded_responses
+from singleflight import CrossProcessFetchLock, SingleFlight, fetch_once
 
 
 class food_that_has_less_than_allowed_limit_fructose(unittest.TestCase):
     def setUp(self) -> None:
-        self.search_object = IngredientNutrientResult("apple")
-        self.search_object.grams_fructose_per_single_serving_of_ingredient = 0.0
-        self.search_object.proportion_of_fructose_per_gram_of_ingredient = 0.0
-        self.search_object.total_fructose = 2.5  # total fructose
-
-        self.search_object.quantity_of_servings = 0.0
-        self.search_object.serving_unit = ""
-        self.search_object.total_weight_grams = 0.0
-        self.search_object.ingredient_name = ""
-
+        self.total_fructose = 2.5  # total fructose
         return super().setUp()
 
     def tests_detail_evaluation_correct_details_exist(self):
-        self.search_object.total_sugars_calculated = 2.5
-        self.search_object.total_sugar_from_api = 2.5
-        result = self.search_object.evaluate_granular_nutrients_exist()
+        result = evaluate_granular_nutrients_exist(2.5, 2.5)
         self.assertEqual(result, True)
 
     def tests_fructose_limit_correctly_evaluated_with_details(self):
-        self.search_object.total_sugars_calculated = 1
-        self.search_object.total_sugar_from_api = 2.5
-        result = (
-            self.search_object.evaluate_if_ingredient_is_under_allowable_fructose_limit()
+        has_detailed_nutrients = evaluate_granular_nutrients_exist(1, 2.5)
+        result = evaluate_if_ingredient_is_under_allowable_fructose_limit(
+            has_detailed_nutrients, self.total_fructose, 2.5
         )
         self.assertEqual(result, True)
 
     def tests_fructose_limit_correctly_evaluated_without_details(self):
-        self.search_object.total_sugars_calculated = 0
-        self.search_object.total_sugar_from_api = 2.5
-        result = (
-            self.search_object.evaluate_if_ingredient_is_under_allowable_fructose_limit()
+        has_detailed_nutrients = evaluate_granular_nutrients_exist(0, 2.5)
+        result = evaluate_if_ingredient_is_under_allowable_fructose_limit(
+            has_detailed_nutrients, self.total_fructose, 2.5
         )
         self.assertEqual(result, True)
 
 
 class food_that_has_greater_than_allowed_limit_fructose(unittest.TestCase):
     def setUp(self) -> None:
-        self.search_object = IngredientNutrientResult("apple")
-        self.search_object.grams_fructose_per_single_serving_of_ingredient = 0.0
-        self.search_object.proportion_of_fructose_per_gram_of_ingredient = 0.0
-        self.search_object.total_fructose = 3.5  # total fructose
-        self.search_object.total_sugars_calculated = 0
-        self.search_object.total_sugar_from_api = 0
-        self.search_object.quantity_of_servings = 0.0
-        self.search_object.serving_unit = ""
-        self.search_object.total_weight_grams = 0.0
-        self.search_object.ingredient_name = ""
+        self.total_fructose = 3.5  # total fructose
         return super().setUp()
 
     def tests_detail_evaluation_no_details(self):
-        self.search_object.total_sugars_calculated = 0
-        self.search_object.total_sugar_from_api = 2.5
-        result = self.search_object.evaluate_granular_nutrients_exist()
+        result = evaluate_granular_nutrients_exist(0, 2.5)
         self.assertEqual(result, False)
 
     def tests_fructose_limit_correctly_evaluated_for_greater_than_allowed_limit(self):
-        result = (
-            self.search_object.evaluate_if_ingredient_is_under_allowable_fructose_limit()
+        has_detailed_nutrients = evaluate_granular_nutrients_exist(0, 0)
+        result = evaluate_if_ingredient_is_under_allowable_fructose_limit(
+            has_detailed_nutrients, self.total_fructose, 0
         )
         self.assertEqual(result, False)
 
     def tests_fructose_limit_correctly_evaluated_with_details_and_greater_than_allowed(
         self,
     ):
-        self.search_object.total_sugars_calculated = 1
-        self.search_object.total_sugar_from_api = 2.5
-        result = (
-            self.search_object.evaluate_if_ingredient_is_under_allowable_fructose_limit()
+        has_detailed_nutrients = evaluate_granular_nutrients_exist(1, 2.5)
+        result = evaluate_if_ingredient_is_under_allowable_fructose_limit(
+            has_detailed_nutrients, self.total_fructose, 2.5
         )
         self.assertEqual(result, False)
 
     def tests_fructose_limit_correctly_evaluated_without_details_and_greater_than_allowed(
         self,
     ):
-        self.search_object.total_sugars_calculated = 0
-        self.search_object.total_sugar_from_api = 3.5
-        result = (
-            self.search_object.evaluate_if_ingredient_is_under_allowable_fructose_limit()
+        has_detailed_nutrients = evaluate_granular_nutrients_exist(0, 3.5)
+        result = evaluate_if_ingredient_is_under_allowable_fructose_limit(
+            has_detailed_nutrients, self.total_fructose, 3.5
         )
         self.assertEqual(result, False)
 
+    def tests_evaluate_gives_allowed_amount_of_ingredient(self):
+        verdict = evaluate(APPLE_RESPONSE)
+        self.assertEqual(verdict.total_fructose, 12.6)
+        self.assertEqual(verdict.is_under_allowable_fructose_limit, False)
+        self.assertAlmostEqual(
+            verdict.grams_fructose_per_single_serving_of_ingredient, 3 / (12.6 / 182)
+        )
+        self.assertAlmostEqual(
+            verdict.proportion_of_fructose_per_gram_of_ingredient, 3 / 12.6
+        )
+        self.assertEqual(
+            evaluate(APPLE_RESPONSE, 15).is_under_allowable_fructose_limit, True
+        )
+
 
-class test_user_input(unittest.TestCase):
-    def tests_user_submits_inedible_food(self):
-        self.search_object = IngredientNutrientResult("1 apple")
-        self.search_object.get_nutrient_raw_response()
-        result = (
-            self.search_object.evaluate_if_ingredient_is_under_allowable_fructose_limit()
+APPLE_RESPONSE = {
+    "foods": [
+        {
+            "food_name": "apple",
+            "serving_unit": 'medium (3" dia)',
+            "serving_weight_grams": 182,
+            "tags": {"item": "apple", "measure": None, "quantity": "1.0"},
+            "full_nutrients": [
+                {"attr_id": 203, "value": 0.4732},
+                {"attr_id": 210, "value": 3.7674},
+                {"attr_id": 211, "value": 4.4226},
+                {"attr_id": 212, "value": 10.738},
+                {"attr_id": 269, "value": 18.9098},
+            ],
+        }
+    ]
+}
+
+
+def make_food_response(
+    name, fructose, glucose, sucrose, sugar, serving_weight_grams=100, quantity="1.0"
+):
+    return {
+        "foods": [
+            {
+                "food_name": name,
+                "serving_unit": "cup",
+                "serving_weight_grams": serving_weight_grams,
+                "tags": {"item": name, "measure": None, "quantity": quantity},
+                "full_nutrients": [
+                    {"attr_id": 210, "value": sucrose},
+                    {"attr_id": 211, "value": glucose},
+                    {"attr_id": 212, "value": fructose},
+                    {"attr_id": 269, "value": sugar},
+                ],
+            }
+        ]
+    }
+
+
+PARSED_APPLE = {
+    "name": "apple",
+    "serving_unit": 'medium (3" dia)',
+    "serving_size_grams": 182,
+    "item": "apple",
+    "measure": None,
+    "quantity": 1,
+    "fructose": 10.7,
+    "glucose": 4.4,
+    "sucrose": 3.8,
+}
+
+
+class cache_schema(unittest.TestCase):
+    def setUp(self) -> None:
+        handle, self.database_path = tempfile.mkstemp(suffix=".db")
+        os.close(handle)
+        return super().setUp()
+
+    def tearDown(self) -> None:
+        os.remove(self.database_path)
+        return super().tearDown()
+
+    def create_legacy_history(self, rows):
+        connection = sqlite3.connect(self.database_path)
+        connection.execute(
+            """CREATE TABLE Searches (id INTEGER PRIMARY Key AUTOINCREMENT NOT NULL,
+            Timestamp DATETIME DEFAULT CURRENT_TIMESTAMP, name TEXT, serving_unit TEXT,
+            serving_size_grams FLOAT, item TEXT, measure TEXT, quantity FLOAT, fructose_n FLOAT,
+            glucose_n FLOAT, sucrose FLOAT, query TEXT, raw TEXT)"""
         )
+        connection.executemany(
+            "INSERT INTO Searches (Timestamp, name, query, raw) VALUES (?, ?, ?, ?)",
+            rows,
+        )
+        connection.commit()
+        connection.close()
+
+    def tests_migration_collapses_history_without_losing_rows(self):
+        self.create_legacy_history(
+            [
+                ("2022-06-13 05:16:01", "apple", None, None),
+                ("2022-06-20 10:00:00", "apple", "Apple", '{"foods": []}'),
+                ("2022-06-21 10:00:00", "apple", " apple ", "{}"),
+                ("2022-06-22 10:00:00", "apple", "apple", ""),
+                ("2022-06-23 10:00:00", "kiwi", "kiwi", '{"foods": [1]}'),
+            ]
+        )
+        connection = db.connect(self.database_path)
+        rows = connection.execute(
+            "SELECT query, hit_count, first_seen, last_seen, raw FROM SearchCache ORDER BY query"
+        ).fetchall()
+        self.assertEqual(
+            rows,
+            [
+                (
+                    "apple",
+                    4,
+                    "2022-06-13 05:16:01",
+                    "2022-06-22 10:00:00",
+                    '{"foods": []}',
+                ),
+                (
+                    "kiwi",
+                    1,
+                    "2022-06-23 10:00:00",
+                    "2022-06-23 10:00:00",
+                    '{"foods": [1]}',
+                ),
+            ],
+        )
+        self.assertEqual(db.get_schema_version(connection), db.SCHEMA_VERSION)
+        self.assertEqual(db.migrate(connection), 0)
+        connection.close()
+
+    def tests_each_migration_stays_inside_its_transaction(self):
+        self.create_legacy_history([("2022-06-23 10:00:00", "kiwi", "kiwi", "")])
+        connection = sqlite3.connect(self.database_path)
+        statements = []
+        connection.set_trace_callback(statements.append)
+        for version in range(1, db.SCHEMA_VERSION + 1):
+            connection.execute("BEGIN IMMEDIATE")
+            statements.clear()
+            db.MIGRATIONS[version](connection)
+            # a migration that commits early would release migrate()'s write lock halfway through
+            self.assertNotIn("COMMIT", statements, f"v{version} committed early")
+            connection.commit()
+        connection.close()
+
+    def tests_record_search_upserts_single_row(self):
+        connection = db.connect(self.database_path)
+        db.record_search(connection, "Apple", PARSED_APPLE, '{"Foods": []}')
+        db.record_search(connection, "  apple", PARSED_APPLE)
+        rows = connection.execute(
+            "SELECT query, hit_count, raw FROM SearchCache"
+        ).fetchall()
+        self.assertEqual(
+            [(query, hits, db.decode_payload(raw)) for query, hits, raw in rows],
+            [("apple", 2, '{"Foods":[]}')],
+        )
+        self.assertEqual(db.lookup_raw_response(connection, "APPLE "), '{"foods":[]}')
+        self.assertIsNone(db.lookup_raw_response(connection, "kiwi"))
+        connection.close()
+
+    def tests_compaction_rewrites_text_payloads_once(self):
+        response = {
+            "foods": [
+                {
+                    "food_name": "kiwi",
+                    "serving_qty": 1,
+                    "serving_unit": "fruit",
+                    "serving_weight_grams": 69,
+                    "photo": {"thumb": "https://example.com/kiwi.jpg"},
+                    "tags": {"item": "kiwi", "measure": None, "quantity": "1"},
+                    "full_nutrients": [
+                        {"attr_id": 212, "value": 3},
+                        {"attr_id": 203, "value": 0.8},
+                    ],
+                }
+            ]
+        }
+        self.create_legacy_history(
+            [("2022-06-23 10:00:00", "kiwi", "kiwi", json.dumps(response))]
+        )
+        connection = db.connect(self.database_path)
+        rewritten, bytes_before, bytes_after = db.compact_payloads(connection)
+        self.assertEqual(rewritten, 1)
+        self.assertLess(bytes_after, bytes_before)
+        self.assertEqual(
+            json.loads(db.lookup_raw_response(connection, "kiwi")),
+            trim_response(response),
+        )
+        self.assertEqual(db.compact_payloads(connection), (0, 0, 0))
+        connection.close()
+
+    def tests_payload_read_timing_skips_rows_without_payloads(self):
+        connection = db.connect(self.database_path)
+        db.record_search(connection, "apple", PARSED_APPLE, '{"foods": []}')
+        db.record_search(connection, "kiwi", PARSED_APPLE, '{"foods": []}')
+        lookup_raw_response = db.lookup_raw_response
+
+        def lookup_deleted_kiwi(connection, search_query):
+            # as if kiwi were quarantined between listing the queries and reading them
+            if search_query == "kiwi":
+                return None
+            return lookup_raw_response(connection, search_query)
+
+        with mock.patch.object(db, "lookup_raw_response", lookup_deleted_kiwi):
+            self.assertGreater(db.time_payload_reads(connection, passes=1), 0.0)
+        connection.close()
+
+
+class memory_cache(unittest.TestCase):
+    def setUp(self) -> None:
+        self.now = 0.0
+        self.cache = MemoryCache(max_size=2, ttl_seconds=10, clock=lambda: self.now)
+        return super().setUp()
+
+    def tests_least_recently_used_entry_is_evicted(self):
+        self.cache.set("apple", {"foods": ["apple"]})
+        self.cache.set("banana", {"foods": ["banana"]})
+        self.cache.get("apple")
+        self.cache.set("kiwi", {"foods": ["kiwi"]})
+        self.assertIsNone(self.cache.get("banana"))
+        self.assertEqual(self.cache.get("apple"), {"foods": ["apple"]})
+        self.assertEqual(self.cache.stats()["evictions"], 1)
+
+    def tests_entries_expire_after_ttl(self):
+        self.cache.set("apple", {"foods": []})
+        self.now = 9.9
+        self.assertIsNotNone(self.cache.get("apple"))
+        self.now = 10.0
+        self.assertIsNone(self.cache.get("apple"))
+        self.assertEqual(self.cache.get_stale("apple"), {"foods": []})
+
+    def tests_hits_and_misses_are_counted(self):
+        self.cache.set("apple", {"foods": []})
+        self.cache.get("apple")
+        self.cache.get("pear")
+        stats = self.cache.stats()
+        self.assertEqual(
+            (stats["hits"], stats["misses"], stats["hit_ratio"]), (1, 1, 0.5)
+        )
+
+
+class materialized_verdicts(unittest.TestCase):
+    def setUp(self) -> None:
+        handle, self.database_path = tempfile.mkstemp(suffix=".db")
+        os.close(handle)
+        self.connection = db.connect(self.database_path)
+        return super().setUp()
+
+    def tearDown(self) -> None:
+        self.connection.close()
+        os.remove(self.database_path)
+        return super().tearDown()
+
+    def tests_backfill_materializes_rows_with_raw_payloads(self):
+        db.record_search(
+            self.connection, "apple", PARSED_APPLE, json.dumps(APPLE_RESPONSE)
+        )
+        db.record_search(
+            self.connection, "nonsense", PARSED_APPLE, '{"message": "no match"}'
+        )
+        self.assertIsNone(db.lookup_verdict(self.connection, "apple"))
+        materialized, failed = db.backfill_verdicts(
+            self.connection, materialize_verdict_from_response
+        )
+        self.assertEqual((materialized, failed), (1, 1))
+        verdict = db.lookup_verdict(self.connection, "Apple")
+        self.assertEqual(verdict["total_sugar"], 18.9)
+        self.assertEqual(verdict["has_detailed_nutrients"], 1)
+        self.assertAlmostEqual(verdict["fructose_per_gram"], 12.6 / 182)
+
+    def tests_verdict_rebuilds_the_parsed_result(self):
+        parsed = evaluate(APPLE_RESPONSE, 5)
+        db.record_search(
+            self.connection,
+            "apple",
+            parsed.parsed_nutrient_response,
+            "",
+            parsed.materialized_verdict,
+        )
+        rebuilt = evaluate_materialized_verdict(
+            db.lookup_verdict(self.connection, "apple"), 5
+        )
+        for attribute in (
+            "total_fructose",
+            "total_sugar_from_api",
+            "has_detailed_nutrients",
+            "is_under_allowable_fructose_limit",
+            "grams_fructose_per_single_serving_of_ingredient",
+            "proportion_of_fructose_per_gram_of_ingredient",
+        ):
+            self.assertEqual(getattr(rebuilt, attribute), getattr(parsed, attribute))
+
+    def tests_verdict_is_immutable_and_has_no_instance_dict(self):
+        verdict = evaluate(APPLE_RESPONSE)
+        with self.assertRaises(AttributeError):
+            verdict.total_fructose = 0.0
+        self.assertFalse(hasattr(verdict, "__dict__"))
+
+
+class cache_store(unittest.TestCase):
+    def setUp(self) -> None:
+        self.directory = tempfile.TemporaryDirectory()
+        self.database_path = os.path.join(self.directory.name, "searches.db")
+        self.store = db.CacheStore(self.database_path, max_batch_size=64)
+        return super().setUp()
+
+    def tearDown(self) -> None:
+        self.store.close()
+        self.directory.cleanup()
+        return super().tearDown()
+
+    def tests_connections_use_wal_and_are_reused_per_thread(self):
+        connection = self.store.connection()
+        self.assertIs(self.store.connection(), connection)
+        journal_mode = connection.execute("PRAGMA journal_mode").fetchone()[0]
+        self.assertEqual(journal_mode, "wal")
+        other_threads_connection = []
+        thread = threading.Thread(
+            target=lambda: other_threads_connection.append(self.store.connection())
+        )
+        thread.start()
+        thread.join()
+        self.assertIsNot(other_threads_connection[0], connection)
+
+    def tests_concurrent_write_behind_loses_no_writes(self):
+        def record_searches(thread_number):
+            for search_number in range(250):
+                self.store.record_search(
+                    f"food {search_number % 50}",
+                    PARSED_APPLE,
+                    f'{{"t": {thread_number}}}',
+                )
+
+        threads = [
+            threading.Thread(target=record_searches, args=(thread_number,))
+            for thread_number in range(8)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.store.close()
+
+        connection = db.connect(self.database_path)
+        rows, hits = connection.execute(
+            "SELECT COUNT(*), SUM(hit_count) FROM SearchCache"
+        ).fetchone()
+        connection.close()
+        self.assertEqual((rows, hits), (50, 8 * 250))
+
+    def tests_flush_makes_queued_writes_visible(self):
+        self.store.record_search("apple", PARSED_APPLE, json.dumps(APPLE_RESPONSE))
+        self.store.flush()
+        self.assertEqual(
+            json.loads(self.store.lookup_raw_response("apple")),
+            trim_response(json.loads(json.dumps(APPLE_RESPONSE).lower())),
+        )
+
+    def tests_writer_survives_a_failed_batch(self):
+        commit_batch = self.store.commit_batch
+        with mock.patch.object(
+            self.store,
+            "commit_batch",
+            side_effect=[sqlite3.IntegrityError("injected"), commit_batch],
+        ):
+            with self.assertLogs(level="ERROR"):
+                self.store.record_search(
+                    "kiwi", PARSED_APPLE, json.dumps(APPLE_RESPONSE)
+                )
+                self.store.flush(timeout=5)
+        self.store.record_search("apple", PARSED_APPLE, json.dumps(APPLE_RESPONSE))
+        self.store.flush(timeout=5)
+        self.assertIsNone(self.store.lookup_raw_response("kiwi"))
+        self.assertIsNotNone(self.store.lookup_raw_response("apple"))
+
+    def tests_locked_batches_are_retried_with_backoff(self):
+        connection = mock.MagicMock()
+        connection.executemany.side_effect = [
+            sqlite3.OperationalError("database is locked"),
+            sqlite3.OperationalError("database is locked"),
+            None,
+        ]
+        with mock.patch.object(db.time, "sleep") as sleep, self.assertLogs(
+            level="WARNING"
+        ):
+            self.store.commit_batch(connection, [()])
+        self.assertEqual(connection.executemany.call_count, 3)
+        self.assertEqual(
+            [call.args[0] for call in sleep.call_args_list],
+            [self.store.retry_backoff_seconds, 2 * self.store.retry_backoff_seconds],
+        )
+
+    def tests_flush_does_not_hang_on_a_stopped_writer(self):
+        unblock = threading.Event()
+        with mock.patch.object(
+            self.store, "commit_batch", side_effect=lambda *_: unblock.wait()
+        ):
+            self.store.record_search("apple", PARSED_APPLE)
+            with self.assertRaises(TimeoutError):
+                self.store.flush(timeout=0.2)
+            unblock.set()
+            self.store.flush(timeout=5)
+        dead_writer = threading.Thread(target=lambda: None)
+        dead_writer.start()
+        dead_writer.join()
+        with mock.patch.object(self.store, "_writer", dead_writer):
+            self.store._writes.put(db.search_record_parameters("kiwi", PARSED_APPLE))
+            with self.assertRaises(RuntimeError):
+                self.store.flush(timeout=5)
+            self.store._writes.get_nowait()
+            self.store._writes.task_done()
+
+
+class nutritionix_client(unittest.TestCase):
+    def setUp(self) -> None:
+        self.server = StubNutritionixServer(responses={"apple": APPLE_RESPONSE}).start()
+        self.client = NutritionixClient(
+            base_url=self.server.url,
+            read_timeout=0.5,
+            max_retries=2,
+            circuit_breaker=CircuitBreaker(
+                failure_threshold=2, reset_timeout_seconds=60
+            ),
+            sleep=lambda seconds: None,
+        )
+        return super().setUp()
+
+    def tearDown(self) -> None:
+        self.server.stop()
+        return super().tearDown()
+
+    def tests_retries_server_errors_then_succeeds(self):
+        self.server.fail_next = 2
+        response = json.loads(self.client.fetch_natural_nutrients("Apple"))
+        self.assertEqual(response, APPLE_RESPONSE)
+        self.assertEqual(self.server.call_count, 3)
+
+    def tests_unmatched_food_is_returned_without_retrying(self):
+        response = json.loads(self.client.fetch_natural_nutrients("assfgasf"))
+        self.assertIn("message", response)
+        self.assertEqual(self.server.call_count, 1)
+
+    def tests_rejected_requests_are_errors_not_answers(self):
+        self.server.error_status = 401
+        self.server.fail_next = 1
+        with self.assertRaises(UpstreamError):
+            self.client.fetch_natural_nutrients("apple")
+        self.assertEqual(self.server.call_count, 1)
+        self.assertEqual(self.client.circuit_breaker.consecutive_failures, 1)
+
+        self.server.error_status = 400
+        self.server.fail_next = 1
+        with self.assertRaises(UpstreamError):
+            self.client.fetch_natural_nutrients("apple")
+        self.assertEqual(self.server.call_count, 2)
+        # a bad request is not a success that would reset the breaker either
+        self.assertEqual(self.client.circuit_breaker.consecutive_failures, 1)
+
+    def tests_read_timeout_is_enforced(self):
+        self.server.latency_seconds = 1.0
+        with self.assertRaises(UpstreamError):
+            self.client.fetch_natural_nutrients("apple")
+
+    def tests_circuit_opens_and_fails_fast(self):
+        self.server.error_rate = 1.0
+        for _ in range(2):
+            with self.assertRaises(UpstreamError):
+                self.client.fetch_natural_nutrients("apple")
+        calls_before_open = self.server.call_count
+        with self.assertRaises(CircuitOpenError):
+            self.client.fetch_natural_nutrients("apple")
+        self.assertEqual(self.server.call_count, calls_before_open)
+
+    def tests_stale_memory_entry_is_served_while_circuit_is_open(self):
+        verdict = materialize_verdict_from_response(APPLE_RESPONSE)
+        stale_cache = MemoryCache(ttl_seconds=-1)
+        stale_cache.set("apple", verdict)
+        self.client.circuit_breaker.record_failure()
+        self.client.circuit_breaker.record_failure()
+        # every cache tier below memory misses in an empty database, never the committed searches.db
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        store = db.CacheStore(os.path.join(directory.name, "searches.db"))
+        self.addCleanup(store.close)
+        with mock.patch.object(
+            model, "nutritionix_client", self.client
+        ), mock.patch.object(
+            model, "nutrient_verdict_cache", stale_cache
+        ), mock.patch.object(
+            model, "unmatched_query_cache", MemoryCache()
+        ), mock.patch.object(
+            db, "cache_store", store
+        ):
+            result = resolve_ingredient("apple")
+            with self.assertRaises(CircuitOpenError):
+                resolve_ingredient("kiwi")
+        self.assertEqual(result.verdict.ingredient_name, "apple")
+        self.assertEqual(self.server.call_count, 0)
+
+
+class offline_app_test_case(unittest.TestCase):
+    """Runs the model and routes against a temporary cache database and a stub Nutritionix server."""
+
+    responses: dict = {}
+
+    def setUp(self) -> None:
+        self.directory = tempfile.TemporaryDirectory()
+        self.store = db.CacheStore(os.path.join(self.directory.name, "searches.db"))
+        self.server = StubNutritionixServer(responses=self.responses).start()
+        self.client = NutritionixClient(base_url=self.server.url, sleep=lambda _: None)
+        self.refresher = BackgroundRefresher(model.refresh_cached_search)
+        self.patches: list[Any] = [
+            mock.patch.object(model, "background_refresher", self.refresher),
+            mock.patch.object(db, "cache_store", self.store),
+            mock.patch.object(model, "nutritionix_client", self.client),
+            mock.patch.object(model, "nutrient_verdict_cache", MemoryCache()),
+            mock.patch.object(model, "unmatched_query_cache", MemoryCache()),
+            mock.patch.object(model, "freshness_checks", MemoryCache()),
+            mock.patch.object(main, "rendered_result_cache", MemoryCache()),
+        ]
+        for patch in self.patches:
+            patch.start()
+        self.app = main.app.test_client()
+        return super().setUp()
+
+    def tearDown(self) -> None:
+        self.refresher.close()
+        for patch in reversed(self.patches):
+            patch.stop()
+        self.server.stop()
+        self.store.close()
+        self.directory.cleanup()
+        return super().tearDown()
+
+
+class test_user_input(offline_app_test_case):
+    responses = dict(
+        load_recorded_responses("searches.db"),
+        **{
+            "12413523314 apples": make_food_response(
+                "apple", 133613e6, 55025e6, 46877e6, 235302e6, 2261e9, "12413523314.0"
+            ),
+            "0 apples": make_food_response("apple", 0, 0, 0, 0, 0, "0.0"),
+        },
+    )
+
+    def tests_user_submits_inedible_food(self):
+        result = resolve_ingredient("1 apple").verdict.is_under_allowable_fructose_limit
         self.assertEqual(result, False)
 
     def tests_user_submits_gibberish(self):
-        self.search_object = IngredientNutrientResult("assfgasf")
         with self.assertRaises(KeyError):
-            self.search_object.get_nutrient_raw_response()
+            resolve_ingredient("assfgasf")
 
     def tests_user_submits_only_numbers(self):
-        self.search_object = IngredientNutrientResult("12413523314")
         with self.assertRaises(KeyError):
-            self.search_object.get_nutrient_raw_response()
+            resolve_ingredient("12413523314")
 
     def tests_user_submits_empty_string(self):
-        self.search_object = IngredientNutrientResult("")
         with self.assertRaises(KeyError):
-            self.search_object.get_nutrient_raw_response()
+            resolve_ingredient("")
 
     def tests_user_submits_only_large_quantity(self):
-        self.search_object = IngredientNutrientResult("12413523314 apples")
-        self.search_object.get_nutrient_raw_response()
-        result = (
-            self.search_object.evaluate_if_ingredient_is_under_allowable_fructose_limit()
-        )
+        result = resolve_ingredient(
+            "12413523314 apples"
+        ).verdict.is_under_allowable_fructose_limit
         self.assertEqual(result, False)
 
     def tests_user_submits_only_0_of_something(self):
-        self.search_object = IngredientNutrientResult("0 apples")
-        self.search_object.get_nutrient_raw_response()
-        result = (
-            self.search_object.evaluate_if_ingredient_is_under_allowable_fructose_limit()
-        )
+        result = resolve_ingredient(
+            "0 apples"
+        ).verdict.is_under_allowable_fructose_limit
         self.assertEqual(result, True)
+
+
+MEAL_RESPONSES = {
+    f"food {number}": make_food_response(f"food {number}", 0.2, 0.2, 0.2, 0.6)
+    for number in range(10)
+}
+
+
+class batch_ingredients(offline_app_test_case):
+    responses = dict(
+        MEAL_RESPONSES,
+        **{
+            "ham and eggs": {
+                "foods": make_food_response("ham", 0, 0, 0, 0)["foods"]
+                + make_food_response("eggs", 0.1, 0.1, 0, 0.2)["foods"]
+            }
+        },
+    )
+
+    def tests_meal_costs_one_upstream_call(self):
+        for number in range(2):
+            resolve_ingredient(f"food {number}").insert_results_into_cache()
+        self.store.flush()
+        self.server.call_count = 0
+        self.server.queries.clear()
+
+        search_queries = "\n".join(f"food {number}" for number in range(10))
+        response = self.app.get(
+            "/api/v1/get_ingredients", query_string={"search_queries": search_queries}
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.server.call_count, 1)
+        self.assertEqual(len(self.server.queries[0].splitlines()), 8)
+        self.assertEqual(
+            [food["name"] for food in response.json["foods"]],
+            [f"food {number}" for number in range(10)],
+        )
+        self.assertEqual(response.json["t_fructose"], 3.0)
+        self.assertTrue(response.json["under_limit"])
+
+    def tests_unmatched_lines_are_reported(self):
+        response = self.app.post(
+            "/api/v1/get_ingredients", data={"search_queries": "food 1\nassfgasf\n"}
+        )
+        self.assertEqual(response.json["unmatched"], ["assfgasf"])
+        self.assertEqual(len(response.json["foods"]), 1)
+
+    def tests_foods_are_matched_to_lines_by_name_not_position(self):
+        # two foods for two lines, but both come from the second line
+        batch_results = model.resolve_ingredient_batch(["xyzzy", "ham and eggs"])
+        self.assertEqual(batch_results[0], ("xyzzy", None))
+        self.assertEqual(batch_results[1][1].verdict.ingredient_name, "ham")
+
+    def tests_foods_are_matched_to_whole_words(self):
+        ham = make_food_response("ham", 0, 0, 0, 0)["foods"][0]
+        apple = APPLE_RESPONSE["foods"][0]
+        # a dropped line must not hand its food to a line that merely contains the name
+        self.assertEqual(
+            model.match_foods_to_queries([ham, apple], ["graham cracker", "pineapple"]),
+            {},
+        )
+        self.assertEqual(
+            model.match_foods_to_queries(
+                [apple, ham], ["apple pie", "2 apples", "ham and eggs"]
+            ),
+            {"2 apples": apple, "ham and eggs": ham},
+        )
+        # a food that fits two lines equally well is left unmatched
+        self.assertEqual(
+            model.match_foods_to_queries([apple], ["apple pie", "apple crumble"]), {}
+        )
+
+    def tests_meal_form_renders_total(self):
+        response = self.app.post("/meal", data={"search_queries": "food 1\nfood 2"})
+        self.assertIn(b"0.6 grams of fructose", response.data)
+
+
+class request_coalescing(offline_app_test_case):
+    responses = {"apple": APPLE_RESPONSE}
+
+    def tests_simultaneous_identical_misses_make_one_upstream_call(self):
+        self.server.latency_seconds = 0.2
+        barrier = threading.Barrier(50)
+        results = []
+
+        def search():
+            barrier.wait()
+            results.append(resolve_ingredient("Apple").verdict.ingredient_name)
+
+        threads = [threading.Thread(target=search) for _ in range(50)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, ["apple"] * 50)
+        self.assertEqual(self.server.call_count, 1)
+
+    def tests_followers_receive_the_leaders_error(self):
+        flight = SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+        errors = []
+
+        def failing_fetch():
+            started.set()
+            release.wait()
+            raise UpstreamError("down")
+
+        def call():
+            try:
+                flight.do("apple", failing_fetch)
+            except UpstreamError as error:
+                errors.append(error)
+
+        leader = threading.Thread(target=call)
+        leader.start()
+        started.wait()
+        follower = threading.Thread(target=call)
+        follower.start()
+        while flight.followers == 0:
+            pass
+        release.set()
+        leader.join()
+        follower.join()
+        self.assertEqual(len(errors), 2)
+        self.assertEqual((flight.leaders, flight.followers), (1, 1))
+
+    def tests_batches_do_not_share_a_single_querys_flight(self):
+        started = threading.Event()
+        release = threading.Event()
+        results = []
+
+        def slow_batch_fetch():
+            started.set()
+            release.wait(5)
+            return "batch"
+
+        with mock.patch.object(singleflight, "upstream_fetches", SingleFlight()):
+            batch = threading.Thread(
+                target=lambda: results.append(
+                    fetch_once("apple\nbanana", slow_batch_fetch, namespace="batch")
+                )
+            )
+            batch.start()
+            self.assertTrue(started.wait(5))
+            # normalizes to the same text as the batch, but is a different request
+            results.append(fetch_once("apple banana", lambda: "single"))
+            release.set()
+            batch.join()
+        self.assertEqual(sorted(results), ["batch", "single"])
+
+    def tests_cross_process_lock_shares_the_fetched_response(self):
+        other_worker_store = db.CacheStore(self.store.database_path)
+        leader = CrossProcessFetchLock(poll_interval_seconds=0.01)
+        waiter = CrossProcessFetchLock(poll_interval_seconds=0.01)
+        fetch_started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def slow_fetch():
+            calls.append("leader")
+            fetch_started.set()
+            release.wait()
+            return '{"foods": []}'
+
+        leader_thread = threading.Thread(
+            target=leader.fetch, args=("apple", slow_fetch)
+        )
+        leader_thread.start()
+        fetch_started.wait()
+        with mock.patch.object(db, "cache_store", other_worker_store):
+            waiter_thread = threading.Thread(
+                target=lambda: calls.append(
+                    waiter.fetch("apple", lambda: calls.append("waiter") or "")
+                )
+            )
+            waiter_thread.start()
+            release.set()
+            leader_thread.join()
+            waiter_thread.join()
+        other_worker_store.close()
+        self.assertEqual(calls, ["leader", '{"foods": []}'])
+
+
+class async_serving(offline_app_test_case):
+    responses = {"apple": APPLE_RESPONSE}
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.async_client = asgi.AsyncNutritionixClient(
+            base_url=self.server.url, max_retries=0
+        )
+        self.async_patch = mock.patch.object(
+            asgi, "async_nutritionix_client", self.async_client
+        )
+        self.async_patch.start()
+
+    def tearDown(self) -> None:
+        self.async_patch.stop()
+        return super().tearDown()
+
+    def resolve(self, *search_queries):
+        async def resolve_all():
+            try:
+                return await asyncio.gather(
+                    *(asgi.resolve_ingredient_async(q) for q in search_queries),
+                    return_exceptions=True,
+                )
+            finally:
+                await self.async_client.aclose()
+
+        return asyncio.run(resolve_all())
+
+    def tests_miss_is_fetched_and_then_served_from_memory(self):
+        (result,) = self.resolve("apple")
+        self.assertEqual(result.verdict.ingredient_name, "apple")
+        self.assertEqual(
+            result.verdict.materialized_verdict,
+            materialize_verdict_from_response(APPLE_RESPONSE),
+        )
+        (result,) = self.resolve("Apple")
+        self.assertEqual(result.verdict.ingredient_name, "apple")
+        self.assertEqual(self.server.call_count, 1)
+
+    def tests_concurrent_identical_misses_make_one_upstream_call(self):
+        self.server.latency_seconds = 0.1
+        results = self.resolve(*["apple"] * 20)
+        self.assertEqual([r.verdict.ingredient_name for r in results], ["apple"] * 20)
+        self.assertEqual(self.server.call_count, 1)
+
+    def tests_unmatched_food_raises_key_error(self):
+        (result,) = self.resolve("assfgasf")
+        self.assertIsInstance(result, KeyError)
+
+    def tests_upstream_failure_raises_upstream_error(self):
+        self.server.fail_next = 1
+        (result,) = self.resolve("apple")
+        self.assertIsInstance(result, UpstreamError)
+
+    def tests_stored_tiers_are_shared_with_the_sync_path(self):
+        resolve_ingredient("apple").insert_results_into_cache()
+        self.store.flush()
+        model.nutrient_verdict_cache.clear()
+        # answered from the cached search for "apple" by the similar food tier, without Nutritionix
+        (result,) = self.resolve("apples")
+        self.assertEqual(result.matched_query, "apple")
+        self.assertEqual(self.server.call_count, 1)
+
+    def tests_stale_memory_hits_queue_a_refresh(self):
+        resolve_ingredient("apple").insert_results_into_cache()
+        self.store.flush()
+        with self.store.connection() as connection:
+            connection.execute("UPDATE SearchCache SET refreshed_at = 0")
+        with mock.patch.object(self.refresher, "submit") as submit:
+            self.resolve("apple", "apple")
+        submit.assert_called_once_with("apple")
+
+
+class nutrient_batch(unittest.TestCase):
+    def setUp(self) -> None:
+        self.foods = [
+            response["foods"][0]
+            for response in load_recorded_responses("searches.db").values()
+            # a recorded food without a quantity cannot be evaluated either way
+            if response["foods"][0]["tags"]["quantity"] is not None
+        ] + [
+            # sums that land next to a rounding tie, where np.round() and round() disagree
+            make_food_response("tie", 0.0, 0.0, 0.3, 0.3)["foods"][0],
+            make_food_response("no detail", 0.0, 0.0, 0.0, 12.0)["foods"][0],
+            make_food_response("half serving", 0.05, 0.0, 0.2, 0.3, 40, "0.5")["foods"][
+                0
+            ],
+        ]
+        return super().setUp()
+
+    def get_single_food_results(self, n_grams_fructose_allowed: float) -> list:
+        return [
+            evaluate({"foods": [food]}, n_grams_fructose_allowed) for food in self.foods
+        ]
+
+    def tests_batch_matches_single_food_results(self):
+        batch = NutrientBatch.from_foods(self.foods)
+        for n_grams_fructose_allowed in (0.5, 3, 10):
+            verdicts = batch.evaluate(n_grams_fructose_allowed)
+            results = self.get_single_food_results(n_grams_fructose_allowed)
+            for index, result in enumerate(results):
+                self.assertEqual(batch.total_fructose[index], result.total_fructose)
+                self.assertEqual(
+                    bool(batch.has_detailed_nutrients[index]),
+                    result.has_detailed_nutrients,
+                )
+                self.assertEqual(
+                    bool(verdicts["is_under_allowable_fructose_limit"][index]),
+                    result.is_under_allowable_fructose_limit,
+                )
+                self.assertEqual(
+                    verdicts["grams_fructose_per_single_serving_of_ingredient"][index],
+                    result.grams_fructose_per_single_serving_of_ingredient,
+                )
+                self.assertEqual(
+                    verdicts["proportion_of_fructose_per_gram_of_ingredient"][index],
+                    result.proportion_of_fructose_per_gram_of_ingredient,
+                )
+
+    def tests_verdict_batch_matches_food_batch(self):
+        verdicts = [
+            materialize_verdict_from_response({"foods": [food]}) for food in self.foods
+        ]
+        from_verdicts = NutrientBatch.from_verdicts(verdicts).evaluate()
+        from_foods = NutrientBatch.from_foods(self.foods).evaluate()
+        for key, column in from_foods.items():
+            self.assertEqual(column.tolist(), from_verdicts[key].tolist())
+
+    def tests_round_like_python(self):
+        values = [0.15, 0.25, 0.35, 1.45, 2.675, 0.05 + 0.2 / 2, -0.15]
+        self.assertEqual(
+            round_like_python(values).tolist(), [round(value, 1) for value in values]
+        )
+
+    def tests_extract_nutrient_values_defaults_to_zero(self):
+        food = {"full_nutrients": [{"attr_id": 212, "value": 1.5}]}
+        self.assertEqual(extract_nutrient_values(food, (212, 269)), [1.5, 0])
+
+
+class local_food_database(offline_app_test_case):
+    responses = {"apple": APPLE_RESPONSE}
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.connection = db.connect(self.store.database_path)
+        return None
+
+    def tearDown(self) -> None:
+        self.connection.close()
+        return super().tearDown()
+
+    def tests_csv_import_joins_nutrients_and_first_portion(self):
+        imported = fooddata.import_fooddata(
+            self.connection, "test_fixtures/fooddata_csv"
+        )
+        self.assertEqual(imported, 4)
+        apple = db.lookup_local_food(self.connection, "Apples, raw, with skin")
+        self.assertEqual(
+            (apple["fructose"], apple["sucrose"], apple["total_sugar"]),
+            (5.9, 2.07, 10.39),
+        )
+        self.assertEqual(
+            (apple["portion_unit"], apple["portion_grams"]), ('medium (3" dia)', 182.0)
+        )
+        catsup = db.lookup_local_food(self.connection, "catsup")
+        self.assertEqual((catsup["total_sugar"], catsup["fructose"]), (21.27, None))
+        self.assertEqual(catsup["portion_unit"], "tbsp")
+        chicken = "chicken, broilers or fryers, breast, meat only, raw"
+        self.assertEqual(
+            self.connection.execute(
+                "SELECT portion_amount, portion_unit FROM LocalFoods WHERE name = ?",
+                (chicken,),
+            ).fetchone(),
+            (100.0, "g"),
+        )
+        # it has no sugar figures, so searches for it go to Nutritionix
+        self.assertIsNone(db.lookup_local_food(self.connection, chicken))
+
+    def tests_json_import_streams_foods(self):
+        with open("test_fixtures/fooddata.json", encoding="utf-8") as file:
+            expected = json.load(file)["FoundationFoods"]
+        with open("test_fixtures/fooddata.json", encoding="utf-8") as file:
+            self.assertEqual(
+                list(fooddata.iterate_json_array(file, chunk_size=7)), expected
+            )
+        self.assertEqual(
+            fooddata.import_fooddata(self.connection, "test_fixtures/fooddata.json"), 3
+        )
+        self.assertEqual(
+            fooddata.import_fooddata(self.connection, "test_fixtures/fooddata.json"), 3
+        )
+        self.assertEqual(
+            self.connection.execute("SELECT COUNT(*) FROM LocalFoods").fetchone()[0], 3
+        )
+        pear = db.lookup_local_food(self.connection, "pears, raw, bartlett")
+        self.assertEqual(
+            (pear["portion_unit"], pear["portion_grams"]), ("medium", 178.0)
+        )
+        syrup = db.lookup_local_food(self.connection, "maple syrup")
+        self.assertEqual(
+            (syrup["total_sugar"], syrup["portion_unit"], syrup["portion_grams"]),
+            (66.67, "1/4 cup", 60.0),
+        )
+
+    def tests_local_food_resolves_without_upstream_call(self):
+        fooddata.import_fooddata(self.connection, "test_fixtures/fooddata_csv")
+        result = resolve_ingredient("Honey")
+        self.assertEqual(result.verdict.total_fructose, round(8.6 + 0.2 / 2, 1))
+        self.assertEqual(result.verdict.serving_unit, "tbsp")
+        self.assertEqual(result.verdict.is_under_allowable_fructose_limit, False)
+        self.assertEqual(self.server.call_count, 0)
+
+        # an ordinary search finds the raw food under its primary name, not only the full USDA description
+        result = resolve_ingredient("Apple")
+        self.assertEqual(result.verdict.ingredient_name, "apples, raw, with skin")
+        self.assertEqual(result.verdict.serving_unit, 'medium (3" dia)')
+        self.assertEqual(self.server.call_count, 0)
+
+        # a local food only describes its first portion, so an amount or a size still goes to Nutritionix
+        self.assertIsNone(db.lookup_local_food(self.connection, "large apple"))
+        batch_results = model.resolve_ingredient_batch(["catsup", "apples", "2 apples"])
+        self.assertEqual(
+            [result is not None for _, result in batch_results], [True, True, False]
+        )
+        self.assertEqual(self.server.queries, ["2 apples"])
+
+    def tests_local_foods_without_sugar_figures_are_misses(self):
+        with self.connection:
+            self.connection.executemany(
+                db.UPSERT_LOCAL_FOOD,
+                [
+                    fooddata.build_local_food(1, "Kiwifruit, dried", {}, None),
+                    fooddata.build_local_food(
+                        2, "Kiwifruit, green, raw", {1012: 4.35, 1010: 0.15}, None
+                    ),
+                ],
+            )
+        self.assertIsNone(db.lookup_local_food(self.connection, "kiwifruit, dried"))
+        self.assertEqual(
+            db.lookup_local_food(self.connection, "kiwifruit")["fdc_id"], 2
+        )
+        # asked of Nutritionix instead of evaluating as sugar free
+        with self.assertRaises(KeyError):
+            resolve_ingredient("kiwifruit, dried")
+        self.assertEqual(self.server.queries, ["kiwifruit, dried"])
+
+
+class query_matching(offline_app_test_case):
+    responses = {
+        "2 cups of apples": make_food_response("apple", 8, 4, 2, 14, 250, "2.0"),
+        "2 apples": dict(
+            foods=[
+                dict(
+                    APPLE_RESPONSE["foods"][0],
+                    tags=dict(item="apple", measure=None, quantity="2.0"),
+                )
+            ]
+        ),
+        "3 large apples": make_food_response("apple", 40, 20, 10, 70, 669, "3.0"),
+    }
+
+    def tests_parse_query(self):
+        self.assertEqual(
+            parse_query("a medium apple"), ParsedQuery(1.0, None, "apple", "medium")
+        )
+        self.assertEqual(
+            parse_query("2 large slices of bread"),
+            ParsedQuery(2.0, "slice", "bread", "large"),
+        )
+        self.assertEqual(
+            parse_query("  3 Cups of  Blueberries "),
+            ParsedQuery(3.0, "cup", "blueberry"),
+        )
+        self.assertEqual(
+            parse_query("1 1/2 tbsp honey"), ParsedQuery(1.5, "tbsp", "honey")
+        )
+        self.assertEqual(parse_query("two peaches"), ParsedQuery(2.0, None, "peach"))
+        self.assertEqual(parse_query("hummus"), ParsedQuery(None, None, "hummus"))
+        self.assertEqual(parse_query("12413523314").food, "")
+
+    def tests_other_amounts_are_scaled_from_cache(self):
+        resolve_ingredient("2 cups of apples").insert_results_into_cache()
+        self.store.flush()
+
+        result = resolve_ingredient("3 cups of apple")
+        self.assertEqual(
+            (result.matched_query, result.scaled, result.match_confidence),
+            ("2 cups of apples", True, 1.0),
+        )
+        self.assertEqual(result.verdict.quantity_of_servings, 3.0)
+        self.assertEqual(result.verdict.total_fructose, 12.0 + 3.0 / 2)
+        self.assertEqual(result.verdict.total_weight_grams, 375.0)
+
+        fuzzy_result = resolve_ingredient("2 cups of aples")
+        self.assertEqual(fuzzy_result.scaled, False)
+        self.assertEqual(fuzzy_result.match_confidence, 0.89)
+        self.assertEqual(self.server.call_count, 1)
+
+        # derived verdicts are not cached under the new query
+        self.assertFalse(result.insert_results_into_cache())
+        self.assertIsNone(self.store.lookup_verdict("3 cups of apple"))
+
+    def tests_different_sizes_are_not_scaled(self):
+        resolve_ingredient("2 apples").insert_results_into_cache()
+        self.store.flush()
+        self.assertTrue(resolve_ingredient("4 apples").scaled)
+        result = resolve_ingredient("3 large apples")
+        self.assertEqual((result.scaled, result.matched_query), (False, None))
+        self.assertEqual(result.verdict.total_fructose, 40 + 10 / 2)
+        self.assertEqual(self.server.queries, ["2 apples", "3 large apples"])
+
+    def tests_different_units_are_not_scaled(self):
+        resolve_ingredient("2 cups of apples").insert_results_into_cache()
+        self.store.flush()
+        with self.assertRaises(KeyError):
+            resolve_ingredient("3 apples")
+        self.assertEqual(self.server.call_count, 2)
+
+
+class cache_warmup(offline_app_test_case):
+    responses = {"apple": APPLE_RESPONSE}
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.connection = db.connect(self.store.database_path)
+        self.connection.executemany(
+            """INSERT INTO SearchCache (query, hit_count, last_seen)
+               VALUES (?, ?, datetime('now', ?))""",
+            [
+                ("apple", 10, "-1 days"),
+                ("honey", 40, "-120 days"),
+                ("pear", 3, "-1 days"),
+            ],
+        )
+        self.connection.commit()
+        self.checkpoint_path = os.path.join(self.directory.name, "warmup.json")
+        return None
+
+    def tearDown(self) -> None:
+        self.connection.close()
+        return super().tearDown()
+
+    def tests_queries_are_ranked_by_decayed_frequency(self):
+        ranked = warmup.rank_cached_queries(self.connection, half_life_days=30)
+        self.assertEqual(
+            [ranked_query.query for ranked_query in ranked], ["apple", "pear", "honey"]
+        )
+        self.assertTrue(all(ranked_query.needs_fetch for ranked_query in ranked))
+
+    def tests_interrupted_prefetch_resumes_from_checkpoint(self):
+        ranked = warmup.rank_cached_queries(self.connection)
+        fetched = []
+
+        def fetch_then_fail(search_query):
+            if fetched:
+                raise UpstreamError("down")
+            fetched.append(search_query)
+            return self.client.fetch_natural_nutrients(search_query)
+
+        counts = warmup.prefetch_missing(
+            self.connection,
+            ranked,
+            fetch_then_fail,
+            warmup.RateLimiter(0),
+            self.checkpoint_path,
+            report=lambda _: None,
+        )
+        self.assertEqual((counts["fetched"], counts["remaining"]), (1, 2))
+        self.assertEqual(self.store.lookup_verdict("apple")["fructose"], 10.7)
+        self.assertEqual(self.store.lookup_verdict("apple")["quantity"], 1.0)
+        self.assertEqual(
+            self.connection.execute(
+                "SELECT hit_count FROM SearchCache WHERE query = 'apple'"
+            ).fetchone()[0],
+            10,
+        )
+
+        counts = warmup.prefetch_missing(
+            self.connection,
+            ranked,
+            self.client.fetch_natural_nutrients,
+            warmup.RateLimiter(0),
+            self.checkpoint_path,
+            report=lambda _: None,
+        )
+        self.assertEqual(counts, dict(fetched=0, unmatched=2, skipped=1, remaining=0))
+        self.assertEqual(self.server.queries, ["apple", "pear", "honey"])
+        self.assertFalse(os.path.exists(self.checkpoint_path))
+
+    def tests_top_verdicts_are_loaded_into_memory(self):
+        self.store.record_search(
+            "pear",
+            PARSED_APPLE,
+            "",
+            materialize_verdict_from_response(APPLE_RESPONSE),
+        )
+        self.store.flush()
+        memory_cache = MemoryCache()
+        self.assertEqual(warmup.warm_memory_cache(memory_cache, self.connection, 5), 1)
+        self.assertEqual(memory_cache.get("pear")["fructose"], 10.7)
+
+    def tests_rate_limiter_spaces_calls(self):
+        now = [0.0]
+        sleeps = []
+
+        def sleep(seconds):
+            sleeps.append(seconds)
+            now[0] += seconds
+
+        rate_limiter = warmup.RateLimiter(4, clock=lambda: now[0], sleep=sleep)
+        for _ in range(3):
+            rate_limiter.wait()
+        self.assertEqual(sleeps, [0.25, 0.25])
+
+
+class benchmark_results(unittest.TestCase):
+    def tests_compare_reports_slower_latencies_and_lower_throughput(self):
+        baseline = {
+            "api_hit": {"p50_ms": 1.0, "throughput_per_second": 100.0, "requests": 5},
+            "parse_food": {"p99_ms": 0.02},
+        }
+        current = {
+            "api_hit": {"p50_ms": 1.05, "throughput_per_second": 50.0, "requests": 9},
+            "parse_food": {"p99_ms": 0.04},
+        }
+        self.assertEqual(
+            benchmark.compare_results(baseline, current, threshold=0.1),
+            [
+                "api_hit.throughput_per_second: 100.0 -> 50.0 (+100%)",
+                "parse_food.p99_ms: 0.02 -> 0.04 (+100%)",
+            ],
+        )
+        self.assertEqual(benchmark.compare_results(baseline, baseline, 0.1), [])
+
+
+class request_metrics(offline_app_test_case):
+    responses = {"apple": APPLE_RESPONSE}
+
+    def tests_search_reports_stage_timings_and_counters(self):
+        misses_before = metrics.cache_lookups.value(tier="sqlite_raw", result="miss")
+        response = self.app.post("/", data={"search_query": "apple"})
+        server_timing = response.headers["Server-Timing"]
+        for stage in ("memory_lookup", "upstream_fetch", "evaluate", "render", "total"):
+            self.assertIn(f"{stage};dur=", server_timing)
+        self.assertEqual(
+            metrics.cache_lookups.value(tier="sqlite_raw", result="miss"),
+            misses_before + 1,
+        )
+
+        hits_before = metrics.cache_lookups.value(tier="memory", result="hit")
+        response = self.app.get("/api/v1/get_single_ingredient?search_query=apple")
+        self.assertNotIn("upstream_fetch", response.headers["Server-Timing"])
+        self.assertEqual(
+            metrics.cache_lookups.value(tier="memory", result="hit"), hits_before + 1
+        )
+
+        exposition = self.app.get("/metrics")
+        self.assertTrue(exposition.content_type.startswith("text/plain"))
+        body = exposition.get_data(as_text=True)
+        self.assertIn('sophie_upstream_requests_total{outcome="ok"}', body)
+        self.assertIn(
+            'sophie_stage_duration_seconds_bucket{stage="upstream_fetch",le="+Inf"}',
+            body,
+        )
+        self.assertIn(
+            'sophie_http_requests_total{route="/",method="POST",status="200"}', body
+        )
+
+    def tests_histogram_buckets_are_cumulative(self):
+        histogram = metrics.Histogram("test_seconds", "Test.", ("stage",), (0.1, 1.0))
+        for value in (0.05, 0.5, 0.5, 5.0):
+            histogram.observe(value, stage="parse")
+        self.assertEqual(
+            histogram.collect(),
+            [
+                'test_seconds_bucket{stage="parse",le="0.1"} 1',
+                'test_seconds_bucket{stage="parse",le="1.0"} 3',
+                'test_seconds_bucket{stage="parse",le="+Inf"} 4',
+                'test_seconds_sum{stage="parse"} 6.05',
+                'test_seconds_count{stage="parse"} 4',
+            ],
+        )
+
+    def tests_long_log_messages_are_truncated(self):
+        log_queue = queue.SimpleQueue()
+        handler = logs.TruncatingQueueHandler(log_queue, max_message_length=10)
+        handler.emit(
+            logging.LogRecord("test", logging.DEBUG, "", 0, "%s", ("x" * 25,), None)
+        )
+        self.assertEqual(
+            log_queue.get_nowait().getMessage(),
+            "xxxxxxxxxx... [15 characters omitted]",
+        )
+
+
+class http_caching(offline_app_test_case):
+    responses = {
+        "apple": APPLE_RESPONSE,
+        "banana": make_food_response("banana", 5, 5, 2, 12),
+    }
+
+    def tests_api_results_are_revalidated_with_etags(self):
+        path = "/api/v1/get_single_ingredient?search_query=apple"
+        first = self.app.get(path)
+        etag = first.headers["ETag"]
+        self.assertEqual(first.headers["Cache-Control"], "public, max-age=3600")
+        self.assertEqual(self.app.get(path).headers["ETag"], etag)
+        self.assertNotEqual(
+            self.app.get("/api/v1/get_single_ingredient?search_query=banana").headers[
+                "ETag"
+            ],
+            etag,
+        )
+
+        not_modified = self.app.get(path, headers={"If-None-Match": etag})
+        self.assertEqual(not_modified.status_code, 304)
+        self.assertEqual(not_modified.get_data(), b"")
+        self.assertEqual(not_modified.headers["ETag"], etag)
+        changed = self.app.get(path, headers={"If-None-Match": '"stale"'})
+        self.assertEqual(changed.status_code, 200)
+        self.assertEqual(changed.get_json(), first.get_json())
+
+    def tests_api_results_are_shared_through_the_sqlite_cache(self):
+        self.app.get("/api/v1/get_single_ingredient?search_query=apple")
+        self.app.get("/api/v1/get_ingredients?search_queries=banana")
+        self.store.flush()
+        for search_query in ("apple", "banana"):
+            self.assertIsNotNone(self.store.lookup_verdict(search_query))
+
+    def tests_upstream_errors_are_not_cacheable(self):
+        self.server.fail_next = 10
+        response = self.app.get("/api/v1/get_single_ingredient?search_query=banana")
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.headers["Cache-Control"], "no-store")
+
+    def tests_result_pages_are_rendered_once(self):
+        with mock.patch.object(
+            main, "render_search_page", wraps=main.render_search_page
+        ) as render_search_page:
+            first = self.app.post("/", data={"search_query": "apple"})
+            second = self.app.post("/", data={"search_query": "apple"})
+        self.assertEqual(render_search_page.call_count, 1)
+        self.assertEqual(first.get_data(), second.get_data())
+
+
+class safe_foods_index(offline_app_test_case):
+    responses = {
+        "kiwi": make_food_response("kiwi", 2, 2, 0, 4),
+        "banana": make_food_response("banana", 5, 5, 2, 12),
+        "grape": make_food_response("grape", 8, 7, 0, 15, serving_weight_grams=500),
+        "2 lettuce": make_food_response(
+            "lettuce", 0.5, 0.5, 0, 1, serving_weight_grams=200, quantity="2.0"
+        ),
+        "lettuce": make_food_response("lettuce", 0.3, 0.3, 0, 0.6),
+    }
+
+    def search(self, *search_queries):
+        for search_query in search_queries:
+            self.app.post("/", data={"search_query": search_query})
+        self.store.flush()
+
+    def listed_foods(self, **args):
+        response = self.app.get("/api/v1/safe_foods", query_string=args)
+        self.assertEqual(response.status_code, 200)
+        return [food["food"] for food in response.get_json()["foods"]]
+
+    def tests_foods_are_listed_lowest_fructose_first(self):
+        self.search("kiwi", "banana", "grape", "2 lettuce")
+        self.assertEqual(self.listed_foods(), ["lettuce", "kiwi", "banana", "grape"])
+        self.assertEqual(
+            self.listed_foods(order_by="fructose_per_gram"),
+            ["lettuce", "grape", "kiwi", "banana"],
+        )
+        self.assertEqual(self.listed_foods(max_fructose=3), ["lettuce", "kiwi"])
+        first_page = self.app.get("/api/v1/safe_foods?limit=3").get_json()
+        self.assertEqual(first_page["next_offset"], 3)
+        self.assertEqual(first_page["foods"][0]["fructose_per_serving"], 0.25)
+        last_page = self.app.get("/api/v1/safe_foods?limit=3&offset=3").get_json()
+        self.assertEqual([food["food"] for food in last_page["foods"]], ["grape"])
+        self.assertIsNone(last_page["next_offset"])
+
+    def tests_index_keeps_one_current_row_per_food(self):
+        self.search("2 lettuce", "lettuce")
+        foods = self.app.get("/api/v1/safe_foods").get_json()["foods"]
+        self.assertEqual([food["query"] for food in foods], ["lettuce"])
+        self.assertAlmostEqual(foods[0]["fructose_per_serving"], 0.3)
+
+        connection = self.store.connection()
+        with connection:
+            connection.execute("DELETE FROM SearchCache WHERE query = 'lettuce'")
+        self.assertEqual(
+            [food["query"] for food in db.list_safe_foods(connection)], ["2 lettuce"]
+        )
+
+    def tests_backfilled_verdicts_are_indexed(self):
+        connection = self.store.connection()
+        db.record_search(
+            connection, "kiwi", PARSED_APPLE, json.dumps(self.responses["kiwi"])
+        )
+        self.assertEqual(db.list_safe_foods(connection), [])
+        db.backfill_verdicts(connection, model.materialize_verdict_from_response)
+        self.assertEqual(self.listed_foods(), ["kiwi"])
+
+    def tests_bad_arguments_are_rejected(self):
+        for query_string in (
+            "order_by=name",
+            "max_fructose=lots",
+            "limit=0",
+            "limit=1000",
+            "offset=-1",
+        ):
+            response = self.app.get(f"/api/v1/safe_foods?{query_string}")
+            self.assertEqual(response.status_code, 400, query_string)
+            self.assertIn("error", response.get_json())
+
+
+class negative_cache(offline_app_test_case):
+    responses = {
+        "kiwi": make_food_response("kiwi", 2, 2, 0, 4),
+        "cheerios": make_food_response("cheerios", 0.3, 0.2, 1, 1.2, quantity=None),
+    }
+
+    def tests_unmatched_queries_skip_nutritionix_until_they_expire(self):
+        saved_before = metrics.upstream_calls_saved.value()
+        for _ in range(2):
+            response = self.app.post("/", data={"search_query": "xyzzy"})
+            self.assertEqual(response.status_code, 200)
+        self.app.get("/api/v1/get_single_ingredient?search_query=XYZZY ")
+        self.app.get("/api/v1/get_ingredients?search_queries=xyzzy")
+        self.assertEqual(self.server.call_count, 1)
+        self.assertEqual(metrics.upstream_calls_saved.value() - saved_before, 3)
+
+        # another worker has none of this process's memory, but shares searches.db
+        with mock.patch.object(model, "unmatched_query_cache", MemoryCache()):
+            with self.assertRaises(model.UnmatchedFoodError):
+                resolve_ingredient("xyzzy")
+        self.assertEqual(self.server.call_count, 1)
+
+        connection = self.store.connection()
+        self.assertEqual(
+            db.lookup_unmatched_query(connection, "xyzzy"),
+            "We couldn't match any of your foods",
+        )
+        db.record_unmatched_query(connection, "xyzzy", "expired", -1)
+        self.assertIsNone(db.lookup_unmatched_query(connection, "xyzzy"))
+
+    def tests_only_no_match_answers_are_negatively_cached(self):
+        # a food that cannot be evaluated is reported unmatched but asked again
+        for _ in range(2):
+            with self.assertRaises(KeyError):
+                resolve_ingredient("cheerios")
+        self.assertEqual(self.server.call_count, 2)
+        batch = self.app.get("/api/v1/get_ingredients?search_queries=cheerios")
+        self.assertEqual(batch.get_json()["unmatched"], ["cheerios"])
+        self.assertEqual(self.server.call_count, 3)
+
+        # bad credentials are an outage, not a food that does not exist
+        self.server.error_status = 401
+        self.server.error_rate = 1.0
+        response = self.app.get("/api/v1/get_single_ingredient?search_query=kiwi")
+        self.assertEqual(response.status_code, 503)
+        self.assertIsNone(db.lookup_unmatched_query(self.store.connection(), "kiwi"))
+        self.assertIsNone(
+            db.lookup_unmatched_query(self.store.connection(), "cheerios")
+        )
+
+    def quarantined_reasons(self) -> list[str]:
+        return [
+            reason
+            for reason, in self.store.connection().execute(
+                "SELECT reason FROM QuarantinedSearches"
+            )
+        ]
+
+    def tests_corrupt_payloads_are_quarantined_and_refetched(self):
+        connection = self.store.connection()
+        db.record_search(connection, "kiwi", PARSED_APPLE)
+        with connection:
+            connection.execute(
+                "UPDATE SearchCache SET raw = ? WHERE query = 'kiwi'", (b"not zlib",)
+            )
+        result = resolve_ingredient("kiwi")
+        self.assertEqual(result.verdict.ingredient_name, "kiwi")
+        self.assertEqual(self.server.call_count, 1)
+        self.assertEqual(len(self.quarantined_reasons()), 1)
+        self.assertTrue(self.quarantined_reasons()[0].startswith("Unreadable payload"))
+
+        result.insert_results_into_cache()
+        self.store.flush()
+        self.assertIsNotNone(db.lookup_verdict(connection, "kiwi"))
+
+    def tests_unusable_verdicts_are_quarantined(self):
+        connection = self.store.connection()
+        db.record_search(
+            connection,
+            "kiwi",
+            PARSED_APPLE,
+            json.dumps(APPLE_RESPONSE),
+            materialize_verdict_from_response(APPLE_RESPONSE),
+        )
+        with connection:
+            connection.execute("UPDATE SearchCache SET serving_size_grams = NULL")
+        self.assertEqual(resolve_ingredient("kiwi").verdict.ingredient_name, "kiwi")
+        self.assertTrue(self.quarantined_reasons()[0].startswith("Unusable verdict"))
+        self.assertEqual(self.server.call_count, 1)
+
+    def tests_backfill_can_quarantine_unparsable_rows(self):
+        connection = self.store.connection()
+        db.record_search(
+            connection, "cheerios", PARSED_APPLE, json.dumps(self.responses["cheerios"])
+        )
+        self.assertEqual(
+            db.backfill_verdicts(
+                connection, materialize_verdict_from_response, quarantine=True
+            ),
+            (0, 1),
+        )
+        self.assertIsNone(db.lookup_raw_response(connection, "cheerios"))
+        self.assertEqual(len(self.quarantined_reasons()), 1)
+
+
+class upstream_scheduler(offline_app_test_case):
+    responses = {
+        name: make_food_response(name, 2, 2, 0, 4)
+        for name in ("kiwi", "plum", "pear", "fig")
+    }
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.now = time.time()
+
+    def advance_clock(self, seconds: float):
+        self.now += seconds
+
+    def make_scheduler(self, **kwargs) -> quota.UpstreamScheduler:
+        return quota.UpstreamScheduler(
+            clock=lambda: self.now, sleep=self.advance_clock, **kwargs
+        )
+
+    def tests_interactive_calls_are_shed_before_the_upstream_quota_is_hit(self):
+        self.server.quota = 3
+        scheduler = self.make_scheduler(
+            calls_per_minute=3, max_wait_seconds={quota.INTERACTIVE: 0}
+        )
+        shed_before = metrics.upstream_shed.value(lane="interactive", reason="timeout")
+        with mock.patch.object(model, "upstream_scheduler", scheduler):
+            statuses = [
+                self.app.get(
+                    f"/api/v1/get_single_ingredient?search_query={food}"
+                ).status_code
+                for food in self.responses
+            ]
+        self.assertEqual(statuses, [200, 200, 200, 503])
+        self.assertEqual(self.server.call_count, 3)
+        self.assertEqual(self.server.quota_rejections, 0)
+        self.assertEqual(
+            metrics.upstream_shed.value(lane="interactive", reason="timeout")
+            - shed_before,
+            1,
+        )
+        # unscheduled, the next call would have been rejected by the stub on every attempt
+        with self.assertRaises(UpstreamError):
+            self.client.fetch_natural_nutrients("fig")
+        self.assertEqual(self.server.quota_rejections, 3)
+
+        self.advance_clock(20)
+        scheduler.acquire(quota.INTERACTIVE)
+
+    def tests_background_work_leaves_a_reserve_for_interactive_calls(self):
+        scheduler = self.make_scheduler(
+            calls_per_minute=4,
+            background_reserve=0.5,
+            max_wait_seconds={quota.INTERACTIVE: 0, quota.BACKGROUND: 0},
+        )
+        for lane in (quota.BACKGROUND, quota.INTERACTIVE):
+            scheduler.acquire(lane)
+            scheduler.acquire(lane)
+            with self.assertRaises(quota.QuotaExceededError) as shed:
+                scheduler.acquire(lane)
+            self.assertEqual(shed.exception.reason, "timeout")
+        self.assertEqual(
+            self.store.count_upstream_calls(), {"background": 2, "interactive": 2}
+        )
+
+    def tests_quota_accounting_survives_a_restart(self):
+        path = self.store.database_path
+        self.make_scheduler(calls_per_minute=10, calls_per_day=3).acquire()
+        self.make_scheduler(calls_per_minute=10, calls_per_day=3).acquire()
+        self.store.close()
+
+        restarted_store = db.CacheStore(path)
+        self.addCleanup(restarted_store.close)
+        scheduler = self.make_scheduler(
+            calls_per_minute=10, calls_per_day=3, background_reserve=0.5
+        )
+        with mock.patch.object(db, "cache_store", restarted_store):
+            with self.assertRaises(quota.QuotaExceededError) as shed:
+                scheduler.acquire(quota.BACKGROUND)
+            self.assertEqual(shed.exception.reason, "daily_quota")
+            scheduler.acquire(quota.INTERACTIVE)
+            with self.assertRaises(quota.QuotaExceededError):
+                scheduler.acquire(quota.INTERACTIVE)
+            self.assertEqual(
+                db.summarize(restarted_store.connection())["upstream_calls_today"], 3
+            )
+            self.advance_clock(24 * 60 * 60)
+            scheduler.acquire(quota.BACKGROUND)
+
+    def tests_full_queues_are_shed(self):
+        queued = threading.Event()
+        release = threading.Event()
+
+        def blocking_sleep(seconds: float):
+            queued.set()
+            release.wait(5)
+            self.advance_clock(seconds)
+
+        scheduler = quota.UpstreamScheduler(
+            calls_per_minute=1,
+            max_queue_depth={quota.INTERACTIVE: 1},
+            max_wait_seconds={quota.INTERACTIVE: 120},
+            clock=lambda: self.now,
+            sleep=blocking_sleep,
+        )
+        scheduler.acquire()
+        waiter = threading.Thread(target=scheduler.acquire)
+        waiter.start()
+        self.assertTrue(queued.wait(5))
+        with self.assertRaises(quota.QuotaExceededError) as shed:
+            scheduler.acquire()
+        self.assertEqual(shed.exception.reason, "queue_full")
+        release.set()
+        waiter.join(5)
+        self.assertEqual(self.store.count_upstream_calls(), {"interactive": 2})
+
+    def tests_coroutines_wait_for_tokens_on_the_event_loop(self):
+        scheduler = self.make_scheduler(
+            calls_per_minute=1, max_wait_seconds={quota.INTERACTIVE: 0}
+        )
+
+        async def acquire_twice():
+            await scheduler.acquire_async(quota.INTERACTIVE)
+            await scheduler.acquire_async(quota.INTERACTIVE)
+
+        with self.assertRaises(quota.QuotaExceededError) as shed:
+            asyncio.run(acquire_twice())
+        self.assertEqual(shed.exception.reason, "timeout")
+        self.assertEqual(scheduler.waiting[quota.INTERACTIVE], 0)
+        self.assertEqual(self.store.count_upstream_calls(), {"interactive": 1})
+
+    def tests_every_attempt_takes_a_token(self):
+        self.server.fail_next = 2
+        scheduler = self.make_scheduler(calls_per_minute=10)
+        scheduler.call(
+            quota.BACKGROUND,
+            lambda acquire: self.client.fetch_natural_nutrients("kiwi", acquire),
+        )
+        self.assertEqual(self.server.call_count, 3)
+        self.assertEqual(self.store.count_upstream_calls(), {"background": 3})
+
+    def tests_budgeted_calls_do_not_retry_a_429(self):
+        self.server.quota = 1
+        scheduler = self.make_scheduler(calls_per_minute=10)
+        fetch = lambda acquire: self.client.fetch_natural_nutrients("kiwi", acquire)
+        scheduler.call(quota.INTERACTIVE, fetch)
+        with self.assertRaises(UpstreamError):
+            scheduler.call(quota.INTERACTIVE, fetch)
+        self.assertEqual(self.server.quota_rejections, 1)
+        self.assertEqual(self.store.count_upstream_calls(), {"interactive": 2})
+        self.assertEqual(
+            self.client.circuit_breaker.state, self.client.circuit_breaker.CLOSED
+        )
+
+    def tests_a_shed_retry_releases_the_half_open_trial(self):
+        breaker = self.client.circuit_breaker
+        breaker.state = breaker.OPEN
+        breaker.opened_at = breaker.clock() - breaker.reset_timeout_seconds
+        self.server.fail_next = 1
+        scheduler = self.make_scheduler(
+            calls_per_minute=1, max_wait_seconds={quota.INTERACTIVE: 0}
+        )
+        with self.assertRaises(quota.QuotaExceededError):
+            scheduler.call(
+                quota.INTERACTIVE,
+                lambda acquire: self.client.fetch_natural_nutrients("kiwi", acquire),
+            )
+        self.assertEqual(self.server.call_count, 1)
+        # the next call is let through as the trial
+        self.assertTrue(breaker.allow_request())
+
+
+class stale_while_revalidate(offline_app_test_case):
+    responses = {"kiwi": make_food_response("kiwi", 9, 2, 0, 11)}
+
+    def cache_kiwi(self, refreshed_at):
+        """Caches an older Nutritionix answer for kiwi, fetched at refreshed_at."""
+        old_response = make_food_response("kiwi", 2, 2, 0, 4)
+        verdict = evaluate(old_response)
+        connection = self.store.connection()
+        db.record_search(
+            connection,
+            "kiwi",
+            verdict.parsed_nutrient_response,
+            json.dumps(old_response),
+            verdict.materialized_verdict,
+        )
+        with connection:
+            connection.execute(
+                "UPDATE SearchCache SET refreshed_at = ?", (refreshed_at,)
+            )
+
+    def kiwi_row(self) -> tuple:
+        return (
+            self.store.connection()
+            .execute("SELECT fructose_n, hit_count, refreshed_at FROM SearchCache")
+            .fetchone()
+        )
+
+    def tests_stale_hits_are_served_and_refreshed_once_in_the_background(self):
+        self.cache_kiwi(refreshed_at=None)
+        self.server.latency_seconds = 0.2
+        queued_before = metrics.background_refreshes.value(outcome="queued")
+        for _ in range(3):
+            model.nutrient_verdict_cache.clear()
+            self.assertEqual(resolve_ingredient("kiwi").verdict.total_fructose, 2)
+        self.assertEqual(
+            metrics.background_refreshes.value(outcome="queued") - queued_before, 1
+        )
+
+        self.assertTrue(self.refresher.join(5))
+        self.assertEqual(self.server.call_count, 1)
+        fructose, hit_count, refreshed_at = self.kiwi_row()
+        self.assertEqual(fructose, 9)
+        self.assertEqual(hit_count, 1)
+        self.assertAlmostEqual(refreshed_at, time.time(), delta=5)
+        self.assertEqual(resolve_ingredient("kiwi").verdict.total_fructose, 9)
+        self.assertEqual(self.store.count_upstream_calls(), {"background": 1})
+
+    def tests_fresh_hits_are_not_refreshed(self):
+        self.cache_kiwi(refreshed_at=time.time() - 60)
+        self.assertEqual(resolve_ingredient("kiwi").verdict.total_fructose, 2)
+        self.assertTrue(self.refresher.join(5))
+        self.assertEqual(self.server.call_count, 0)
+
+        with mock.patch.object(model, "FRESHNESS_TTL_SECONDS", 30):
+            model.nutrient_verdict_cache.clear()
+            resolve_ingredient("kiwi")
+            self.assertTrue(self.refresher.join(5))
+        self.assertEqual(self.server.call_count, 1)
+
+    def tests_failed_refreshes_keep_serving_the_cached_answer(self):
+        self.cache_kiwi(refreshed_at=0)
+        self.server.error_rate = 1.0
+        failed_before = metrics.background_refreshes.value(outcome="failed")
+        response = self.app.get("/api/v1/get_single_ingredient?search_query=kiwi")
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(self.refresher.join(5))
+        self.assertEqual(
+            metrics.background_refreshes.value(outcome="failed") - failed_before, 1
+        )
+        # the route counted the search, the failed refresh left the payload and its fetch time alone
+        self.assertEqual(self.kiwi_row(), (2, 2, 0))
+
+    def tests_stale_memory_hits_are_refreshed(self):
+        self.cache_kiwi(refreshed_at=0)
+        model.nutrient_verdict_cache.set("kiwi", self.store.lookup_verdict("kiwi"))
+        with mock.patch.object(
+            self.store, "needs_refresh", wraps=self.store.needs_refresh
+        ) as needs_refresh:
+            for _ in range(3):
+                self.assertEqual(resolve_ingredient("kiwi").verdict.total_fructose, 2)
+        # later hits skip the freshness check until it expires
+        self.assertEqual(needs_refresh.call_count, 1)
+        self.assertTrue(self.refresher.join(5))
+        self.assertEqual(self.server.call_count, 1)
+        self.assertEqual(self.kiwi_row()[0], 9)
+
+    def tests_failed_refreshes_back_off(self):
+        now = [0.0]
+        attempts = []
+
+        def failing_refresh(search_query):
+            attempts.append(search_query)
+            raise UpstreamError("unavailable")
+
+        refresher = BackgroundRefresher(
+            failing_refresh, backoff_seconds=10, clock=lambda: now[0]
+        )
+        self.addCleanup(refresher.close)
+        backoff_before = metrics.background_refreshes.value(outcome="backoff")
+        for advance, queued in ((0, True), (5, False), (5, True), (15, False)):
+            now[0] += advance
+            self.assertEqual(refresher.submit("kiwi"), queued)
+            self.assertTrue(refresher.join(5))
+        self.assertEqual(len(attempts), 2)
+        self.assertEqual(
+            metrics.background_refreshes.value(outcome="backoff") - backoff_before, 2
+        )
+        # the second failure doubled the backoff
+        now[0] += 5
+        self.assertTrue(refresher.submit("kiwi"))
+        self.assertTrue(refresher.join(5))
+
+    def tests_pending_refreshes_are_bounded(self):
+        release = threading.Event()
+        refreshed = []
+
+        def slow_refresh(search_query):
+            release.wait(5)
+            refreshed.append(search_query)
+
+        refresher = BackgroundRefresher(slow_refresh, max_workers=1, max_pending=2)
+        self.addCleanup(refresher.close)
+        self.assertTrue(refresher.submit("Kiwi"))
+        self.assertFalse(refresher.submit("kiwi "))
+        self.assertTrue(refresher.submit("plum"))
+        self.assertFalse(refresher.submit("pear"))
+        release.set()
+        self.assertTrue(refresher.join(5))
+        self.assertEqual(refreshed, ["kiwi", "plum"])
+
+
+class bulk_evaluation(offline_app_test_case):
+    responses = {
+        name: make_food_response(name, 2, 2, 0, 4)
+        for name in ("kiwi", "plum", "pear", "fig")
+    }
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.input_path = os.path.join(self.directory.name, "menu.txt")
+        self.output_path = os.path.join(self.directory.name, "verdicts.jsonl")
+
+    def run_bulk(self, foods: list[str], *args) -> int:
+        with open(self.input_path, "w", encoding="utf-8") as input_file:
+            input_file.write("\n".join(foods) + "\n")
+        with mock.patch("sys.stderr"):
+            return bulk.main([self.input_path, "--output", self.output_path, *args])
+
+    def read_output(self) -> dict:
+        with open(self.output_path, encoding="utf-8") as output_file:
+            records = [json.loads(line) for line in output_file]
+        by_line = {record["line"]: record for record in records}
+        self.assertEqual(len(by_line), len(records), "a line was written twice")
+        return by_line
+
+    def tests_input_formats_are_read_as_streams(self):
+        self.assertEqual(
+            list(bulk.read_foods(["kiwi\n", "\n", " 2 plums \n"], "text", "food")),
+            ["kiwi", "2 plums"],
+        )
+        self.assertEqual(
+            list(
+                bulk.read_foods(
+                    ["sku,product\n", "1,kiwi\n", "2,\n", '3,"pear, sliced"\n'],
+                    "csv",
+                    "product",
+                )
+            ),
+            ["kiwi", "pear, sliced"],
+        )
+        with self.assertRaises(ValueError):
+            list(bulk.read_foods(["sku,name\n", "1,kiwi\n"], "csv", "food"))
+        self.assertEqual(
+            list(
+                bulk.read_foods(
+                    ['{"food": "kiwi"}\n', "\n", '"fig"\n'], "jsonl", "food"
+                )
+            ),
+            ["kiwi", "fig"],
+        )
+        self.assertEqual(bulk.detect_input_format("export.CSV"), "csv")
+        self.assertEqual(bulk.detect_input_format("foods.ndjson"), "jsonl")
+
+    def tests_verdicts_are_streamed_with_their_input_line(self):
+        # slow enough that both kiwis are in flight together and share one call
+        self.server.latency_seconds = 0.2
+        foods = ["kiwi", "xyzzy", "plum", "kiwi", "pear"]
+        self.assertEqual(self.run_bulk(foods, "--concurrency", "5"), 0)
+        records = self.read_output()
+        self.assertEqual(sorted(records), [1, 2, 3, 4, 5])
+        self.assertEqual(
+            [records[line]["status"] for line in sorted(records)],
+            ["ok", "unmatched", "ok", "ok", "ok"],
+        )
+        self.assertEqual(records[3]["name"], "plum")
+        self.assertEqual(records[3], dict(records[3], under_limit=True, t_fructose=2))
+        self.assertEqual(self.server.call_count, 4)
+        self.assertFalse(os.path.exists(self.output_path + ".checkpoint.json"))
+        self.assertEqual(self.store.count_upstream_calls(), {"background": 4})
+
+    def tests_full_background_queues_are_waited_out(self):
+        shed = quota.QuotaExceededError(quota.BACKGROUND, "queue_full")
+        with mock.patch.object(
+            bulk, "resolve_ingredient", side_effect=[shed, resolve_ingredient("kiwi")]
+        ), mock.patch.object(bulk.time, "sleep") as sleep:
+            record, _ = bulk.evaluate_food("kiwi")
+        self.assertEqual(record["status"], "ok")
+        sleep.assert_called_once_with(bulk.QUEUE_FULL_RETRY_SECONDS)
+        with mock.patch.object(
+            bulk,
+            "resolve_ingredient",
+            side_effect=quota.QuotaExceededError(quota.BACKGROUND, "daily_quota"),
+        ):
+            with self.assertRaises(quota.QuotaExceededError):
+                bulk.evaluate_food("kiwi")
+
+    def tests_bulk_workers_get_room_in_the_background_queue(self):
+        depths = []
+        scheduler = bulk.upstream_scheduler
+        default_depth = scheduler.max_queue_depth[quota.BACKGROUND]
+
+        def evaluate_stream(foods, output, **kwargs):
+            depths.append(scheduler.max_queue_depth[quota.BACKGROUND])
+            kwargs["save"](dict(next_line=2, done_after=[], output_bytes=0))
+            return dict(ok=0, unmatched=0, fetched=0, skipped=0, failed=0)
+
+        with mock.patch.object(bulk, "evaluate_stream", evaluate_stream):
+            self.run_bulk(["kiwi"], "--concurrency", "16")
+        self.assertEqual(depths, [default_depth + 16])
+        self.assertEqual(scheduler.max_queue_depth[quota.BACKGROUND], default_depth)
+
+    def tests_interrupted_runs_resume_from_the_checkpoint(self):
+        for food in ("kiwi", "plum"):
+            resolve_ingredient(food).insert_results_into_cache()
+        self.store.flush()
+        self.server.error_rate = 1.0
+        calls_before = self.server.call_count
+        foods = ["kiwi", "plum", "pear", "kiwi", "fig"]
+        self.assertEqual(
+            self.run_bulk(foods, "--concurrency", "1", "--checkpoint-every", "1"), 1
+        )
+        self.assertNotIn(3, self.read_output())
+        with open(self.output_path + ".checkpoint.json", encoding="utf-8") as file:
+            self.assertEqual(json.load(file)["next_line"], 3)
+        # a line written after the last checkpoint is dropped and evaluated again
+        with open(self.output_path, "a", encoding="utf-8") as output_file:
+            output_file.write('{"line": 3, "status": "partial"}\n')
+
+        self.server.error_rate = 0.0
+        self.assertEqual(self.run_bulk(foods), 0)
+        records = self.read_output()
+        self.assertEqual(sorted(records), [1, 2, 3, 4, 5])
+        self.assertEqual({record["status"] for record in records.values()}, {"ok"})
+        self.assertFalse(os.path.exists(self.output_path + ".checkpoint.json"))
+        # cached foods never went upstream; fig was not reached before the first run stopped
+        queries = self.server.queries[calls_before:]
+        self.assertEqual((queries.count("kiwi"), queries.count("fig")), (0, 1))
+
+
+class request_profiling(offline_app_test_case):
+    responses = {"kiwi": make_food_response("kiwi", 2, 2, 0, 4)}
+    path = "/api/v1/get_single_ingredient"
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.profile_directory = os.path.join(self.directory.name, "profiles")
+        for name, value in (
+            ("PROFILE_DIRECTORY", self.profile_directory),
+            ("PROFILE_SECRET", "test secret"),
+            ("used_profile_tokens", {}),
+        ):
+            patch: Any = mock.patch.object(profiling, name, value)
+            patch.start()
+            self.addCleanup(patch.stop)
+        # give the stack sampler something to catch
+        self.server.latency_seconds = 0.05
+
+    def get_kiwi(self, **headers):
+        return self.app.get(f"{self.path}?search_query=kiwi", headers=headers)
+
+    def tests_requests_are_not_profiled_by_default(self):
+        response = self.get_kiwi()
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn("X-Profile-Id", response.headers)
+        self.assertEqual(profiling.list_profiles(self.profile_directory, ".prof"), [])
+
+    def tests_signed_requests_write_a_profile_and_collapsed_stacks(self):
+        token = profiling.sign_profile_token(self.path, "test secret")
+        response = self.get_kiwi(**{"X-Profile": token})
+        profile_path = os.path.join(
+            self.profile_directory, response.headers["X-Profile-Id"]
+        )
+        stats = pstats.Stats(profile_path + ".prof")
+        self.assertTrue(
+            any(function == "resolve_ingredient" for _, _, function in stats.stats)
+        )
+        with open(profile_path + ".folded", encoding="utf-8") as folded_file:
+            stacks = folded_file.read()
+        self.assertIn("model.py:resolve_ingredient;", stacks)
+
+        # as a query parameter too, and profiling is released for the next request
+        token = profiling.sign_profile_token(self.path, "test secret", 300)
+        response = self.app.get(f"{self.path}?search_query=kiwi&profile={token}")
+        self.assertIn("X-Profile-Id", response.headers)
+        self.assertEqual(
+            len(profiling.list_profiles(self.profile_directory, ".prof")), 2
+        )
+
+    def tests_tokens_profile_one_request(self):
+        token = profiling.sign_profile_token(self.path, "test secret")
+        self.assertIn("X-Profile-Id", self.get_kiwi(**{"X-Profile": token}).headers)
+        for _ in range(2):
+            self.assertNotIn(
+                "X-Profile-Id", self.get_kiwi(**{"X-Profile": token}).headers
+            )
+        self.assertEqual(
+            len(profiling.list_profiles(self.profile_directory, ".prof")), 1
+        )
+        # used tokens are forgotten once they have expired
+        self.assertFalse(profiling.claim_profile_token(token, self.path, "test secret"))
+        profiling.claim_profile_token(
+            profiling.sign_profile_token(
+                self.path, "test secret", 0, time.time() + 700
+            ),
+            self.path,
+            "test secret",
+            time.time() + 700,
+        )
+        self.assertEqual(len(profiling.used_profile_tokens), 1)
+
+    def tests_invalid_tokens_are_ignored(self):
+        expired = profiling.sign_profile_token(self.path, "test secret", -1)
+        other_path = profiling.sign_profile_token("/", "test secret")
+        forged = profiling.sign_profile_token(self.path, "guessed secret")
+        for token in (expired, other_path, forged, "not a token"):
+            self.assertNotIn(
+                "X-Profile-Id", self.get_kiwi(**{"X-Profile": token}).headers
+            )
+        with mock.patch.object(profiling, "PROFILE_SECRET", ""):
+            token = profiling.sign_profile_token(self.path, "")
+            self.assertNotIn(
+                "X-Profile-Id", self.get_kiwi(**{"X-Profile": token}).headers
+            )
+
+    def tests_sampled_requests_are_profiled_and_summarized(self):
+        with mock.patch.object(profiling, "PROFILE_SAMPLE_RATE", 1.0):
+            for _ in range(2):
+                self.assertIn("X-Profile-Id", self.get_kiwi().headers)
+        summary = io.StringIO()
+        self.assertEqual(
+            profiling.summarize_profiles(self.profile_directory, stream=summary), 2
+        )
+        self.assertIn("2 profile(s)", summary.getvalue())
+        self.assertIn("resolve_ingredient", summary.getvalue())
+        self.assertIn("Most sampled frames", summary.getvalue())
@@ -0,0 +1,280 @@
+"""Warms the cache after a deploy from the search history in searches.db.
+
+    python warmup.py --top 200 --rate 2
+    WARM_CACHE_TOP_N=200 flask --app main run
+
+Queries are ranked by hit count, decayed by how long ago they were last searched. Rows without a current
+verdict are materialized from their stored payload, then rows still without one are fetched from
+Nutritionix at most --rate requests per second, in the scheduler's background lane (see quota.py). Each fetched row commits on its own, so web workers reading
+the WAL database never wait on the warm-up, and an interrupted run resumes from its checkpoint file.
+Setting WARM_CACHE_TOP_N loads the best ranked verdicts into each process's memory cache at startup.
+"""
+import os
+import sys
+import json
+import time
+import sqlite3
+import logging
+import argparse
+import functools
+import threading
+from dataclasses import dataclass
+from typing import Callable, Union
+
+import db
+from cache import MemoryCache
+from nutrients import UNUSABLE_RESPONSE_ERRORS, evaluate
+from nutritionix import UpstreamError
+from quota import BACKGROUND
+
+DEFAULT_HALF_LIFE_DAYS = 30.0
+
+
+@dataclass(frozen=True, slots=True)
+class RankedQuery:
+    """A cached query and what the warm-up still has to do for it.
+
+    Args:
+    - score(float) - hit_count halved for every half life since the query was last searched
+    - has_raw(bool) - a usable API payload is stored
+    - has_verdict(bool) - a verdict at the current db.VERDICT_VERSION is stored
+    """
+
+    query: str
+    hit_count: int
+    age_days: float
+    score: float
+    has_raw: bool
+    has_verdict: bool
+
+    @property
+    def needs_fetch(self) -> bool:
+        """No usable payload, or one that could not be materialized into a current verdict."""
+        return not (self.has_raw and self.has_verdict)
+
+
+def rank_cached_queries(
+    connection: sqlite3.Connection, half_life_days: float = DEFAULT_HALF_LIFE_DAYS
+) -> list[RankedQuery]:
+    """Returns every cached query, most valuable to have warm first."""
+    rows = connection.execute(
+        """SELECT query, hit_count, COALESCE(julianday('now') - julianday(last_seen), 0),
+                  raw != '', verdict_version IS ?
+           FROM SearchCache""",
+        (db.VERDICT_VERSION,),
+    ).fetchall()
+    ranked = [
+        RankedQuery(
+            query,
+            hit_count,
+            age_days,
+            hit_count * 0.5 ** (max(age_days, 0) / half_life_days),
+            bool(has_raw),
+            bool(has_verdict),
+        )
+        for query, hit_count, age_days, has_raw, has_verdict in rows
+    ]
+    return sorted(ranked, key=lambda ranked_query: ranked_query.score, reverse=True)
+
+
+def warm_memory_cache(
+    memory_cache: MemoryCache,
+    connection: sqlite3.Connection,
+    top_n: int,
+    half_life_days: float = DEFAULT_HALF_LIFE_DAYS,
+) -> int:
+    """Loads the materialized verdicts of the top_n ranked queries into memory_cache and returns how many were loaded."""
+    loaded = 0
+    for ranked_query in rank_cached_queries(connection, half_life_days):
+        if loaded >= min(top_n, memory_cache.max_size):
+            break
+        if not ranked_query.has_verdict:
+            continue
+        verdict = db.lookup_verdict(connection, ranked_query.query)
+        if verdict is not None:
+            memory_cache.set(ranked_query.query, verdict)
+            loaded += 1
+    return loaded
+
+
+def start_memory_cache_warmup(top_n: int) -> Union[threading.Thread, None]:
+    """Fills the shared memory cache on a background thread so startup and the first requests never wait on it."""
+    if top_n <= 0:
+        return None
+    from cache import nutrient_verdict_cache
+
+    def load():
+        started = time.perf_counter()
+        loaded = warm_memory_cache(
+            nutrient_verdict_cache, db.cache_store.connection(), top_n
+        )
+        logging.debug(
+            f"Loaded {loaded} verdict(s) into the memory cache in {time.perf_counter() - started:.2f}s"
+        )
+
+    thread = threading.Thread(target=load, name="memory-cache-warmup", daemon=True)
+    thread.start()
+    return thread
+
+
+class RateLimiter:
+    """Spaces calls at least 1 / rate seconds apart.
+
+    Args:
+    - rate(float) - calls per second; 0 disables the limit
+    """
+
+    def __init__(
+        self,
+        rate: float,
+        clock: Callable[[], float] = time.monotonic,
+        sleep: Callable[[float], None] = time.sleep,
+    ):
+        self.interval = 1 / rate if rate > 0 else 0.0
+        self.clock = clock
+        self.sleep = sleep
+        self.next_call = 0.0
+
+    def wait(self):
+        now = self.clock()
+        if self.next_call > now:
+            self.sleep(self.next_call - now)
+            now = self.next_call
+        self.next_call = now + self.interval
+
+
+def load_checkpoint(checkpoint_path: str) -> set[str]:
+    """Returns the queries a previous interrupted run already attempted."""
+    try:
+        with open(checkpoint_path, encoding="utf-8") as checkpoint_file:
+            return set(json.load(checkpoint_file)["attempted"])
+    except (OSError, ValueError, KeyError):
+        return set()
+
+
+def save_checkpoint(checkpoint_path: str, attempted: set[str]):
+    temporary_path = checkpoint_path + ".tmp"
+    with open(temporary_path, "w", encoding="utf-8") as checkpoint_file:
+        json.dump({"attempted": sorted(attempted)}, checkpoint_file)
+    os.replace(temporary_path, checkpoint_path)
+
+
+def prefetch_missing(
+    connection: sqlite3.Connection,
+    ranked_queries: list[RankedQuery],
+    fetch: Callable[[str], str],
+    rate_limiter: RateLimiter,
+    checkpoint_path: str,
+    report: Callable[[str], None] = print,
+) -> dict:
+    """Fetches and stores the queries that need it (see RankedQuery.needs_fetch), in rank order.
+
+    Args:
+    - fetch(callable) - returns the raw response text for a query, e.g. model.get_nutrient_data_from_api
+    - checkpoint_path(String) - attempted queries are recorded here after each fetch and skipped when resuming
+
+    Stops at the first nutritionix.UpstreamError, leaving the checkpoint for the next run. Returns counts of
+    fetched, unmatched, skipped and remaining queries.
+    """
+    attempted = load_checkpoint(checkpoint_path)
+    pending = [
+        ranked_query.query
+        for ranked_query in ranked_queries
+        if ranked_query.needs_fetch and ranked_query.query not in attempted
+    ]
+    counts = dict(fetched=0, unmatched=0, skipped=len(attempted), remaining=0)
+    for position, search_query in enumerate(pending, start=1):
+        rate_limiter.wait()
+        try:
+            raw = fetch(search_query)
+        except UpstreamError as error:
+            counts["remaining"] = len(pending) - position + 1
+            report(f"Nutritionix unavailable, stopping: {error}")
+            return counts
+        try:
+            verdict = evaluate(json.loads(raw.lower()))
+        except UNUSABLE_RESPONSE_ERRORS:
+            counts["unmatched"] += 1
+            outcome = "no match"
+        else:
+            db.update_cached_response(
+                connection,
+                search_query,
+                verdict.parsed_nutrient_response,
+                raw,
+                verdict.materialized_verdict,
+            )
+            counts["fetched"] += 1
+            outcome = "fetched"
+        attempted.add(search_query)
+        save_checkpoint(checkpoint_path, attempted)
+        report(f"[{position}/{len(pending)}] {search_query}: {outcome}")
+    if os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    return counts
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--database", default=db.DATABASE_PATH)
+    parser.add_argument(
+        "--top", type=int, default=0, help="only warm the N best ranked queries"
+    )
+    parser.add_argument(
+        "--rate", type=float, default=1.0, help="most Nutritionix calls per second"
+    )
+    parser.add_argument("--half-life-days", type=float, default=DEFAULT_HALF_LIFE_DAYS)
+    parser.add_argument(
+        "--checkpoint", help="progress file, defaults to <database>.warmup.json"
+    )
+    parser.add_argument(
+        "--no-fetch",
+        action="store_true",
+        help="only materialize verdicts from stored payloads",
+    )
+    parser.add_argument(
+        "--restart", action="store_true", help="ignore an existing checkpoint"
+    )
+    args = parser.parse_args(argv)
+    checkpoint_path = args.checkpoint or args.database + ".warmup.json"
+    if args.restart and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+
+    from model import get_nutrient_data_from_api, materialize_verdict_from_response
+
+    started = time.perf_counter()
+    db.cache_store = db.CacheStore(args.database, write_behind=False)
+    connection = db.cache_store.connection()
+    materialized, failed = db.backfill_verdicts(
+        connection, materialize_verdict_from_response
+    )
+    print(
+        f"{args.database}: materialized {materialized} verdict(s) from stored payloads, "
+        f"{failed} unparsable"
+    )
+    ranked_queries = rank_cached_queries(connection, args.half_life_days)
+    if args.top:
+        ranked_queries = ranked_queries[: args.top]
+    missing = sum(ranked_query.needs_fetch for ranked_query in ranked_queries)
+    print(f"{len(ranked_queries)} ranked queries, {missing} missing or stale")
+
+    counts = dict(fetched=0, unmatched=0, skipped=0, remaining=missing)
+    if not args.no_fetch:
+        counts = prefetch_missing(
+            connection,
+            ranked_queries,
+            functools.partial(get_nutrient_data_from_api, lane=BACKGROUND),
+            RateLimiter(args.rate),
+            checkpoint_path,
+        )
+    db.cache_store.close()
+    print(
+        f"Fetched {counts['fetched']}, unmatched {counts['unmatched']}, "
+        f"skipped {counts['skipped']} from an earlier run, {counts['remaining']} remaining "
+        f"({time.perf_counter() - started:.1f}s)"
+    )
+    return 1 if counts["remaining"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())